@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+"""Phase by phase analysis of visit notes in batches
+    ©2024, Ovais Quraishi
+
+    A batch of visit notes goes through a list of phases, every note of
+    the batch finishes a phase before any note starts the next one, so a
+    phase can run all of its prompts with the same model. Each phase
+    stores its result per note (and per model) in analysis_batch_results
+    and the batch records the phase it is at in analysis_batches, so a
+    run that stops, is cancelled or crashes picks up at the phase it was
+    in. Results of a batch are deleted once it is done.
+
+    Only one bulk run works at a time, it holds a Postgres advisory lock.
+
+    Example:
+        phases = [('summarize', summarize_batch), ('diagnose', diagnose_batch)]
+        stats = run_bulk(phases, batch_size=50)
+"""
+
+import datetime
+import json
+import logging
+import time
+import uuid
+from contextlib import contextmanager
+
+import psycopg2
+
+from database import db_connection
+from database import register_query
+from database import run_modify_query
+from database import run_query
+from utils import serialize_datetime
+from utils import ts_int_to_dt_obj
+
+# advisory lock key, one bulk run at a time
+BULK_ANALYSIS_LOCK_ID = 7369783
+DONE = 'done'
+
+register_query('create_analysis_batch',
+               """INSERT INTO analysis_batches
+                        (batch_id, run_id, timestamp, updated, phase, visit_note_ids)
+                   VALUES
+                        (%s, %s, %s, %s, %s, %s);
+                """)
+
+register_query('set_analysis_batch_phase',
+               """UPDATE analysis_batches
+                   SET
+                        phase = %s,
+                        updated = %s
+                   WHERE batch_id = %s;
+                """)
+
+register_query('get_open_analysis_batches',
+               """SELECT
+                        batch_id, phase, visit_note_ids
+                   FROM
+                        analysis_batches
+                   WHERE phase <> 'done'
+                   ORDER BY id;
+                """)
+
+register_query('get_analysis_batch_results',
+               """SELECT
+                        patient_note_id, phase, llm, result_document
+                   FROM
+                        analysis_batch_results
+                   WHERE batch_id = %s;
+                """)
+
+register_query('store_analysis_batch_result',
+               """INSERT INTO analysis_batch_results
+                        (batch_id, patient_note_id, phase, llm, timestamp, result_document)
+                   VALUES
+                        (%s, %s, %s, %s, %s, %s)
+                   ON CONFLICT (batch_id, patient_note_id, phase, llm) DO UPDATE
+                   SET
+                        timestamp = EXCLUDED.timestamp,
+                        result_document = EXCLUDED.result_document;
+                """)
+
+register_query('delete_analysis_batch_results',
+               """DELETE FROM analysis_batch_results
+                   WHERE batch_id = %s;
+                """)
+
+# notes of earlier batches of the run are left out, a note that failed
+#  is not taken again in the same run
+register_query('get_next_bulk_visit_notes',
+               """SELECT
+                        patient_note_id
+                   FROM
+                        patient_notes pn
+                   WHERE NOT EXISTS (SELECT 1
+                                     FROM patient_documents pd
+                                     WHERE pd.patient_note_id = pn.patient_note_id)
+                         AND NOT EXISTS (SELECT 1
+                                         FROM analysis_batches ab
+                                         WHERE ab.run_id = %s
+                                               AND ab.visit_note_ids ? pn.patient_note_id)
+                   ORDER BY pn.patient_note_id
+                   LIMIT %s;
+                """)
+
+def _revive_timestamps(document):
+    # prompt results carry datetime timestamps, JSON has strings
+    stack = [document]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, dict):
+            timestamp = item.get('timestamp')
+            if isinstance(timestamp, str):
+                try:
+                    item['timestamp'] = datetime.datetime.fromisoformat(timestamp)
+                except ValueError:
+                    pass
+            stack.extend(value for value in item.values() if isinstance(value, (dict, list)))
+        elif isinstance(item, list):
+            stack.extend(value for value in item if isinstance(value, (dict, list)))
+    return document
+
+class AnalysisBatch:
+    """Visit notes analyzed together, the phase they are at and the
+        results of the phases they went through
+    """
+
+    def __init__(self, batch_id, phase, visit_note_ids, results=None):
+        self.batch_id = batch_id
+        self.phase = phase
+        self.visit_note_ids = list(visit_note_ids)
+        # (phase, llm, patient_note_id) -> result
+        self.results = results or {}
+
+    @classmethod
+    def create(cls, run_id, visit_note_ids, phase):
+        dt = ts_int_to_dt_obj()
+        batch = cls(uuid.uuid4().hex, phase, visit_note_ids)
+        run_modify_query('create_analysis_batch', (batch.batch_id, run_id, dt, dt, phase,
+                                                   json.dumps(batch.visit_note_ids)))
+        return batch
+
+    @classmethod
+    def load(cls, row):
+        batch = cls(row['batch_id'], row['phase'], row['visit_note_ids'])
+        for result in run_query('get_analysis_batch_results', (batch.batch_id,)):
+            key = (result['phase'], result['llm'], result['patient_note_id'])
+            batch.results[key] = _revive_timestamps(result['result_document'])
+        return batch
+
+    def result(self, phase, patient_note_id, llm=''):
+        """Result a phase stored for a note, None if it has none
+        """
+
+        return self.results.get((phase, llm, patient_note_id))
+
+    def pending(self, phase, llm='', needs=None, needs_llm=''):
+        """Notes without a result for phase (and llm) yet, of those with a
+            result for the phase needs (and needs_llm), when given
+        """
+
+        return [patient_note_id for patient_note_id in self.visit_note_ids
+                if self.result(phase, patient_note_id, llm) is None
+                and (needs is None or self.result(needs, patient_note_id, needs_llm) is not None)]
+
+    def store(self, phase, patient_note_id, result, llm=''):
+        """Keep and persist the result of a phase for a note
+        """
+
+        run_modify_query('store_analysis_batch_result',
+                         (self.batch_id, patient_note_id, phase, llm, ts_int_to_dt_obj(),
+                          json.dumps(result, default=serialize_datetime)))
+        self.results[(phase, llm, patient_note_id)] = result
+
+    def advance(self, phase):
+        """Record that the batch is at phase, results are dropped once it
+            is done
+        """
+
+        run_modify_query('set_analysis_batch_phase', (phase, ts_int_to_dt_obj(), self.batch_id))
+        self.phase = phase
+        if phase == DONE:
+            run_modify_query('delete_analysis_batch_results', (self.batch_id,))
+
+    def completed(self, phase):
+        """Notes with a result for phase, for any llm
+        """
+
+        return len({patient_note_id for result_phase, _, patient_note_id in self.results
+                    if result_phase == phase})
+
+@contextmanager
+def bulk_run_lock():
+    """True while this process holds the bulk run lock, False if another
+        run has it. The lock is held on a pooled connection for the whole
+        run and released before the connection goes back to the pool, it
+        goes with the connection if the process dies.
+    """
+
+    with db_connection() as conn, conn.cursor() as cur:
+        cur.execute('SELECT pg_try_advisory_lock(%s);', (BULK_ANALYSIS_LOCK_ID,))
+        locked = cur.fetchone()[0]
+        conn.commit()
+        try:
+            yield locked
+        finally:
+            if locked and not conn.closed:
+                try:
+                    cur.execute('SELECT pg_advisory_unlock(%s);', (BULK_ANALYSIS_LOCK_ID,))
+                    conn.commit()
+                except psycopg2.Error as e:
+                    # closing the session releases the lock as well
+                    logging.error('Releasing bulk run lock: %s', e)
+                    conn.close()
+
+def _batches(run_id, first_phase, visit_note_ids, batch_size):
+    for row in run_query('get_open_analysis_batches'):
+        logging.info('Resuming analysis batch %s at %s', row['batch_id'], row['phase'])
+        yield AnalysisBatch.load(row)
+
+    if visit_note_ids is not None:
+        for offset in range(0, len(visit_note_ids), batch_size):
+            yield AnalysisBatch.create(run_id, visit_note_ids[offset:offset + batch_size],
+                                       first_phase)
+        return
+
+    while True:
+        rows = run_query('get_next_bulk_visit_notes', (run_id, batch_size))
+        if not rows:
+            return
+        yield AnalysisBatch.create(run_id, [row['patient_note_id'] for row in rows], first_phase)
+
+def run_bulk(phases, visit_note_ids=None, batch_size=50, cancelled=None, stats=None):
+    """Run batches of visit notes through phases, a list of
+        (phase name, callable(AnalysisBatch)) in order. Unfinished batches
+        of earlier runs go first, then batches of batch_size visit_note_ids
+        or, by default, of the notes that have not been analyzed yet.
+
+        cancelled is checked between phases, a cancelled run can be picked
+        up later. stats is updated as the run goes, the last phase's
+        results are the completed notes. Raises RuntimeError when another
+        bulk run is in progress.
+    """
+
+    phase_names = [name for name, _ in phases]
+    cancelled = cancelled or (lambda: False)
+    stats = stats if stats is not None else {}
+    stats.update({
+                  'batches': 0,
+                  'submitted': 0,
+                  'completed': 0,
+                  'failed': 0,
+                  'phases': {name: 0.0 for name in phase_names},
+                  'cancelled': False
+                 })
+    started = time.monotonic()
+
+    with bulk_run_lock() as locked:
+        if not locked:
+            raise RuntimeError('Another bulk analysis run is in progress')
+
+        run_id = uuid.uuid4().hex
+        for batch in _batches(run_id, phase_names[0], visit_note_ids, batch_size):
+            stats['batches'] += 1
+            stats['submitted'] += len(batch.visit_note_ids)
+            position = phase_names.index(batch.phase) if batch.phase in phase_names else 0
+            for name, func in phases[position:]:
+                if cancelled():
+                    stats['cancelled'] = True
+                    break
+                phase_started = time.monotonic()
+                logging.info('Batch %s: %s %s visit notes', batch.batch_id, name,
+                             len(batch.visit_note_ids))
+                func(batch)
+                stats['phases'][name] = round(stats['phases'][name] +
+                                              time.monotonic() - phase_started, 3)
+                following = phase_names.index(name) + 1
+                batch.advance(phase_names[following] if following < len(phase_names) else DONE)
+            if stats['cancelled']:
+                break
+            stats['completed'] += batch.completed(phase_names[-1])
+            stats['failed'] = stats['submitted'] - stats['completed']
+
+    stats['elapsed_seconds'] = round(time.monotonic() - started, 3)
+    return stats
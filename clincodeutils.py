@@ -1,15 +1,44 @@
 #!/usr/bin/env python3
 """ ©2024, Ovais Quraishi """
 
-import ast
 import asyncio
 import logging
 import re
-from gptutils import prompt_chat
-import simple_icd_10_cm as icddetails
-import icd10 as icdbilling
+from codedetails import CODE_DETAILS
+from config import get_config
+from gptutils import json_format
+from gptutils import json_object_closed
+from gptutils import json_value_closed
+from gptutils import prompt_chat_stream
+from gptutils import run_sync
+from icdresolver import ICD10_RESOLVER
+from llmoutput import BillingGuidelines
+from llmoutput import CodeDescription
+from llmoutput import CPT_CODE_BATCH_SCHEMA
+from llmoutput import CPT_CODE_SCHEMA
+from llmoutput import HCPCS_CODE_BATCH_SCHEMA
+from llmoutput import HCPCS_CODE_SCHEMA
+from llmoutput import ICD_BILLING_GUIDELINES_SCHEMA
+from llmoutput import LLMOutputError
+from llmoutput import parse_code_batch
+from llmoutput import parse_reply
+from pipeline import parse_worker_counts
 from bs4 import BeautifulSoup
 
+CONFIG = get_config()
+
+# model the code lookup prompts run on
+CODE_LOOKUP_LLM = 'llama3.1'
+# cpt/hcpcs codes asked for per prompt, for models that are not listed in
+#  CODE_LOOKUP_BATCH_SIZES, 1 asks for one code at a time
+DEFAULT_CODE_LOOKUP_BATCH_SIZE = 10
+# cpt/hcpcs codes per lookup prompt on CODE_LOOKUP_LLM, CODE_LOOKUP_BATCH_SIZES
+#  in setup.config lists them as model:size,model:size
+CODE_LOOKUP_BATCH_SIZE = max(1, parse_worker_counts(CONFIG.get('service', 'CODE_LOOKUP_BATCH_SIZES',
+                                                               fallback=''),
+                                                    [CODE_LOOKUP_LLM],
+                                                    DEFAULT_CODE_LOOKUP_BATCH_SIZE)[CODE_LOOKUP_LLM])
+
 def extract_icd10_codes(text):
     """Extract ICD-10 codes from a string.
     """
@@ -31,88 +60,252 @@ def extract_hcpcs_codes(text):
     lookup_pattern = r'\b\d{5}\b'
     return re.findall(lookup_pattern, text)
 
-def icd_10_code_details(icd_10_code):
-    """ICD-10 code details
+def icd_10_code_details(icd_10_code, icd_details_obj):
+    """ICD-10 code details, the text of a billing guidelines prompt result
     """
 
     try:
-        icd_details_obj = lookup_icd_gpt(icd_10_code)
         return icd_details_obj['analysis']
-    except (ValueError, AttributeError) as e:
-        logging.error('Error: %s, %s', icd_10_code, e.args[0])
-        return e.args[0]
+    except (KeyError, TypeError) as e:
+        raise LLMOutputError(f'No billing guidelines reply for {icd_10_code}') from e
+
+def parse_icd_10_code_details(icd_10_code, icd_details_obj):
+    """Parse the LLM reply with the billing guidelines of an icd-10 code,
+        raises LLMOutputError when the reply can't be read
+    """
+
+    return parse_reply(icd_10_code_details(icd_10_code, icd_details_obj), BillingGuidelines)
 
 def icd_10_code_details_list(list_of_icd_10_codes):
     """Details about each icd-10 code found
     """
-    
-    details_list = []
-
-    for icd_10_code in list_of_icd_10_codes:
-        # should be dictionary object
-        detail = icd_10_code_details(icd_10_code).replace('  ','').replace('\n','')
-        details = ast.literal_eval(detail)
-        details_list.append(details)
-
-    return details_list
-
-def lookup_icd_gpt(icd_code):
-    """Lookup icd codes using llama3.1
-    """
-
-    code_lookup_prompt = f"""Response MUST BE JSON ONLY, no additional comments. Tell me about ICD-10 code {icd_code}, is it billable? Respond in JSON only. Use the following python JSON template, \
-    the JSON needs to be python compliant where boolean "true" needs to be represented as True and \
-    "false" as False: \
-     {{'code': 'icd-10 code goes here',
-        'billable': BOOLEAN,
-        'full_data': {{
-            'short_description': 'short description goes here',
-            'long_description': 'long description goes here',
-            'billing_guidelines': {{
-                'insurance_company': {{
-                    'reimbursement_rate': 'REIMBURSEMENT RATE from the insurance company goes here',
-                    'billing_instructions': 'billing instructions from the insurance company go here'
-                }},
-                'medical_provider': {{
-                    'reimbursement_rate': 'REIMBURSEMENT RATE from the medical provider goes here',
-                    'billing_instructions': 'billing instructions from the medical provider go here'
-                }}
-            }}
-        }}}}
+
+    return run_sync(icd_10_code_details_list_async(list_of_icd_10_codes))
+
+async def icd_10_code_details_list_async(list_of_icd_10_codes):
+    """Details about each icd-10 code found, codes are looked up
+        concurrently, each code is only ever described once by the LLM,
+        see codedetails.py
     """
 
-    icd_details = asyncio.run(prompt_chat('llama3.1', code_lookup_prompt + '', False))
+    return await CODE_DETAILS.lookup_many('icd', list_of_icd_10_codes, fetch_icd_details_gpt)
+
+async def fetch_icd_details_gpt(icd_10_code):
+    """Details for an icd-10 code, validity, billable flag and descriptions
+        come from the offline ICD-10-CM index, the LLM is only asked for
+        the billing guidelines of valid codes
+    """
+
+    resolved = ICD10_RESOLVER.resolve(icd_10_code)
+    if not resolved:
+        resolved = {
+                    'code': icd_10_code,
+                    'valid': False,
+                    'billable': False,
+                    'short_description': '',
+                    'long_description': ''
+                   }
+
+    billing_guidelines = BillingGuidelines()
+    incomplete = False
+    if resolved['valid']:
+        guidelines_obj = await prompt_chat_stream(CODE_LOOKUP_LLM,
+                                                  icd_billing_guidelines_prompt(resolved['code'],
+                                                                                resolved['short_description']),
+                                                  False,
+                                                  stop_when=json_object_closed(),
+                                                  output_format=json_format(ICD_BILLING_GUIDELINES_SCHEMA))
+        if not guidelines_obj:
+            # no model endpoint answered, the code is known but has no
+            #  billing guidelines yet
+            logging.error('Billing guidelines for %s: no reply', icd_10_code)
+            incomplete = True
+        else:
+            try:
+                billing_guidelines = parse_icd_10_code_details(icd_10_code, guidelines_obj)
+            except LLMOutputError as e:
+                logging.error('Billing guidelines for %s: %s', icd_10_code, e)
+                incomplete = True
+
+    icd_details = {
+                   'code': resolved['code'],
+                   'valid': resolved['valid'],
+                   'billable': resolved['billable'],
+                   'full_data': {
+                                 'short_description': resolved['short_description'],
+                                 'long_description': resolved['long_description'],
+                                 'billing_guidelines': billing_guidelines.to_dict()
+                                }
+                  }
+    if incomplete:
+        icd_details['incomplete'] = True
 
     return icd_details
 
-def lookup_cpt_gpt(cpt_code_list):
-    """Lookup cpt codes using llama3.1
+def icd_billing_guidelines_prompt(icd_code, description):
+    """Prompt used to ask for the billing guidelines of an icd code
+    """
+
+    code_lookup_prompt = f"""Response MUST BE JSON ONLY, no additional comments. What are the billing guidelines \
+    for ICD-10 code {icd_code} ({description})? Respond in JSON only. Use the following JSON template: \
+     {{"insurance_company": {{
+            "reimbursement_rate": "REIMBURSEMENT RATE from the insurance company goes here",
+            "billing_instructions": "billing instructions from the insurance company go here"
+        }},
+        "medical_provider": {{
+            "reimbursement_rate": "REIMBURSEMENT RATE from the medical provider goes here",
+            "billing_instructions": "billing instructions from the medical provider go here"
+        }}}}
     """
 
-    cpt_details = []
-    for cpt_code in cpt_code_list:
-        code_lookup_prompt = f"""Explain CPT code {cpt_code}. Respond with JSON only. Keys cpt is the code number, \
+    return code_lookup_prompt
+
+def cpt_code_lookup_prompt(cpt_code):
+    """Prompt used to look up a cpt code
+    """
+
+    code_lookup_prompt = f"""Explain CPT code {cpt_code}. Respond with JSON only. Keys cpt is the code number, \
         details is a dictionary with nested keys short_description and long_description. JSON template {{"cpt": "actual \
         cpt code", "details": {{"short_description": "short description goes here", "long_description": "long \
         description goes here"}}}}"""
 
-        result = asyncio.run(prompt_chat('llama3.1', code_lookup_prompt + '', False))
-        cpt_details.append(result['analysis'])
+    return code_lookup_prompt
+
+def hcpcs_code_lookup_prompt(hcpcs_code):
+    """Prompt used to look up a hcpcs code
+    """
+
+    code_lookup_prompt = f"""Explain HCPCS code {hcpcs_code}. Respond with JSON only. Keys cpt is the code number, \
+        details is a dictionary with nested keys short_description and long_description. JSON template {{"hcpcs": "actual \
+        hcpcs code", "details": {{"short_description": "short description goes here", "long_description": "long \
+        description goes here"}}}}"""
+
+    return code_lookup_prompt
+
+def code_batch_lookup_prompt(code_system, codes):
+    """Prompt used to look up several cpt or hcpcs codes at once
+    """
+
+    code_lookup_prompt = f"""Explain each of these {code_system.upper()} codes: {', '.join(codes)}. Respond with \
+        JSON only. Key codes is a list with one entry for every code, in the order given. In each entry key \
+        {code_system} is the code number, details is a dictionary with nested keys short_description and \
+        long_description. JSON template {{"codes": [{{"{code_system}": "actual {code_system} code", "details": \
+        {{"short_description": "short description goes here", "long_description": "long description goes \
+        here"}}}}]}}"""
+
+    return code_lookup_prompt
+
+def lookup_cpt_gpt(cpt_code_list):
+    """Lookup cpt codes using llama3.1
+    """
+
+    return run_sync(lookup_cpt_gpt_async(cpt_code_list))
+
+async def lookup_cpt_gpt_async(cpt_code_list):
+    """Lookup cpt codes using llama3.1, codes are looked up concurrently,
+        several per prompt, and each code is only ever described once by
+        the LLM
+    """
+
+    cpt_details = await lookup_code_details('cpt', cpt_code_list)
 
     return cpt_details
 
+async def fetch_cpt_details_gpt(cpt_code):
+    """Ask the LLM about a cpt code
+    """
+
+    result = await prompt_chat_stream(CODE_LOOKUP_LLM, cpt_code_lookup_prompt(cpt_code) + '', False,
+                                      stop_when=json_object_closed(),
+                                      output_format=json_format(CPT_CODE_SCHEMA))
+    return code_description(result, 'cpt', cpt_code)
+
 def lookup_hcpcs_gpt(hcpcs_code_list):
     """Lookup hcpcs codes using llama3.1
     """
 
-    hcpcs_details = []
-    for hcpcs_code in hcpcs_code_list:
-        code_lookup_prompt = f"""Explain HCPCS code {hcpcs_code}. Respond with JSON only. Keys cpt is the code number, \
-        details is a dictionary with nested keys short_description and long_description. JSON template {{"hcpcs": "actual \
-        hcpcs code", "details": {{"short_description": "short description goes here", "long_description": "long \
-        description goes here"}}}}"""
+    return run_sync(lookup_hcpcs_gpt_async(hcpcs_code_list))
+
+async def lookup_hcpcs_gpt_async(hcpcs_code_list):
+    """Lookup hcpcs codes using llama3.1, codes are looked up concurrently,
+        several per prompt, and each code is only ever described once by
+        the LLM
+    """
 
-        result = asyncio.run(prompt_chat('llama3.1', code_lookup_prompt + '', False))
-        hcpcs_details.append(result['analysis'])
+    hcpcs_details = await lookup_code_details('hcpcs', hcpcs_code_list)
 
     return hcpcs_details
+
+async def fetch_hcpcs_details_gpt(hcpcs_code):
+    """Ask the LLM about a hcpcs code
+    """
+
+    result = await prompt_chat_stream(CODE_LOOKUP_LLM, hcpcs_code_lookup_prompt(hcpcs_code) + '', False,
+                                      stop_when=json_object_closed(),
+                                      output_format=json_format(HCPCS_CODE_SCHEMA))
+    return code_description(result, 'hcpcs', hcpcs_code)
+
+def code_description(result, code_system, code):
+    """cpt/hcpcs details from a lookup prompt result, a reply that can't
+        be read gives empty descriptions marked incomplete
+    """
+
+    try:
+        return parse_reply(result['analysis'] if result else '', CodeDescription,
+                           code_system).to_dict()
+    except LLMOutputError as e:
+        logging.error('%s code %s: %s', code_system, code, e)
+        return dict(CodeDescription(code_system, code).to_dict(), incomplete=True)
+
+async def lookup_code_details(code_system, codes):
+    """cpt/hcpcs details for a list of codes, in order, through the code
+        details dictionary, CODE_LOOKUP_BATCH_SIZE codes per prompt
+    """
+
+    batch_size = CODE_LOOKUP_BATCH_SIZE
+    if batch_size == 1:
+        return await CODE_DETAILS.lookup_many(code_system, codes, CODE_DETAIL_FETCHERS[code_system])
+
+    async def fetch_batch(batch):
+        return await fetch_code_details_batch_gpt(code_system, batch)
+
+    return await CODE_DETAILS.lookup_batched(code_system, codes, fetch_batch, batch_size)
+
+async def fetch_code_details_batch_gpt(code_system, codes):
+    """Ask the LLM about several cpt or hcpcs codes in one prompt, returns
+        {code: details} for every code. Codes the reply left out are asked
+        for again, one prompt each.
+    """
+
+    result = await prompt_chat_stream(CODE_LOOKUP_LLM, code_batch_lookup_prompt(code_system, codes), False,
+                                      stop_when=json_value_closed(),
+                                      output_format=json_format(CODE_BATCH_SCHEMAS[code_system]))
+    try:
+        descriptions = parse_code_batch(result['analysis'] if result else '', code_system)
+    except LLMOutputError as e:
+        logging.error('%s batch %s: %s', code_system, ', '.join(codes), e)
+        descriptions = {}
+
+    details = {}
+    for code in codes:
+        description = descriptions.get(code.upper())
+        if description is not None:
+            description.code = code
+            details[code] = description.to_dict()
+
+    missing = [code for code in codes if code not in details]
+    if missing:
+        logging.info('%s of %s %s codes missing from the batch reply, asking for them one by one',
+                     len(missing), len(codes), code_system)
+        fetch = CODE_DETAIL_FETCHERS[code_system]
+        details.update(zip(missing, await asyncio.gather(*(fetch(code) for code in missing))))
+    return details
+
+CODE_DETAIL_FETCHERS = {
+                        'cpt': fetch_cpt_details_gpt,
+                        'hcpcs': fetch_hcpcs_details_gpt
+                       }
+CODE_BATCH_SCHEMAS = {
+                      'cpt': CPT_CODE_BATCH_SCHEMA,
+                      'hcpcs': HCPCS_CODE_BATCH_SCHEMA
+                     }
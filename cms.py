@@ -1,53 +1,86 @@
 #!/usr/bin/env python3
 """Collect Fee Schedules for CPT/HCPCS codes
     ©2024, Ovais Quraishi
+
+    Harvests the fee schedule of every code listed in CODES_FILE from the
+    pfs.data.cms.gov datastore and stores it as JSONB in the
+    cpt_hcpcs_codes table. Codes are fetched concurrently, with a bounded
+    number of requests in flight and a minimum interval between requests.
+    Rows are inserted in bulk, and every code whose rows are committed is
+    written to a checkpoint file, so an interrupted run picks up where it
+    stopped. Codes already in the table are skipped.
+
+    Every run loads a fee schedule snapshot, labelled with the CMS release
+    it was taken from. Fetched rows are diffed, per code, against the
+    current rows by sha256: only new or changed rows are inserted, tagged
+    with the snapshot as first_snapshot_id, and current rows that CMS no
+    longer returns get the snapshot as retired_snapshot_id. A row belongs
+    to every snapshot from its first up to, not including, its retired
+    one, so pricing queries can be pinned to any loaded snapshot. Once a
+    snapshot is complete the fee matrix (see feematrix.py) is rebuilt
+    from the latest complete snapshot.
+
+    Run:
+        > python cms.py --concurrency 4 --rate 2 --checkpoint cms.checkpoint.json
+    Quarterly refresh, re-fetches every code and only writes the delta:
+        > python cms.py --delta --snapshot 2024Q2 --effective-date 2024-04-01
 """
 
+import argparse
+import asyncio
+import datetime
 import hashlib
-import requests
 import json
+import logging
+import os
+import time
+
+import httpx
 
 from utils import ts_int_to_dt_obj
 from utils import serialize_datetime
-from database import insert_data_into_table
+from database import insert_many_into_table
+from database import register_query
+from database import run_modify_query
+from database import run_query
+from feematrix import build_fee_matrix
 
-with open('2024_DHS_Code_List_Addendum_03_01_2024.txt') as afile:
-    CODES = [line.rstrip('\n') for line in afile]
+CODES_FILE = '2024_DHS_Code_List_Addendum_03_01_2024.txt'
+CMS_API_URL = 'https://pfs.data.cms.gov/api/1/datastore/query'
 
-def get_details(hcpcs_code):
-    """Get CPT code details and fee schedules, store as JSONB in
-        PostgreSQL database
-    """
+HEADERS_OPTIONS = {
+    'Accept': '*/*',
+    'Accept-Language': 'en-US,en;q=0.9',
+    'Access-Control-Request-Headers': 'content-type',
+    'Access-Control-Request-Method': 'POST',
+    'Connection': 'keep-alive',
+    'Origin': 'https://www.cms.gov',
+    'Referer': 'https://www.cms.gov/',
+    'Sec-Fetch-Dest': 'empty',
+    'Sec-Fetch-Mode': 'cors',
+    'Sec-Fetch-Site': 'same-site',
+    'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36'
+}
 
-    headers_options = {
-        'Accept': '*/*',
-        'Accept-Language': 'en-US,en;q=0.9',
-        'Access-Control-Request-Headers': 'content-type',
-        'Access-Control-Request-Method': 'POST',
-        'Connection': 'keep-alive',
-        'Origin': 'https://www.cms.gov',
-        'Referer': 'https://www.cms.gov/',
-        'Sec-Fetch-Dest': 'empty',
-        'Sec-Fetch-Mode': 'cors',
-        'Sec-Fetch-Site': 'same-site',
-        'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36'
-    }
+HEADERS_POST = {
+    'Accept': 'application/json, text/plain, */*',
+    'Accept-Language': 'en-US,en;q=0.9',
+    'Connection': 'keep-alive',
+    'Content-Type': 'application/json',
+    'Origin': 'https://www.cms.gov',
+    'Referer': 'https://www.cms.gov/',
+    'Sec-Fetch-Dest': 'empty',
+    'Sec-Fetch-Mode': 'cors',
+    'Sec-Fetch-Site': 'same-site',
+    'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36',
+    'sec-ch-ua': '"Chromium";v="122", "Not(A:Brand";v="24", "Google Chrome";v="122"',
+    'sec-ch-ua-mobile': '?0',
+    'sec-ch-ua-platform': '"macOS"'
+}
 
-    headers_post = {
-        'Accept': 'application/json, text/plain, */*',
-        'Accept-Language': 'en-US,en;q=0.9',
-        'Connection': 'keep-alive',
-        'Content-Type': 'application/json',
-        'Origin': 'https://www.cms.gov',
-        'Referer': 'https://www.cms.gov/',
-        'Sec-Fetch-Dest': 'empty',
-        'Sec-Fetch-Mode': 'cors',
-        'Sec-Fetch-Site': 'same-site',
-        'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36',
-        'sec-ch-ua': '"Chromium";v="122", "Not(A:Brand";v="24", "Google Chrome";v="122"',
-        'sec-ch-ua-mobile': '?0',
-        'sec-ch-ua-platform': '"macOS"'
-    }
+def hcpcs_check_query(hcpcs_code):
+    """Datastore query that checks whether a code exists
+    """
 
     data_post = {
     "resources": [
@@ -80,6 +113,12 @@ def get_details(hcpcs_code):
     "keys": True
     }
 
+    return data_post
+
+def pricing_query(hcpcs_code):
+    """Datastore query for the fee schedule of a code, for every locality
+    """
+
     data_all = {
     "resources": [
         {
@@ -792,29 +831,373 @@ def get_details(hcpcs_code):
     "keys": True
     }
 
-    url1 = f'https://pfs.data.cms.gov/api/1/datastore/query?search=hcpcsCheck{hcpcs_code}&redirect=false&ACA='
-    url2 = f'https://pfs.data.cms.gov/api/1/datastore/query?search=pricing_single_{hcpcs_code}&redirect=false&ACA='
-
-    session = requests.Session()
-    session.options(url1, headers=headers_options)
-    session.post(url1, headers=headers_post, json=data_post)
-    session.options(url2, headers=headers_options)
-    session_response = session.post(url2, headers=headers_post, json=data_all)
-
-    results = json.loads(json.dumps(session_response.json()))['results']
-    return results
-
-ts = serialize_datetime(ts_int_to_dt_obj())
-for a_code in CODES:
-    datas = get_details(a_code)
-    if datas:
-        for a_data in datas:
-            data_sha256 = hashlib.sha256(json.dumps(a_data, sort_keys=True).encode('utf-8')).hexdigest()
-            codes_data = {
-                          'timestamp' : ts,
-                          'sha256' : data_sha256,
-                          'codes_document' : json.dumps(a_data)
-                         }
-            insert_data_into_table('cpt_hcpcs_codes', codes_data)
+    return data_all
+
+def read_codes(codes_file=CODES_FILE):
+    """CPT/HCPCS codes to harvest, one per line
+    """
+
+    with open(codes_file) as afile:
+        return [line.rstrip('\n') for line in afile if line.strip()]
+
+def fee_schedule_rows(datas, ts):
+    """cpt_hcpcs_codes rows for the fee schedule records of a code
+    """
+
+    codes_rows = []
+    for a_data in datas:
+        data_sha256 = hashlib.sha256(json.dumps(a_data, sort_keys=True).encode('utf-8')).hexdigest()
+        codes_data = {
+                      'timestamp' : ts,
+                      'sha256' : data_sha256,
+                      'codes_document' : json.dumps(a_data)
+                     }
+        codes_rows.append(codes_data)
+    return codes_rows
+
+register_query('get_ingested_codes',
+               """SELECT DISTINCT
+                        hcpc
+                  FROM
+                        cpt_hcpcs_codes
+                  WHERE retired_snapshot_id IS NULL;
+               """)
+
+register_query('begin_snapshot',
+               """INSERT INTO fee_schedule_snapshots
+                        (timestamp, label, effective_date, status)
+                  VALUES
+                        (%s, %s, %s, 'loading')
+                  ON CONFLICT (label) DO UPDATE SET
+                        timestamp = EXCLUDED.timestamp
+                  WHERE fee_schedule_snapshots.status = 'loading'
+                  RETURNING id;
+               """,
+               types=('timestamp with time zone', 'text', 'date'))
+
+register_query('complete_snapshot',
+               """UPDATE fee_schedule_snapshots
+                  SET
+                        status = 'complete',
+                        stats = %s
+                  WHERE id = %s;
+               """,
+               types=('jsonb', 'integer'))
+
+register_query('get_current_rows',
+               """SELECT
+                        id, sha256
+                  FROM
+                        cpt_hcpcs_codes
+                  WHERE hcpc = ANY(%s)
+                        AND retired_snapshot_id IS NULL;
+               """,
+               types=('text[]',))
+
+register_query('retire_rows',
+               """UPDATE cpt_hcpcs_codes
+                  SET
+                        retired_snapshot_id = %s
+                  WHERE id = ANY(%s)
+                        AND retired_snapshot_id IS NULL
+                  RETURNING id;
+               """,
+               types=('integer', 'integer[]'))
+
+def get_ingested_codes():
+    """Codes that already have fee schedule rows in the table
+    """
+
+    return {row['hcpc'] for row in run_query('get_ingested_codes')}
+
+def begin_snapshot(label, effective_date):
+    """Create the fee schedule snapshot a run loads into, or pick up the
+        unfinished one with the same label, returns its id
+    """
+
+    created = run_modify_query('begin_snapshot', (ts_int_to_dt_obj(), label, effective_date))
+    if not created:
+        raise ValueError(f'Fee schedule snapshot {label} is already complete')
+    return created[0]['id']
+
+def complete_snapshot(snapshot_id, stats):
+    """Mark a snapshot complete, pricing queries use the latest complete
+        snapshot by default
+    """
+
+    run_modify_query('complete_snapshot', (json.dumps(stats), snapshot_id))
+
+def get_current_rows(hcpcs_codes):
+    """sha256 -> id of the current, not retired, rows of codes
+    """
+
+    rows = run_query('get_current_rows', (list(hcpcs_codes),))
+    return {row['sha256']: row['id'] for row in rows}
+
+def retire_rows(row_ids, snapshot_id):
+    """Retire rows that are no longer in the fee schedule as of snapshot_id
+    """
+
+    if not row_ids:
+        return 0
+    return len(run_modify_query('retire_rows', (snapshot_id, list(row_ids))))
+
+def store_delta(rows, hcpcs_codes, snapshot_id):
+    """Diff fetched rows of codes against their current rows, insert new
+        and changed rows, retire the ones that are gone
+
+        Re-running it for the same codes and snapshot changes nothing, so
+        a code can safely be stored again after an interruption.
+    """
+
+    current = get_current_rows(hcpcs_codes)
+    new_rows = []
+    fetched = set()
+    for row in rows:
+        fetched.add(row['sha256'])
+        if row['sha256'] not in current:
+            new_rows.append(dict(row, first_snapshot_id=snapshot_id))
+
+    inserted = 0
+    if new_rows:
+        batches = insert_many_into_table('cpt_hcpcs_codes', new_rows)
+        inserted = sum(batch['inserted'] for batch in batches)
+    retired = retire_rows([row_id for sha256, row_id in current.items()
+                           if sha256 not in fetched], snapshot_id)
+    return {
+            'inserted': inserted,
+            'unchanged': len(rows) - len(new_rows),
+            'retired': retired
+           }
+
+class RateLimiter:
+    """Spaces out request starts by at least 1/rate seconds
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self._lock = asyncio.Lock()
+        self._next_start = 0
+
+    async def wait(self):
+        """Wait for the next request slot
+        """
+
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next_start - now
+            self._next_start = max(now, self._next_start) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+class Checkpoint:
+    """Codes that are done, kept in a JSON file that is replaced atomically,
+        a checkpoint left by a run for another snapshot is ignored
+    """
+
+    def __init__(self, path, snapshot=None):
+        self.path = path
+        self.snapshot = snapshot
+        self.done = set()
+        if path and os.path.exists(path):
+            with open(path, encoding='utf-8') as afile:
+                checkpoint = json.load(afile)
+            if checkpoint.get('snapshot') == snapshot:
+                self.done = set(checkpoint.get('done', []))
+
+    def save(self, codes):
+        """Mark codes done and write the file
+        """
+
+        self.done.update(codes)
+        if not self.path:
+            return
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as afile:
+            json.dump({
+                       'timestamp': serialize_datetime(ts_int_to_dt_obj()),
+                       'snapshot': self.snapshot,
+                       'done': sorted(self.done)
+                      }, afile)
+        os.replace(tmp_path, self.path)
+
+class FeeScheduleHarvester:
+    """Concurrent, resumable fee schedule harvester
+
+        concurrency: codes fetched at the same time
+        rate: max requests started per second, 0 for no limit
+        flush_size: rows buffered before they are inserted
+        preflight: also send the OPTIONS requests a browser would send
+        snapshot_id, snapshot: id and label of the snapshot being loaded
+    """
+
+    def __init__(self, base_url=CMS_API_URL, concurrency=4, rate=2, checkpoint_file=None,
+                 flush_size=2000, retries=3, timeout=60, preflight=False,
+                 snapshot_id=None, snapshot=None):
+        self.base_url = base_url
+        self.concurrency = concurrency
+        self.limiter = RateLimiter(rate)
+        self.checkpoint = Checkpoint(checkpoint_file, snapshot)
+        self.snapshot_id = snapshot_id
+        self.flush_size = flush_size
+        self.retries = retries
+        self.timeout = timeout
+        self.preflight = preflight
+        self.ts = serialize_datetime(ts_int_to_dt_obj())
+        self._rows = []
+        self._pending_codes = []
+        self._flush_lock = None
+        self.stats = {
+                      'codes': 0,
+                      'skipped': 0,
+                      'no_data': 0,
+                      'failed': 0,
+                      'rows': 0,
+                      'inserted': 0,
+                      'unchanged': 0,
+                      'retired': 0
+                     }
+
+    async def _request(self, client, method, url, **kwargs):
+        for attempt in range(1, self.retries + 1):
+            await self.limiter.wait()
+            try:
+                response = await client.request(method, url, **kwargs)
+                response.raise_for_status()
+                return response
+            except (httpx.TransportError, httpx.HTTPStatusError) as e:
+                if attempt == self.retries:
+                    raise
+                backoff = 2 ** attempt
+                logging.warning('%s %s failed (%s), retrying in %ss', method, url, e, backoff)
+                await asyncio.sleep(backoff)
+
+    async def _post(self, client, url, query):
+        if self.preflight:
+            await self._request(client, 'OPTIONS', url, headers=HEADERS_OPTIONS)
+        response = await self._request(client, 'POST', url, headers=HEADERS_POST, json=query)
+        return response.json().get('results') or []
+
+    async def fetch_code(self, client, hcpcs_code):
+        """Fee schedule records of a code, every page of them
+        """
+
+        url1 = f'{self.base_url}?search=hcpcsCheck{hcpcs_code}&redirect=false&ACA='
+        url2 = f'{self.base_url}?search=pricing_single_{hcpcs_code}&redirect=false&ACA='
+
+        if not await self._post(client, url1, hcpcs_check_query(hcpcs_code)):
+            return []
+
+        results = []
+        query = pricing_query(hcpcs_code)
+        while True:
+            page = await self._post(client, url2, query)
+            results.extend(page)
+            if len(page) < query['limit']:
+                return results
+            query['offset'] += query['limit']
+
+    async def flush(self, force=False):
+        """Store the delta of buffered rows, then checkpoint the codes they
+            belong to
+        """
+
+        async with self._flush_lock:
+            if not self._pending_codes or (not force and len(self._rows) < self.flush_size):
+                return
+            rows, self._rows = self._rows, []
+            codes, self._pending_codes = self._pending_codes, []
+            delta = await asyncio.to_thread(store_delta, rows, codes, self.snapshot_id)
+            for counter, count in delta.items():
+                self.stats[counter] += count
+            self.checkpoint.save(codes)
+
+    async def _harvest_code(self, client, semaphore, hcpcs_code):
+        async with semaphore:
+            try:
+                datas = await self.fetch_code(client, hcpcs_code)
+            except (httpx.HTTPError, ValueError) as e:
+                logging.error('Unable to fetch %s: %s', hcpcs_code, e)
+                self.stats['failed'] += 1
+                return
+        if not datas:
+            logging.info('%s has no data available', hcpcs_code)
+            self.stats['no_data'] += 1
+        rows = fee_schedule_rows(datas, self.ts)
+        self.stats['rows'] += len(rows)
+        self._rows.extend(rows)
+        self._pending_codes.append(hcpcs_code)
+        await self.flush()
+
+    async def harvest(self, codes, skip_codes=()):
+        """Harvest the fee schedules of codes, codes in the checkpoint or
+            in skip_codes are not fetched again
+        """
+
+        self._flush_lock = asyncio.Lock()
+        skip = set(skip_codes) | self.checkpoint.done
+        todo = [code for code in dict.fromkeys(codes) if code not in skip]
+        self.stats['codes'] = len(todo)
+        self.stats['skipped'] = len(codes) - len(todo)
+        logging.info('Harvesting %s codes, skipping %s', len(todo), self.stats['skipped'])
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        limits = httpx.Limits(max_connections=self.concurrency)
+        async with httpx.AsyncClient(timeout=self.timeout, limits=limits) as client:
+            try:
+                await asyncio.gather(*(self._harvest_code(client, semaphore, code) for code in todo))
+            finally:
+                # whatever was fetched before an interruption is kept
+                await self.flush(force=True)
+
+        return self.stats
+
+def main():
+    """Harvest fee schedules for the codes in the codes file into a
+        snapshot
+    """
+
+    today = datetime.date.today().isoformat()
+    parser = argparse.ArgumentParser(description='Collect CMS fee schedules for CPT/HCPCS codes')
+    parser.add_argument('--codes-file', default=CODES_FILE)
+    parser.add_argument('--base-url', default=CMS_API_URL)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--rate', type=float, default=2, help='max requests per second')
+    parser.add_argument('--checkpoint', default='cms.checkpoint.json')
+    parser.add_argument('--flush-size', type=int, default=2000)
+    parser.add_argument('--preflight', action='store_true',
+                        help='send browser style OPTIONS requests before each POST')
+    parser.add_argument('--delta', action='store_true',
+                        help='re-fetch codes already in the table and store what changed')
+    parser.add_argument('--effective-date', default=today,
+                        help='date the fee schedule takes effect, YYYY-MM-DD')
+    parser.add_argument('--snapshot', help='snapshot label, defaults to the effective date')
+    parser.add_argument('--no-fee-matrix', action='store_true',
+                        help='do not rebuild the fee matrix once the snapshot is complete')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO) # init logging
+
+    snapshot = args.snapshot or args.effective_date
+    snapshot_id = begin_snapshot(snapshot, args.effective_date)
+    harvester = FeeScheduleHarvester(base_url=args.base_url,
+                                     concurrency=args.concurrency,
+                                     rate=args.rate,
+                                     checkpoint_file=args.checkpoint,
+                                     flush_size=args.flush_size,
+                                     preflight=args.preflight,
+                                     snapshot_id=snapshot_id,
+                                     snapshot=snapshot)
+    skip_codes = () if args.delta else get_ingested_codes()
+    stats = asyncio.run(harvester.harvest(read_codes(args.codes_file), skip_codes))
+    if stats['failed']:
+        # rerun with the same --snapshot to retry the failed codes
+        logging.warning('Snapshot %s left loading, %s codes failed', snapshot, stats['failed'])
     else:
-        print(a_code, "has no data available")
+        complete_snapshot(snapshot_id, stats)
+        if not args.no_fee_matrix:
+            build_fee_matrix()
+    print(json.dumps(stats))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+"""Code details dictionary
+    ©2024, Ovais Quraishi
+
+    Details of an ICD/CPT/HCPCS code only depend on the code and on the
+    prompt used to ask the LLM about it, so each code is described by the
+    LLM once and kept in the code_details table, keyed by
+    (code system, code, prompt version). An in-process read-through
+    cache sits in front of the table, and concurrent lookups of the same
+    code, from any thread or event loop, share a single LLM call.
+
+    Bump the code system's entry in CODE_PROMPT_VERSIONS whenever its
+    lookup prompt changes, old entries are then ignored. Details marked
+    incomplete, the LLM reply could not be read, are returned but not
+    kept, the next lookup asks again.
+"""
+
+import asyncio
+import concurrent.futures
+import json
+import logging
+import threading
+
+from config import get_config
+from database import register_query
+from database import run_query
+from database import insert_data_into_table
+from utils import ts_int_to_dt_obj
+
+CONFIG = get_config()
+
+CODE_DETAILS_PERSIST = CONFIG.getboolean('service', 'CODE_DETAILS_PERSIST', fallback=True)
+
+CODE_PROMPT_VERSIONS = {
+                        'icd': '4',
+                        'cpt': '3',
+                        'hcpcs': '3'
+                       }
+
+register_query('get_code_details',
+               """SELECT
+                        details_document
+                  FROM
+                        code_details
+                  WHERE code_system = %s
+                        AND code = %s
+                        AND prompt_version = %s;
+               """)
+
+register_query('get_many_code_details',
+               """SELECT
+                        code, details_document
+                  FROM
+                        code_details
+                  WHERE code_system = %s
+                        AND code = ANY(%s)
+                        AND prompt_version = %s;
+               """,
+               types=('text', 'text[]', 'text'))
+
+def is_incomplete(details):
+    """Details built from an LLM reply that could not be read
+    """
+
+    return isinstance(details, dict) and bool(details.get('incomplete'))
+
+class CodeDetailsDictionary:
+    """Read-through dictionary of code details
+    """
+
+    def __init__(self, persist):
+        self.persist = persist
+        self._details = {}
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._counters = {
+                          'memory_hits': 0,
+                          'db_hits': 0,
+                          'llm_lookups': 0,
+                          'shared_lookups': 0
+                         }
+
+    def _incr(self, counter):
+        with self._lock:
+            self._counters[counter] += 1
+
+    def stats(self):
+        """Lookup counters and number of codes held in memory
+        """
+
+        with self._lock:
+            return dict(self._counters, memory_entries=len(self._details))
+
+    def _db_get(self, key):
+        code_system, code, prompt_version = key
+        rows = run_query('get_code_details', (code_system, code, prompt_version))
+        return rows[0]['details_document']['details'] if rows else None
+
+    def _db_get_many(self, code_system, codes, prompt_version):
+        rows = run_query('get_many_code_details', (code_system, codes, prompt_version))
+        return {row['code']: row['details_document']['details'] for row in rows}
+
+    def _db_put(self, key, details):
+        code_system, code, prompt_version = key
+        insert_data_into_table('code_details', {
+                                                'timestamp': ts_int_to_dt_obj(),
+                                                'code_system': code_system,
+                                                'code': code,
+                                                'prompt_version': prompt_version,
+                                                'details_document': json.dumps({'details': details})
+                                               })
+
+    async def _db_load(self, key, code):
+        details = None
+        if self.persist:
+            try:
+                details = await asyncio.to_thread(self._db_get, key)
+            except Exception as e: # pylint: disable=broad-except
+                logging.error('Code details read failed for %s: %s', code, e)
+        if details is not None:
+            self._incr('db_hits')
+        return details
+
+    async def _db_load_many(self, code_system, codes, prompt_version):
+        """{code: details} of the codes the table has, one query
+        """
+
+        if not self.persist or not codes:
+            return {}
+        try:
+            found = await asyncio.to_thread(self._db_get_many, code_system, codes, prompt_version)
+        except Exception as e: # pylint: disable=broad-except
+            logging.error('Code details read failed for %s: %s', ', '.join(codes), e)
+            return {}
+        with self._lock:
+            self._counters['db_hits'] += len(found)
+        return found
+
+    async def _db_store(self, key, code, details):
+        if self.persist and not is_incomplete(details):
+            try:
+                await asyncio.to_thread(self._db_put, key, details)
+            except Exception as e: # pylint: disable=broad-except
+                logging.error('Code details write failed for %s: %s', code, e)
+
+    async def _load(self, key, code, fetch):
+        """Database first, LLM second
+        """
+
+        details = await self._db_load(key, code)
+        if details is not None:
+            return details
+
+        self._incr('llm_lookups')
+        details = await fetch(code)
+        await self._db_store(key, code, details)
+        return details
+
+    def _claim(self, key):
+        """(details, None) for a code held in memory, (None, future) of the
+            lookup already running for it, or (None, None) after making
+            the caller the owner of a new lookup
+        """
+
+        with self._lock:
+            if key in self._details:
+                self._counters['memory_hits'] += 1
+                return self._details[key], None
+            future = self._inflight.get(key)
+            if future is None:
+                self._inflight[key] = concurrent.futures.Future()
+            return None, future
+
+    def _settle(self, key, details=None, error=None):
+        """Finish an owned lookup, the waiters get details or error
+        """
+
+        with self._lock:
+            future = self._inflight.pop(key, None)
+            if error is None and not is_incomplete(details):
+                self._details[key] = details
+        if future is None:
+            # settled already, a batch that failed settles all its codes
+            return
+        if isinstance(error, asyncio.CancelledError):
+            future.cancel()
+        elif error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(details)
+
+    async def lookup(self, code_system, code, fetch):
+        """Details for a code, fetch(code) is awaited to ask the LLM when
+            the code is not known yet
+        """
+
+        key = (code_system, code, CODE_PROMPT_VERSIONS[code_system])
+        details, future = self._claim(key)
+        if details is not None:
+            return details
+        if future is not None:
+            self._incr('shared_lookups')
+            return await asyncio.wrap_future(future)
+
+        try:
+            details = await self._load(key, code, fetch)
+        except (Exception, asyncio.CancelledError) as e:
+            self._settle(key, error=e)
+            raise
+        self._settle(key, details)
+        return details
+
+    async def lookup_many(self, code_system, codes, fetch):
+        """Details for a list of codes, in order, each distinct code is
+            looked up once
+        """
+
+        unique_codes = list(dict.fromkeys(codes))
+        details = await asyncio.gather(*(self.lookup(code_system, code, fetch)
+                                         for code in unique_codes))
+        details_by_code = dict(zip(unique_codes, details))
+        return [details_by_code[code] for code in codes]
+
+    async def lookup_batched(self, code_system, codes, fetch_batch, batch_size):
+        """Details for a list of codes, in order, like lookup_many(), but
+            the codes that have to be asked for go to the LLM batch_size at
+            a time, fetch_batch(codes) is awaited for each batch and returns
+            {code: details} for every code it was given
+        """
+
+        unique_codes = list(dict.fromkeys(codes))
+        version = CODE_PROMPT_VERSIONS[code_system]
+        details_by_code = {}
+        shared = {}
+        owned = {}
+        for code in unique_codes:
+            key = (code_system, code, version)
+            details, future = self._claim(key)
+            if details is not None:
+                details_by_code[code] = details
+            elif future is not None:
+                shared[code] = future
+            else:
+                owned[code] = key
+
+        async def load_batch(batch):
+            with self._lock:
+                self._counters['llm_lookups'] += len(batch)
+            fetched = await fetch_batch(batch)
+            for code in batch:
+                await self._db_store(owned[code], code, fetched[code])
+                self._settle(owned[code], fetched[code])
+                details_by_code[code] = fetched[code]
+
+        try:
+            stored = await self._db_load_many(code_system, list(owned), version)
+            missing = []
+            for code, key in owned.items():
+                if code not in stored:
+                    missing.append(code)
+                    continue
+                self._settle(key, stored[code])
+                details_by_code[code] = stored[code]
+            batch_size = max(1, batch_size)
+            await asyncio.gather(*(load_batch(missing[offset:offset + batch_size])
+                                   for offset in range(0, len(missing), batch_size)))
+        except (Exception, asyncio.CancelledError) as e:
+            for code, key in owned.items():
+                if code not in details_by_code:
+                    self._settle(key, error=e)
+            raise
+
+        for code, future in shared.items():
+            self._incr('shared_lookups')
+            details_by_code[code] = await asyncio.wrap_future(future)
+        return [details_by_code[code] for code in codes]
+
+    def clear(self):
+        """Empty the in-process cache
+        """
+
+        with self._lock:
+            self._details.clear()
+
+CODE_DETAILS = CodeDetailsDictionary(CODE_DETAILS_PERSIST)
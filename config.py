@@ -1,10 +1,31 @@
 # config.py
 # ©2024, Ovais Quraishi
 
+"""setup.config is parsed once per process into a Config object that
+    every module shares, get_config() returns it. The file is checked
+    for changes at most every CHECK_INTERVAL seconds and parsed again
+    when its mtime changes, or on the next access after a SIGHUP once
+    reload_on_sighup() is installed.
+
+    Example:
+        CONFIG = get_config()
+        CONFIG.getlist('service', 'LLMS')
+        CONFIG.patient_data_encryption_enabled
+"""
+
 import configparser
+import logging
+import os
+import signal
+import threading
+import time
 from pathlib import Path
 
 CONFIG_FILE = 'setup.config'
+# seconds between checks of the config file's mtime
+CHECK_INTERVAL = 2
+
+_UNSET = object()
 
 def read_config(file_path):
     """Read setup config file"""
@@ -14,7 +35,154 @@ def read_config(file_path):
         return config_obj
     raise FileNotFoundError(f"Config file {file_path} not found.")
 
+class Config:
+    """Parsed setup.config that reloads itself when the file changes
+
+        Reads go to the RawConfigParser of the last successful parse, so
+        the usual get(), getint(), getboolean(), config['section'] and so
+        on all work. A reload swaps in a whole new parser, readers never
+        see a half parsed file, and a file that can't be parsed leaves the
+        previous one in place. Values changed with set() last until the
+        next reload.
+    """
+
+    def __init__(self, file_path=CONFIG_FILE, check_interval=CHECK_INTERVAL):
+        self.file_path = str(Path(file_path).resolve())
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._reload_requested = False
+        self._parser = None
+        self._mtime = None
+        self._checked = 0
+        self.reload()
+
+    def reload(self):
+        """Parse the config file again, then run the on_reload() callbacks
+        """
+
+        with self._lock:
+            mtime = os.stat(self.file_path).st_mtime_ns
+            parser = read_config(self.file_path)
+            reloaded = self._parser is not None
+            self._parser = parser
+            self._mtime = mtime
+            self._checked = time.monotonic()
+
+        if reloaded:
+            logging.info('Reloaded %s', self.file_path)
+            for callback in list(self._callbacks):
+                try:
+                    callback(self)
+                except Exception as e: # pylint: disable=broad-exception-caught
+                    logging.error('Config reload callback %s failed: %s', callback, e)
+
+    def refresh(self):
+        """Reload if the file changed or a reload was requested, the file
+            is looked at no more than every check_interval seconds
+        """
+
+        now = time.monotonic()
+        if not self._reload_requested and now - self._checked < self.check_interval:
+            return
+        self._checked = now
+        try:
+            if self._reload_requested or os.stat(self.file_path).st_mtime_ns != self._mtime:
+                self._reload_requested = False
+                self.reload()
+        except (OSError, configparser.Error) as e:
+            logging.error('Keeping the loaded config, %s: %s', self.file_path, e)
+
+    def request_reload(self):
+        """Reload on the next access, safe to call from a signal handler
+        """
+
+        self._reload_requested = True
+
+    def on_reload(self, callback):
+        """Call callback(config) after every reload
+        """
+
+        self._callbacks.append(callback)
+
+    @property
+    def parser(self):
+        """RawConfigParser of the current config
+        """
+
+        self.refresh()
+        return self._parser
+
+    def __getattr__(self, name):
+        # get(), getint(), has_option(), set() and the rest of the parser API
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.parser, name)
+
+    def __getitem__(self, section):
+        return self.parser[section]
+
+    def __contains__(self, section):
+        return section in self.parser
+
+    def getlist(self, section, option, fallback=_UNSET, separator=','):
+        """Comma separated option as a list, items are stripped and empty
+            ones dropped
+        """
+
+        if fallback is _UNSET:
+            value = self.parser.get(section, option)
+        else:
+            value = self.parser.get(section, option, fallback=None)
+            if value is None:
+                return fallback
+        return [item.strip() for item in value.split(separator) if item.strip()]
+
+    @property
+    def llms(self):
+        """[service] LLMS"""
+
+        return self.getlist('service', 'LLMS')
+
+    @property
+    def medllms(self):
+        """[service] MEDLLMS"""
+
+        return self.getlist('service', 'MEDLLMS')
+
+    @property
+    def patient_data_encryption_enabled(self):
+        """[service] PATIENT_DATA_ENCRYPTION_ENABLED"""
+
+        return self.parser.getboolean('service', 'PATIENT_DATA_ENCRYPTION_ENABLED')
+
+_CONFIG_LOCK = threading.Lock()
+_CONFIG = None
+
 def get_config():
-    """Returns the parsed configuration object"""
-    return read_config(CONFIG_FILE)
+    """Returns the process-wide configuration object, setup.config is
+        parsed on the first call
+    """
+
+    global _CONFIG # pylint: disable=global-statement
+
+    if _CONFIG is None:
+        with _CONFIG_LOCK:
+            if _CONFIG is None:
+                _CONFIG = Config()
+    return _CONFIG
+
+def reload_on_sighup():
+    """Reload the config on SIGHUP, call from the main thread of a long
+        running process
+    """
+
+    config = get_config()
+    previous = signal.getsignal(signal.SIGHUP)
+
+    def handler(signum, frame):
+        config.request_reload()
+        if callable(previous):
+            previous(signum, frame)
 
+    signal.signal(signal.SIGHUP, handler)
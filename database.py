@@ -1,111 +1,560 @@
 # database.py
 # ©2024, Ovais Quraishi
 
+import collections
+import hashlib
+import os
+import re
+import threading
+import time
+import uuid
+import weakref
+from contextlib import contextmanager
+
 import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+import psycopg2.pool
 import logging
 from config import get_config
 
-def psql_connection():
-    """Connect to PostgreSQL server"""
+# pool settings live in the [psqldb] section next to the connection
+#  settings, they are not passed on to psycopg2.connect()
+POOL_SETTINGS = {
+                 'pool_minconn': 1,
+                 'pool_maxconn': 10,
+                 # seconds a connection may sit idle before it is checked
+                 #  with SELECT 1 on checkout
+                 'pool_idle_check': 60
+                }
+# rows a server-side cursor fetches per round trip, see stream_query_rows()
+STREAM_ITERSIZE = 2000
+
+class PreparingConnection(psycopg2.extensions.connection):
+    """Connection that keeps track of the registered queries it has
+        prepared, see run_query()
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+    def deallocate_all(self):
+        """Drop every prepared statement, the next run prepares again
+        """
+
+        if self.prepared and not self.closed:
+            with self.cursor() as cur:
+                cur.execute('DEALLOCATE ALL')
+            self.commit()
+        self.prepared.clear()
+
+class ConnectionPool:
+    """Process-wide, thread-safe PostgreSQL connection pool
+
+        Wraps psycopg2's ThreadedConnectionPool, callers block until a
+        connection is free instead of getting PoolError, and connections
+        that were idle for a while are health checked before use. The pool
+        is recreated after a fork, connections can't be shared across
+        processes. The child leaves the connections it inherited alone,
+        closing one would end the parent's session on the shared socket.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pid = None
+        self._slots = None
+        # connection -> when it last went back to the pool, weakly keyed
+        #  so a closed connection's entry goes with it
+        self._last_used = weakref.WeakKeyDictionary()
+        # connections inherited from the parent process, kept so they are
+        #  never garbage collected (which closes them)
+        self._inherited = []
+        self.idle_check = POOL_SETTINGS['pool_idle_check']
+
+    def _create(self):
+        db_config = dict(get_config()['psqldb'])
+        settings = {key: int(db_config.pop(key, default)) for key, default in POOL_SETTINGS.items()}
+        self.idle_check = settings['pool_idle_check']
+        try:
+            self._pool = psycopg2.pool.ThreadedConnectionPool(settings['pool_minconn'],
+                                                              settings['pool_maxconn'],
+                                                              connection_factory=PreparingConnection,
+                                                              **db_config)
+        except psycopg2.Error as e:
+            logging.error("Error connecting to PostgreSQL: %s", e)
+            raise
+        self._slots = threading.BoundedSemaphore(settings['pool_maxconn'])
+        self._last_used = weakref.WeakKeyDictionary()
+        self._pid = os.getpid()
+
+    def _abandon(self):
+        # the parent's connections, taken out of the pool without closing
+        self._inherited.extend(self._pool._pool)
+        self._inherited.extend(self._pool._used.values())
+        self._pool._pool.clear()
+        self._pool._used.clear()
+        self._pool._rused.clear()
+        self._pool = None
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is not None and self._pid != os.getpid():
+                self._abandon()
+            if self._pool is None:
+                self._create()
+            return self._pool, self._slots
+
+    def _is_alive(self, conn):
+        last_used = self._last_used.get(conn)
+        if conn.closed:
+            return False
+        if last_used is None or time.monotonic() - last_used < self.idle_check:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    @contextmanager
+    def connection(self):
+        """Check out a connection, it goes back to the pool on exit and
+            anything left uncommitted is rolled back. A child forked while
+            the connection was checked out leaves it to the parent.
+        """
+
+        pool, slots = self._get_pool()
+        pid = os.getpid()
+        slots.acquire()
+        conn = None
+        try:
+            conn = pool.getconn()
+            if not self._is_alive(conn):
+                logging.info('Replacing stale PostgreSQL connection')
+                pool.putconn(conn, close=True)
+                conn = pool.getconn()
+            yield conn
+            if not conn.closed and os.getpid() == pid:
+                conn.rollback()
+        except Exception:
+            if conn is not None and not conn.closed and os.getpid() == pid:
+                conn.rollback()
+                # a failed transaction may have taken a PREPARE with it
+                try:
+                    conn.deallocate_all()
+                except psycopg2.Error:
+                    conn.close()
+            raise
+        finally:
+            if conn is not None and os.getpid() == pid:
+                if conn.closed:
+                    self._last_used.pop(conn, None)
+                else:
+                    self._last_used[conn] = time.monotonic()
+                pool.putconn(conn, close=bool(conn.closed))
+            slots.release()
+
+    def close(self):
+        """Close all connections
+        """
+
+        with self._lock:
+            if self._pool is not None and self._pid != os.getpid():
+                self._abandon()
+            if self._pool is not None:
+                self._pool.closeall()
+            self._pool = None
+
+DB_POOL = ConnectionPool()
+
+def db_connection():
+    """Context managed connection from the process-wide pool
+
+        Example:
+            with db_connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(sql_query)
+                conn.commit()
+    """
+
+    return DB_POOL.connection()
 
-    db_config = get_config()['psqldb']
-    try:
-        psql_conn = psycopg2.connect(**db_config)
-        psql_cur = psql_conn.cursor()
-        return psql_conn, psql_cur
-    except psycopg2.Error as e:
-        logging.error("Error connecting to PostgreSQL: %s", e)
-        raise
+# registered queries, name -> {'statement', 'params', 'types'}
+QUERIES = {}
+QUERY_PLACEHOLDER = re.compile(r'%\((\w+)\)s|%s|%%')
+
+def register_query(name, sql_query, types=None):
+    """Register a named, parameterized query, returns the name
+
+        sql_query uses psycopg2 placeholders, either all %s or all
+        %(name)s. It is turned into a server-side prepared statement the
+        first time a pooled connection runs it, and from then on only the
+        parameters are sent. types lists the Postgres type of each
+        parameter, in order, for parameters whose type Postgres can't
+        infer from the query.
+    """
+
+    names = []
+    positional = []
+
+    def placeholder(match):
+        if match.group(0) == '%%':
+            return '%'
+        if match.group(1):
+            if match.group(1) not in names:
+                names.append(match.group(1))
+            return f'${names.index(match.group(1)) + 1}'
+        positional.append(match)
+        return f'${len(positional)}'
+
+    statement = QUERY_PLACEHOLDER.sub(placeholder, sql_query).strip().rstrip(';')
+    if names and positional:
+        raise ValueError(f'Query {name} mixes %s and %(name)s placeholders')
+    query = {
+             'statement': statement,
+             'params': names or len(positional),
+             'types': tuple(types or ())
+            }
+    if QUERIES.get(name, query) != query:
+        raise ValueError(f'Query {name} is already registered with different SQL')
+    QUERIES[name] = query
+    return name
+
+def execute_prepared(cur, name, params=None):
+    """Run a registered query on a cursor of a pooled connection,
+        preparing it first if this connection hasn't yet
+    """
+
+    query = QUERIES[name]
+    conn = cur.connection
+    if name not in conn.prepared:
+        types = f" ({', '.join(query['types'])})" if query['types'] else ''
+        cur.execute(f"PREPARE {name}{types} AS {query['statement']}")
+        conn.prepared.add(name)
+
+    if isinstance(query['params'], list):
+        values = [params[param] for param in query['params']]
+    else:
+        values = list(params or ())
+        if len(values) != query['params']:
+            raise ValueError(f"Query {name} takes {query['params']} parameters, got {len(values)}")
+    if values:
+        cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(values))})", values)
+    else:
+        cur.execute(f'EXECUTE {name}')
+
+def _result_dicts(cur):
+    if not cur.description:
+        return []
+    columns = [desc[0] for desc in cur.description]
+    return [dict(zip(columns, row)) for row in cur.fetchall()]
+
+def run_query(name, params=None):
+    """Run a registered query, return all rows as list of dictionaries
+    """
+
+    with db_connection() as conn, conn.cursor() as cur:
+        try:
+            execute_prepared(cur, name, params)
+            return _result_dicts(cur)
+        except psycopg2.Error as e:
+            logging.error("%s: %s", name, e)
+            raise
+
+def run_modify_query(name, params=None):
+    """Run a registered INSERT/UPDATE/DELETE query and commit, return the
+        rows of a RETURNING clause as list of dictionaries
+    """
+
+    with db_connection() as conn, conn.cursor() as cur:
+        try:
+            execute_prepared(cur, name, params)
+            result = _result_dicts(cur)
+            conn.commit()
+            return result
+        except psycopg2.Error as e:
+            logging.error("%s: %s", name, e)
+            raise
+
+def run_modify_query_rowcount(name, params=None):
+    """Run a registered INSERT/UPDATE/DELETE query and commit, return the
+        number of rows it affected
+    """
+
+    with db_connection() as conn, conn.cursor() as cur:
+        try:
+            execute_prepared(cur, name, params)
+            rowcount = cur.rowcount
+            conn.commit()
+            return rowcount
+        except psycopg2.Error as e:
+            logging.error("%s: %s", name, e)
+            raise
 
 def execute_query(sql_query):
     """Execute a SQL query"""
 
-    conn, cur = psql_connection()
-    try:
-        cur.execute(sql_query)
-        result = cur.fetchall()
-        conn.close()
-        return result
-    except psycopg2.Error as e:
-        logging.error("%s", e)
-        raise
+    with db_connection() as conn, conn.cursor() as cur:
+        try:
+            cur.execute(sql_query)
+            result = cur.fetchall()
+            conn.commit()
+            return result
+        except psycopg2.Error as e:
+            logging.error("%s", e)
+            raise
 
 def insert_data_into_table(table_name, data):
-    """Insert data into table"""
-
-    conn, cur = psql_connection()
-    try:
-        placeholders = ', '.join(['%s'] * len(data))
-        columns = ', '.join(data.keys())
-        # Since the table keys that matter are set to UNIQUE value,
-        #   I find the ON CONFLICT DO NOTHING more effecient than
-        #   doing a lookup before INSERT. This way original content
-        #   is preserved by default. In case of updating existing
-        #   data, one can write a method to safely update data
-        #   while also preserving original data. For example use
-        #   ON CONFLICT DO UPDATE. For now this'd do.
-        sql_query = f"""INSERT INTO {table_name} ({columns}) VALUES ({placeholders}) \
-                     ON CONFLICT DO NOTHING;"""
-        cur.execute(sql_query, list(data.values()))
-        conn.commit()
-    except psycopg2.Error as e:
-        logging.error("%s", e)
-        raise
+    """Insert data into table, each table and set of columns gets its own
+        registered query
+    """
+
+    columns = ', '.join(data.keys())
+    placeholders = ', '.join(['%s'] * len(data))
+    # Since the table keys that matter are set to UNIQUE value,
+    #   I find the ON CONFLICT DO NOTHING more effecient than
+    #   doing a lookup before INSERT. This way original content
+    #   is preserved by default. In case of updating existing
+    #   data, one can write a method to safely update data
+    #   while also preserving original data. For example use
+    #   ON CONFLICT DO UPDATE. For now this'd do.
+    sql_query = f"""INSERT INTO {table_name} ({columns}) VALUES ({placeholders}) \
+                 ON CONFLICT DO NOTHING;"""
+    name = f"insert_{table_name}_{hashlib.sha1(columns.encode('utf-8')).hexdigest()[:12]}"
+    if name not in QUERIES:
+        register_query(name, sql_query)
+    run_modify_query(name, list(data.values()))
+
+def insert_many_into_table(table_name, rows, on_conflict='nothing', conflict_target=None,
+                           batch_size=1000):
+    """Insert a list of dicts into a table, batch_size rows per INSERT
+        statement and one transaction per batch
+
+        on_conflict:
+            'nothing' - ON CONFLICT DO NOTHING, same as insert_data_into_table
+            'update'  - ON CONFLICT (conflict_target) DO UPDATE the other columns
+            None      - no ON CONFLICT clause, a conflict raises
+
+        Returns a list with {'batch', 'rows', 'inserted', 'updated', 'skipped'}
+        per batch, updated rows are existing rows that on_conflict='update'
+        changed, skipped rows are conflicts that were left alone.
+    """
+
+    rows = list(rows)
+    if not rows:
+        return []
+
+    columns = list(rows[0].keys())
+    conflict_clause = ''
+    if on_conflict == 'nothing':
+        conflict_clause = 'ON CONFLICT DO NOTHING'
+    elif on_conflict == 'update':
+        if not conflict_target:
+            raise ValueError("on_conflict='update' needs a conflict_target")
+        target = [conflict_target] if isinstance(conflict_target, str) else list(conflict_target)
+        updates = ', '.join(f'{column} = EXCLUDED.{column}'
+                            for column in columns if column not in target)
+        conflict_clause = f"ON CONFLICT ({', '.join(target)}) DO UPDATE SET {updates}"
+    elif on_conflict is not None:
+        raise ValueError(f'Unknown on_conflict {on_conflict}')
+
+    # xmax is 0 for a row this statement inserted, set for one it updated
+    sql_query = f"""INSERT INTO {table_name} ({', '.join(columns)}) VALUES %s \
+                 {conflict_clause} RETURNING (xmax = 0);"""
+
+    batch_counts = []
+    with db_connection() as conn, conn.cursor() as cur:
+        for batch_number, offset in enumerate(range(0, len(rows), batch_size)):
+            batch = [[row[column] for column in columns]
+                     for row in rows[offset:offset + batch_size]]
+            try:
+                written = psycopg2.extras.execute_values(cur, sql_query, batch,
+                                                         page_size=len(batch), fetch=True)
+                conn.commit()
+            except psycopg2.Error as e:
+                logging.error("%s", e)
+                raise
+            inserted = sum(1 for (was_inserted,) in written if was_inserted)
+            batch_counts.append({
+                                 'batch': batch_number,
+                                 'rows': len(batch),
+                                 'inserted': inserted,
+                                 'updated': len(written) - inserted,
+                                 'skipped': len(batch) - len(written)
+                                })
+
+    return batch_counts
 
 def get_select_query_results(sql_query):
     """Execute a query, return all rows for the query
     """
 
-    conn, cur = psql_connection()
-    try:
-        cur.execute(sql_query)
-        result = cur.fetchall()
-        conn.close()
-        return result
-    except psycopg2.Error as e:
-        logging.error("%s", e)
-        raise
+    with db_connection() as conn, conn.cursor() as cur:
+        try:
+            cur.execute(sql_query)
+            result = cur.fetchall()
+            return result
+        except psycopg2.Error as e:
+            logging.error("%s", e)
+            raise
 
-def get_select_query_result_dicts(sql_query):
+def get_select_query_result_dicts(sql_query, params=None):
     """Execute a query, return all rows for the query as list of dictionaries"""
 
-    conn, cur = psql_connection()
-    try:
-        cur.execute(sql_query)
-        columns = [desc[0] for desc in cur.description]  # Fetch column names
-        result = [dict(zip(columns, row)) for row in cur.fetchall()]
-        conn.close()
-        return result
-    except psycopg2.Error as e:
-        logging.error("%s", e)
-        raise
+    with db_connection() as conn, conn.cursor() as cur:
+        try:
+            cur.execute(sql_query, params)
+            return _result_dicts(cur)
+        except psycopg2.Error as e:
+            logging.error("%s", e)
+            raise
+
+def _row_maker(columns, row_type):
+    if row_type == 'dict':
+        return lambda row: dict(zip(columns, row))
+    if row_type == 'tuple':
+        return lambda row: row
+    if row_type == 'namedtuple':
+        # namedtuples have __slots__ = (), no per row __dict__
+        return collections.namedtuple('Row', columns, rename=True)._make
+    raise ValueError(f'Unknown row_type {row_type}')
+
+def stream_query_rows(sql_query, params=None, itersize=STREAM_ITERSIZE, batch_size=None,
+                      row_type='dict'):
+    """Execute a query on a named server-side cursor and yield its rows,
+        itersize rows are fetched from the server at a time so memory
+        stays flat however many rows the query returns
+
+        batch_size - yield lists of up to batch_size rows instead of rows
+        row_type   - 'dict', 'tuple' or 'namedtuple'
+
+        The generator holds a pooled connection, and the transaction the
+        cursor lives in, until it is exhausted or closed.
+
+        Example:
+            for note in stream_query_rows(sql_query, row_type='namedtuple'):
+                print(note.id)
+    """
+
+    with db_connection() as conn, \
+         conn.cursor(name=f'stream_{uuid.uuid4().hex}') as cur:
+        cur.itersize = itersize
+        try:
+            cur.execute(sql_query, params)
+            rows = cur.fetchmany(batch_size or itersize)
+        except psycopg2.Error as e:
+            logging.error("%s", e)
+            raise
+        # a named cursor only has a description after the first fetch
+        make_row = _row_maker([desc[0] for desc in cur.description or ()], row_type)
+        while rows:
+            if batch_size:
+                yield [make_row(row) for row in rows]
+            else:
+                for row in rows:
+                    yield make_row(row)
+            rows = cur.fetchmany(batch_size or itersize)
+
+def execute_modify_query(sql_query, params=None):
+    """Execute an INSERT/UPDATE/DELETE query and commit, return the rows
+        of a RETURNING clause as list of dictionaries
+    """
+
+    with db_connection() as conn, conn.cursor() as cur:
+        try:
+            cur.execute(sql_query, params)
+            result = _result_dicts(cur)
+            conn.commit()
+            return result
+        except psycopg2.Error as e:
+            logging.error("%s", e)
+            raise
 
-def get_hcpcs_locality_cost(hcpcs_code, locality_designation):
-    """Get cost for a given hcpcs code and locality
+register_query('get_fee_schedule_snapshot',
+               """SELECT
+                        id, label, effective_date
+                  FROM
+                        fee_schedule_snapshots
+                  WHERE status = 'complete'
+                        AND (%(snapshot)s IS NULL OR label = %(snapshot)s)
+                  ORDER BY effective_date DESC, id DESC
+                  LIMIT 1;
+               """,
+               types=('text',))
+
+def get_fee_schedule_snapshot(snapshot=None):
+    """Get a complete fee schedule snapshot by label, the latest one when
+        snapshot is None. Before any snapshot is loaded this is a stand-in
+        with id 0, which only sees rows loaded without a snapshot.
     """
 
-    sql_query = f"""
+    snapshots = run_query('get_fee_schedule_snapshot', {'snapshot': snapshot})
+    if snapshots:
+        return snapshots[0]
+    if snapshot is not None:
+        raise ValueError(f'No complete fee schedule snapshot {snapshot}')
+    return {'id': 0, 'label': None, 'effective_date': None}
+
+# rows of cpt_hcpcs_codes that belong to snapshot %(snapshot_id)s
+FEE_SCHEDULE_SNAPSHOT_FILTER = """COALESCE(first_snapshot_id, 0) <= %(snapshot_id)s
+                                  AND (retired_snapshot_id IS NULL
+                                       OR retired_snapshot_id > %(snapshot_id)s)"""
+
+register_query('get_hcpcs_locality_cost',
+               f"""
                 SELECT
 					codes_document ->> 'sdesc' AS short_description,
-					codes_document ->> 'locality' AS mac_locality,
-					codes_document ->> 'modifier' AS modifier,
-					ROUND(CAST(codes_document ->> 'fac_price' AS numeric), 2) AS facility_price,
-					ROUND(CAST(codes_document ->> 'nfac_price' AS numeric), 2) AS non_fasility_price,
-					ROUND(CAST(codes_document ->> 'fac_limiting_charge' AS numeric), 2) AS facility_limiting_charge,
-					ROUND(CAST(codes_document ->> 'nfac_limiting_charge' AS numeric), 2) AS non_facility_limiting_charge,
-					codes_document ->> 'conv_fact' AS conv_fact
+					locality AS mac_locality,
+					modifier,
+					ROUND(fac_price, 2) AS facility_price,
+					ROUND(nfac_price, 2) AS non_fasility_price,
+					ROUND(fac_limiting_charge, 2) AS facility_limiting_charge,
+					ROUND(nfac_limiting_charge, 2) AS non_facility_limiting_charge,
+					conv_fact
                 FROM
 					cpt_hcpcs_codes
                 WHERE
-					codes_document ->> 'hcpc' = '{hcpcs_code}'
-					and codes_document ->> 'locality' = '{locality_designation}';
-                """
-    costs = get_select_query_result_dicts(sql_query)
-    
+					hcpc = %(hcpcs_code)s
+					and locality = %(locality)s
+					and {FEE_SCHEDULE_SNAPSHOT_FILTER};
+                """)
+
+def get_hcpcs_locality_cost(hcpcs_code, locality_designation, snapshot=None):
+    """Get cost for a given hcpcs code and locality, from the latest
+        fee schedule snapshot or the one labelled snapshot
+    """
+
+    params = {
+              'hcpcs_code': hcpcs_code,
+              'locality': locality_designation,
+              'snapshot_id': get_fee_schedule_snapshot(snapshot)['id']
+             }
+    costs = run_query('get_hcpcs_locality_cost', params)
+
     return costs
 
+register_query('get_pt_locality_and_codes',
+               """
+                SELECT
+                    pd.patient_id,
+                    pd.patient_locality,
+                    pci.code AS cpt_code
+                FROM
+                    public.patient_code_items pci
+                JOIN
+                    public.patient_documents pd ON pd.patient_document_id = pci.patient_document_id
+                WHERE
+                    pci.patient_document_id = %s
+                    AND pci.source = 'cpt'
+                ORDER BY pci.position;
+                """)
+
 def get_pt_locality_and_codes(patient_document_id):
-    """Get patient locality and associated codes
+    """Get patient locality and associated cpt codes
 
         Example:
             doc_id = 'aaf6b52080f87f01305a3de7f596e91354b3fec0969b0a870f560db9b11ba629667525285ab30886a51246035053e8211c7b7a75cd0d72a1ca4964785465764f'
@@ -116,86 +565,78 @@ def get_pt_locality_and_codes(patient_document_id):
                 est_costs = get_hcpcs_locality_cost(a_code, doc['locality'])
                 print (est_costs)
     """
-    
-    sql_query = f"""
-                SELECT 
-                    pd.patient_id,
-					pd.patient_locality,
-                    jsonb_array_elements_text(pc.codes_document -> 'cpt' -> 'codes') AS cpt_code
-                FROM 
-                    public.patient_documents pd
-                JOIN 
-                    public.patient_codes pc ON pd.patient_document_id = pc.patient_document_id
-                WHERE 
-                    pd.patient_document_id = '{patient_document_id}';
-                """
-    locality_codes = get_select_query_result_dicts(sql_query)
-
-    # Initialize the result dictionary
-    result_dict = {}
-
-    for item in locality_codes:
-        patient_id = item['patient_id']
-        locality = item['patient_locality']
-        cpt_code = item['cpt_code']
-    
-        # If patient_id and locality are not yet in the result dictionary, initialize them
-        if (patient_id, locality) not in result_dict:
-            result_dict[(patient_id, locality)] = {'patient_id': patient_id, 'locality': locality, 'codes': []}
-    
-        # Append cpt_code to the codes list
-        result_dict[(patient_id, locality)]['codes'].append(cpt_code)
-
-    # Get the first item from the result dictionary
-    pt_locality_codes = list(result_dict.values())[0]
 
-    return pt_locality_codes
+    locality_codes = run_query('get_pt_locality_and_codes', (patient_document_id,))
 
-def get_icd_billable_estimates(patient_id):
-    """Get billable information for icd codes for a given patient
-    """
+    # a patient document belongs to one patient at one locality, raises
+    #  IndexError when the document has no cpt codes
+    pt_locality_codes = {
+                         'patient_id': locality_codes[0]['patient_id'],
+                         'locality': locality_codes[0]['patient_locality'],
+                         'codes': [item['cpt_code'] for item in locality_codes]
+                        }
 
-    sql_query = f"""
+    return pt_locality_codes
+
+register_query('get_icd_billable_estimates',
+               """
                 SELECT
-                    pc.patient_id,
-                    icd_detail->>'code' AS code,
-                    (icd_detail->>'billable')::boolean AS billable,
-                    icd_detail->'full_data'->>'short_description' AS short_description,
-                    icd_detail->'full_data'->'billing_guidelines'->'medical_provider'->>'reimbursement_rate' AS medical_provider_reimbursement_rate,
-                    icd_detail->'full_data'->'billing_guidelines'->'insurance_company'->>'reimbursement_rate' AS insurance_company_reimbursement_rate,
+                    pci.patient_id,
+                    pci.patient_document_id,
+                    pci.code,
+                    pci.billable,
+                    pci.short_description,
+                    pci.provider_reimbursement_rate AS medical_provider_reimbursement_rate,
+                    pci.provider_reimbursement_min AS medical_provider_reimbursement_min,
+                    pci.provider_reimbursement_max AS medical_provider_reimbursement_max,
+                    pci.insurance_reimbursement_rate AS insurance_company_reimbursement_rate,
+                    pci.insurance_reimbursement_min AS insurance_company_reimbursement_min,
+                    pci.insurance_reimbursement_max AS insurance_company_reimbursement_max,
                     pd.patient_locality
                 FROM
-                    patient_codes pc
-                JOIN
-                    jsonb_array_elements(pc.codes_document->'icd'->'details') AS icd_detail ON true
+                    patient_code_items pci
                 JOIN
-                    patient_documents pd ON pc.patient_id = pd.patient_id
+                    patient_documents pd ON pd.patient_document_id = pci.patient_document_id
                 WHERE
-                    pc.codes_document ? 'icd'
-                    AND pc.patient_id = '{patient_id}';
-                 """
+                    pci.patient_id = %s
+                    AND pci.code_system = 'icd'
+                ORDER BY pci.patient_document_id, pci.position;
+                 """)
 
-    costs = get_select_query_result_dicts(sql_query)
-    return costs
-
-def get_cpt_fees(hcpcs_code, mac_locality):
-    """Get locality based fee schedule for a given hcpcs code
+def get_icd_billable_estimates(patient_id):
+    """Get billable information for icd codes for a given patient
     """
 
-    sql_query = f"""
+    costs = run_query('get_icd_billable_estimates', (patient_id,))
+    return costs
+
+register_query('get_cpt_fees',
+               f"""
                     SELECT
                         codes_document ->> 'sdesc' AS short_description,
-                        codes_document ->> 'locality' AS mac_locality,
-                        codes_document ->> 'modifier' AS modifier,
-                        codes_document ->> 'fac_price' AS facility_price,
-                        codes_document ->> 'nfac_price' AS non_fasility_price,
-                        codes_document ->> 'fac_limiting_charge' AS facility_limiting_charge,
-                        codes_document ->> 'nfac_limiting_charge' AS non_facility_limiting_charge,
-                        codes_document ->> 'conv_fact' AS conv_fact
+                        locality AS mac_locality,
+                        modifier,
+                        fac_price AS facility_price,
+                        nfac_price AS non_fasility_price,
+                        fac_limiting_charge AS facility_limiting_charge,
+                        nfac_limiting_charge AS non_facility_limiting_charge,
+                        conv_fact
                     FROM
                         cpt_hcpcs_codes
                     WHERE
-                        codes_document ->> 'hcpc' = '{hcpcs_code}'
-                        AND codes_document ->> 'locality' = '{mac_locality}';
-                 """
-    pass
+                        hcpc = %(hcpcs_code)s
+                        AND locality = %(locality)s
+                        AND {FEE_SCHEDULE_SNAPSHOT_FILTER};
+                 """)
+
+def get_cpt_fees(hcpcs_code, mac_locality, snapshot=None):
+    """Get locality based fee schedule for a given hcpcs code, from the
+        latest fee schedule snapshot or the one labelled snapshot
+    """
+
+    params = {
+              'hcpcs_code': hcpcs_code,
+              'locality': mac_locality,
+              'snapshot_id': get_fee_schedule_snapshot(snapshot)['id']
+             }
+    return run_query('get_cpt_fees', params)
@@ -1,15 +1,32 @@
 # encryption.py
 # ©2024, Ovais Quraishi
 
-"""This module provides functions for encrypting and decrypting 
+"""This module provides functions for encrypting and decrypting
     text using the Fernet cryptography library.
+
+    The key file is read once and the cipher is cached for the life of
+    the process, call reload_key() after the key file changes. A config
+    reload drops the cached cipher, ENCRYPTION_KEY may name another file.
+    encrypt_many() and decrypt_many() spread large batches over a thread
+    pool.
 """
 
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 from cryptography.fernet import Fernet
 from config import get_config
 
 CONFIG = get_config()
 
+# batches smaller than this are done in the calling thread
+PARALLEL_MIN_ITEMS = 256
+BATCH_WORKERS = min(8, os.cpu_count() or 1)
+
+_CIPHER_LOCK = threading.Lock()
+_CIPHER = None
+
 def load_key():
     """Loads a key used to encrypt and decrypt text.
     """
@@ -19,22 +36,85 @@ def load_key():
         key = key_file.read()
     return key
 
+def get_cipher():
+    """Cached Fernet cipher for the loaded key, the key file is only read
+        on first use and by reload_key()
+    """
+
+    global _CIPHER # pylint: disable=global-statement
+
+    cipher = _CIPHER
+    if cipher is None:
+        with _CIPHER_LOCK:
+            if _CIPHER is None:
+                _CIPHER = Fernet(load_key())
+            cipher = _CIPHER
+    return cipher
+
+def reload_key():
+    """Read the key file again and replace the cached cipher
+    """
+
+    global _CIPHER # pylint: disable=global-statement
+
+    cipher = Fernet(load_key())
+    with _CIPHER_LOCK:
+        _CIPHER = cipher
+    return cipher
+
+def _forget_cipher(_config):
+    global _CIPHER # pylint: disable=global-statement
+
+    with _CIPHER_LOCK:
+        _CIPHER = None
+
+CONFIG.on_reload(_forget_cipher)
+
 def encrypt_text(text):
     """Encrypts a piece of text using the loaded key.
     """
 
-    key = load_key()
-    cipher_suite = Fernet(key)
     encoded_text = text.encode()
-    encrypted_text = cipher_suite.encrypt(encoded_text)
+    encrypted_text = get_cipher().encrypt(encoded_text)
     return encrypted_text
 
 def decrypt_text(encrypted_text):
     """Decrypts a piece of encrypted text using the loaded key.
     """
 
-    key = load_key()
-    cipher_suite = Fernet(key)
-    decrypted_text = cipher_suite.decrypt(encrypted_text)
+    decrypted_text = get_cipher().decrypt(encrypted_text)
     decoded_text = decrypted_text.decode()
     return decoded_text
+
+def _map_batch(func, items, workers):
+    items = list(items)
+    if workers is None:
+        workers = BATCH_WORKERS if len(items) >= PARALLEL_MIN_ITEMS else 1
+    if workers <= 1 or len(items) < 2:
+        return [func(item) for item in items]
+
+    # one slice per worker, so the pool isn't handed a task per item
+    size = -(-len(items) // workers)
+    slices = [items[offset:offset + size] for offset in range(0, len(items), size)]
+    with ThreadPoolExecutor(max_workers=len(slices),
+                            thread_name_prefix='encryption') as executor:
+        results = executor.map(lambda a_slice: [func(item) for item in a_slice], slices)
+        return [result for a_slice in results for result in a_slice]
+
+def encrypt_many(texts, workers=None):
+    """Encrypts a list of texts, in order, with the loaded key. Batches of
+        PARALLEL_MIN_ITEMS or more are split over BATCH_WORKERS threads
+        unless workers says otherwise, workers=1 stays in this thread.
+    """
+
+    cipher = get_cipher()
+    return _map_batch(lambda text: cipher.encrypt(text.encode()), texts, workers)
+
+def decrypt_many(encrypted_texts, workers=None):
+    """Decrypts a list of encrypted texts, in order, with the loaded key,
+        threads are used as in encrypt_many()
+    """
+
+    cipher = get_cipher()
+    return _map_batch(lambda encrypted_text: cipher.decrypt(encrypted_text).decode(),
+                      encrypted_texts, workers)
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""Fee schedule price matrix
+    ©2024, Ovais Quraishi
+
+    Prices of every code in a fee schedule snapshot, precomputed into a
+    NumPy array of codes x localities x modifiers x PRICE_COLUMNS and
+    saved as a .npy file next to a JSON index of the axis labels. Every
+    process maps the file read-only, so gunicorn workers share a single
+    copy through the page cache, and pricing a claim is one fancy-indexed
+    lookup instead of a cpt_hcpcs_codes query per code and locality.
+
+    cms.py rebuilds the matrix after each snapshot it completes. The
+    index is replaced last, processes pick up a rebuilt matrix on their
+    next lookup and keep the one they have mapped until then.
+
+    Rebuild by hand, for the latest or a given snapshot:
+        > python feematrix.py
+        > python feematrix.py --snapshot 2024Q1
+
+    Example:
+        FEE_MATRIX.price_claim(['99213', '99214'], '0111205')
+"""
+
+import argparse
+import glob
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+from config import get_config
+from database import FEE_SCHEDULE_SNAPSHOT_FILTER
+from database import get_fee_schedule_snapshot
+from database import register_query
+from database import run_query
+from utils import serialize_datetime
+from utils import ts_int_to_dt_obj
+
+PRICE_COLUMNS = ('fac_price', 'nfac_price', 'fac_limiting_charge', 'nfac_limiting_charge')
+INDEX_FILE = 'index.json'
+
+def fee_matrix_path():
+    """Directory the matrix lives in, FEE_MATRIX_PATH in setup.config
+    """
+
+    return get_config().get('service', 'FEE_MATRIX_PATH', fallback='fee_matrix')
+
+register_query('get_snapshot_prices',
+               f"""SELECT
+                        hcpc,
+                        locality,
+                        modifier,
+                        codes_document ->> 'sdesc' AS sdesc,
+                        fac_price,
+                        nfac_price,
+                        fac_limiting_charge,
+                        nfac_limiting_charge
+                  FROM
+                        cpt_hcpcs_codes
+                  WHERE {FEE_SCHEDULE_SNAPSHOT_FILTER}
+                  ORDER BY id;
+               """)
+
+def get_snapshot_prices(snapshot_id):
+    """Price rows of every code in a fee schedule snapshot
+    """
+
+    return run_query('get_snapshot_prices', {'snapshot_id': snapshot_id})
+
+def build_matrix(rows):
+    """Price array and axis labels for price rows, prices that are
+        missing are NaN. When a code, locality and modifier show up more
+        than once the last row wins.
+    """
+
+    codes = sorted({row['hcpc'] for row in rows})
+    localities = sorted({row['locality'] for row in rows})
+    modifiers = sorted({row['modifier'] or '' for row in rows})
+    code_idx = {code: i for i, code in enumerate(codes)}
+    locality_idx = {locality: i for i, locality in enumerate(localities)}
+    modifier_idx = {modifier: i for i, modifier in enumerate(modifiers)}
+
+    prices = np.full((len(codes), len(localities), len(modifiers), len(PRICE_COLUMNS)),
+                     np.nan, dtype=np.float64)
+    short_descriptions = [''] * len(codes)
+    for row in rows:
+        i = code_idx[row['hcpc']]
+        prices[i, locality_idx[row['locality']], modifier_idx[row['modifier'] or '']] = [
+            np.nan if row[column] is None else float(row[column]) for column in PRICE_COLUMNS]
+        short_descriptions[i] = row.get('sdesc') or short_descriptions[i]
+
+    index = {
+             'columns': list(PRICE_COLUMNS),
+             'codes': codes,
+             'localities': localities,
+             'modifiers': modifiers,
+             'short_descriptions': short_descriptions
+            }
+    return prices, index
+
+def write_matrix(path, prices, index):
+    """Write a price array and its index into path, the .npy file gets a
+        new name each build and the index is replaced last, so a reader
+        never sees a half written matrix
+    """
+
+    os.makedirs(path, exist_ok=True)
+    prices_file = f"prices-{index.get('snapshot_id') or 0}-{time.time_ns()}.npy"
+    tmp_path = os.path.join(path, f'{prices_file}.tmp')
+    with open(tmp_path, 'wb') as afile:
+        np.save(afile, prices)
+    os.replace(tmp_path, os.path.join(path, prices_file))
+
+    index = dict(index, prices_file=prices_file, shape=list(prices.shape))
+    tmp_path = os.path.join(path, f'{INDEX_FILE}.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as afile:
+        json.dump(index, afile)
+    os.replace(tmp_path, os.path.join(path, INDEX_FILE))
+
+    # processes that still map an older file keep reading it after unlink
+    for old_file in glob.glob(os.path.join(path, 'prices-*.npy')):
+        if os.path.basename(old_file) != prices_file:
+            os.remove(old_file)
+    return index
+
+def build_fee_matrix(snapshot=None, path=None):
+    """Rebuild the matrix from the latest complete fee schedule snapshot
+        or the one labelled snapshot, returns its index without the axes
+    """
+
+    started = time.monotonic()
+    snapshot_row = get_fee_schedule_snapshot(snapshot)
+    prices, index = build_matrix(get_snapshot_prices(snapshot_row['id']))
+    index.update({
+                  'snapshot': snapshot_row['label'],
+                  'snapshot_id': snapshot_row['id'],
+                  'effective_date': snapshot_row['effective_date'].isoformat()
+                                    if snapshot_row['effective_date'] else None,
+                  'built': serialize_datetime(ts_int_to_dt_obj())
+                 })
+    index = write_matrix(path or fee_matrix_path(), prices, index)
+    logging.info('Built %s fee matrix for snapshot %s in %.2fs',
+                 'x'.join(str(n) for n in prices.shape), index['snapshot'],
+                 time.monotonic() - started)
+    return {key: value for key, value in index.items()
+            if key not in ('codes', 'localities', 'modifiers', 'short_descriptions')}
+
+class FeeMatrix:
+    """Read-only, memory-mapped view of the fee matrix, loaded on first
+        use and reloaded when the index file is replaced
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._index_version = None
+        # index, prices and the label -> position dicts, swapped as one
+        self._matrix = None
+
+    def _load(self):
+        if self.path is None:
+            self.path = fee_matrix_path()
+        path = self.path
+        index_file = os.path.join(path, INDEX_FILE)
+        # the index is replaced, not rewritten, so a rebuild changes its inode
+        stat = os.stat(index_file)
+        version = (stat.st_ino, stat.st_mtime_ns)
+        with self._lock:
+            if version != self._index_version:
+                with open(index_file, encoding='utf-8') as afile:
+                    index = json.load(afile)
+                prices = np.load(os.path.join(path, index['prices_file']), mmap_mode='r')
+                self._matrix = {
+                                'index': index,
+                                'prices': prices,
+                                'codes': {code: i for i, code in enumerate(index['codes'])},
+                                'localities': {locality: i for i, locality
+                                               in enumerate(index['localities'])},
+                                'modifiers': {modifier: i for i, modifier
+                                              in enumerate(index['modifiers'])}
+                               }
+                self._index_version = version
+                logging.info('Loaded fee matrix for snapshot %s', index.get('snapshot'))
+            return self._matrix
+
+    @property
+    def snapshot(self):
+        """Label of the snapshot the matrix was built from
+        """
+
+        return self._load()['index'].get('snapshot')
+
+    @staticmethod
+    def _positions(labels, values):
+        return np.array([labels.get(value, -1) for value in values], dtype=np.intp)
+
+    def _lookup(self, matrix, codes, localities, modifiers):
+        if isinstance(localities, str):
+            localities = [localities] * len(codes)
+        if modifiers is None or isinstance(modifiers, str):
+            modifiers = [modifiers] * len(codes)
+        code_idx = self._positions(matrix['codes'], codes)
+        locality_idx = self._positions(matrix['localities'], localities)
+        modifier_idx = self._positions(matrix['modifiers'],
+                                       [modifier or '' for modifier in modifiers])
+        known = (code_idx >= 0) & (locality_idx >= 0) & (modifier_idx >= 0)
+
+        result = np.full((len(codes), len(PRICE_COLUMNS)), np.nan, dtype=np.float64)
+        result[known] = matrix['prices'][code_idx[known], locality_idx[known], modifier_idx[known]]
+        return result
+
+    def lookup(self, codes, localities, modifiers=''):
+        """Prices for each code, locality and modifier, as an array of
+            len(codes) x PRICE_COLUMNS. localities and modifiers are either
+            one value for all codes or one per code. Unknown codes,
+            localities and modifiers are priced NaN.
+        """
+
+        return self._lookup(self._load(), list(codes), localities, modifiers)
+
+    def price_claim(self, codes, locality, modifiers=''):
+        """Price every line of a claim at one locality, with per column
+            totals over the lines that could be priced
+        """
+
+        matrix = self._load()
+        codes = list(codes)
+        result = self._lookup(matrix, codes, locality, modifiers)
+        priced = ~np.isnan(result).all(axis=1)
+        totals = np.nansum(result[priced], axis=0)
+
+        short_descriptions = matrix['index']['short_descriptions']
+        lines = []
+        for code, row, is_priced in zip(codes, result.tolist(), priced.tolist()):
+            code_i = matrix['codes'].get(code)
+            line = {
+                    'code': code,
+                    'short_description': None if code_i is None else short_descriptions[code_i],
+                    'priced': is_priced
+                   }
+            line.update({column: None if np.isnan(price) else round(price, 2)
+                         for column, price in zip(PRICE_COLUMNS, row)})
+            lines.append(line)
+
+        return {
+                'snapshot': matrix['index'].get('snapshot'),
+                'locality': locality,
+                'lines': lines,
+                'totals': {column: round(float(total), 2)
+                           for column, total in zip(PRICE_COLUMNS, totals)},
+                'unpriced': [line['code'] for line in lines if not line['priced']]
+               }
+
+FEE_MATRIX = FeeMatrix()
+
+def main():
+    """Rebuild the fee matrix
+    """
+
+    parser = argparse.ArgumentParser(description='Build the fee schedule price matrix')
+    parser.add_argument('--snapshot', help='snapshot label, defaults to the latest complete one')
+    parser.add_argument('--path', help='matrix directory, defaults to FEE_MATRIX_PATH')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO) # init logging
+
+    print(json.dumps(build_fee_matrix(args.snapshot, args.path)))
+
+if __name__ == '__main__':
+    main()
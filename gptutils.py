@@ -1,78 +1,587 @@
 #!/usr/bin/env python3
 """Ollama-GPT module
     ©2024, Ovais Quraishi
+
+    Prompts are spread over the Ollama hosts in setup.config by
+    OLLAMA_ROUTER, see ollamarouter.py. preload_models(), resident_models(),
+    pin_model() and unpin_model() manage which models the hosts keep
+    loaded.
 """
 
+import asyncio
+import atexit
 import hashlib
 import logging
+import threading
+import time
+import weakref
 import httpx
 import sys
 
 from ollama import AsyncClient
+from ollama import ResponseError
 
 from config import get_config
 from encryption import encrypt_text
+from llmcache import LLM_CACHE
+from llmcache import LLM_CACHE_ENABLED
+from llmcache import cache_key
 from utils import ts_int_to_dt_obj
-from utils import sanitize_string
-from utils import check_endpoint_health
+from normalize import BOILERPLATE_PHRASES
+from normalize import strip_boilerplate
+from ollamarouter import NoEndpointError
+from ollamarouter import OllamaRouter
+from ollamarouter import endpoints_from_config
 
 CONFIG = get_config()
 
+# keep-alive connection pool settings, per event loop
+OLLAMA_POOL_MAX_CONNECTIONS = CONFIG.getint('service', 'OLLAMA_POOL_MAX_CONNECTIONS', fallback=16)
+OLLAMA_POOL_MAX_KEEPALIVE = CONFIG.getint('service', 'OLLAMA_POOL_MAX_KEEPALIVE', fallback=8)
+OLLAMA_POOL_KEEPALIVE_EXPIRY = CONFIG.getfloat('service', 'OLLAMA_POOL_KEEPALIVE_EXPIRY', fallback=300)
+# seconds a health check result is trusted for
+OLLAMA_HEALTH_CHECK_TTL = CONFIG.getfloat('service', 'OLLAMA_HEALTH_CHECK_TTL', fallback=30)
+# seconds a host that failed is left out, doubled per failure in a row
+OLLAMA_ENDPOINT_COOLDOWN = CONFIG.getfloat('service', 'OLLAMA_ENDPOINT_COOLDOWN', fallback=5)
+OLLAMA_ENDPOINT_MAX_COOLDOWN = CONFIG.getfloat('service', 'OLLAMA_ENDPOINT_MAX_COOLDOWN', fallback=300)
+# seconds Ollama keeps a model loaded after its last prompt
+OLLAMA_KEEP_ALIVE = CONFIG.getfloat('service', 'OLLAMA_KEEP_ALIVE', fallback=300)
+# models Ollama keeps loaded for good
+OLLAMA_PINNED_MODELS = CONFIG.getlist('service', 'OLLAMA_PINNED_MODELS', fallback=[])
+# a model load that takes longer than this is counted as a load event
+OLLAMA_LOAD_EVENT_SECONDS = CONFIG.getfloat('service', 'OLLAMA_LOAD_EVENT_SECONDS', fallback=0.5)
+# output format sent with prompts that expect JSON, see json_format()
+LLM_JSON_FORMAT = CONFIG.get('service', 'LLM_JSON_FORMAT', fallback='json')
+
+class OllamaClientManager:
+    """Process-wide manager of pooled, keep-alive Ollama clients
+
+        httpx connections are bound to the event loop that opened them, so
+        the manager keeps one AsyncClient per event loop, each with its own
+        bounded pool of keep-alive connections. It also owns a long-lived
+        background event loop that sync callers (gunicorn threads) can
+        submit coroutines to with run(), so connections are reused across
+        requests instead of dying with a short-lived asyncio.run() loop.
+        Clients are per host too, host defaults to the first one.
+    """
+
+    def __init__(self, host, max_connections, max_keepalive, keepalive_expiry):
+        self.host = host
+        self.limits = httpx.Limits(max_connections=max_connections,
+                                   max_keepalive_connections=max_keepalive,
+                                   keepalive_expiry=keepalive_expiry)
+        self._lock = threading.Lock()
+        self._clients = weakref.WeakKeyDictionary()
+        self._loop = None
+        self._loop_thread = None
+
+    def get_client(self, host=None):
+        """AsyncClient for host and the running event loop
+        """
+
+        host = host or self.host
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            clients = self._clients.setdefault(loop, {})
+            client = clients.get(host)
+            if client is None:
+                client = AsyncClient(host=host, limits=self.limits)
+                clients[host] = client
+        return client
+
+    def run(self, coro):
+        """Run a coroutine on the shared background loop, block until done
+        """
+
+        with self._lock:
+            if self._loop is None or self._loop.is_closed():
+                self._loop = asyncio.new_event_loop()
+                self._loop_thread = threading.Thread(target=self._loop.run_forever,
+                                                     name='ollama-client-loop',
+                                                     daemon=True)
+                self._loop_thread.start()
+            loop = self._loop
+            if threading.current_thread() is self._loop_thread:
+                coro.close()
+                raise RuntimeError('run() called from the client loop, await the coroutine instead')
+        return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+    async def aclose(self):
+        """Close the clients that belong to the running event loop
+        """
+
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            clients = self._clients.pop(loop, {})
+        for client in clients.values():
+            # ollama.AsyncClient does not expose close(), the httpx client does
+            await client._client.aclose()
+
+    def shutdown(self):
+        """Close all pooled connections and stop the background loop
+        """
+
+        with self._lock:
+            loop, self._loop = self._loop, None
+            thread, self._loop_thread = self._loop_thread, None
+        if loop is not None and not loop.is_closed():
+            asyncio.run_coroutine_threadsafe(self.aclose(), loop).result()
+            asyncio.run_coroutine_threadsafe(loop.shutdown_asyncgens(), loop).result()
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+        with self._lock:
+            self._clients.clear()
+
+OLLAMA_ROUTER = OllamaRouter(endpoints_from_config(CONFIG,
+                                                   CONFIG.get('service', 'OLLAMA_API_URL'),
+                                                   OLLAMA_POOL_MAX_CONNECTIONS),
+                             keep_alive=OLLAMA_KEEP_ALIVE,
+                             cooldown=OLLAMA_ENDPOINT_COOLDOWN,
+                             max_cooldown=OLLAMA_ENDPOINT_MAX_COOLDOWN,
+                             health_check_ttl=OLLAMA_HEALTH_CHECK_TTL,
+                             load_threshold=OLLAMA_LOAD_EVENT_SECONDS,
+                             pinned=OLLAMA_PINNED_MODELS)
+OLLAMA_CLIENTS = OllamaClientManager(OLLAMA_ROUTER.endpoints[0].url,
+                                     OLLAMA_POOL_MAX_CONNECTIONS,
+                                     OLLAMA_POOL_MAX_KEEPALIVE,
+                                     OLLAMA_POOL_KEEPALIVE_EXPIRY)
+atexit.register(OLLAMA_CLIENTS.shutdown)
+
+def run_sync(coro):
+    """Run a prompt coroutine from sync code on the shared client loop
+    """
+
+    return OLLAMA_CLIENTS.run(coro)
+
+def schema_unsupported(url, error):
+    """The server at url turned a schema format down, send 'json' instead
+    """
+
+    global LLM_JSON_FORMAT # pylint: disable=global-statement
+
+    if LLM_JSON_FORMAT == 'schema':
+        logging.warning('Ollama at %s does not take a JSON schema format (%s), '
+                        'sending json instead', url, error)
+        LLM_JSON_FORMAT = 'json'
+
+def json_format(schema):
+    """Chat format for a prompt whose reply should match a JSON schema,
+        by LLM_JSON_FORMAT:
+            schema - the schema itself, constrained output (Ollama 0.5+)
+            json   - any JSON object, the default
+            none   - no format, the prompt alone asks for JSON
+        A server that turns a schema down gets 'json' from then on, see
+        prompt_chat().
+    """
+
+    if LLM_JSON_FORMAT == 'schema':
+        return schema
+    if LLM_JSON_FORMAT == 'json':
+        return 'json'
+    return None
+
 async def prompt_chat(llm,
                       content,
-                      encrypt_analysis=CONFIG.getboolean('service',
-                                                         'PATIENT_DATA_ENCRYPTION_ENABLED')
+                      encrypt_analysis=CONFIG.patient_data_encryption_enabled,
+                      use_cache=True,
+                      stream=False,
+                      stop_when=None,
+                      output_format=None
                      ):
     """Llama Chat Prompting and response
+
+        With LLM_CACHE_ENABLED set, replies are served from and stored in
+        the LLM response cache (see llmcache.py), use_cache=False bypasses
+        the cache for this call.
+
+        With stream=True the reply is consumed chunk by chunk, see
+        prompt_chat_stream. stop_when needs stream=True, ValueError
+        otherwise.
+
+        output_format is sent to Ollama as the chat format, 'json' or a
+        JSON schema the reply must match, see json_format(). A server too
+        old for schemas answers with an error, the prompt is sent again
+        with 'json' and so are later ones.
+
+        The prompt goes to the host OLLAMA_ROUTER picks for llm, a host
+        that can't be reached is left out and the next one is tried. The
+        host is told to keep llm loaded for OLLAMA_KEEP_ALIVE seconds, or
+        for good when llm is pinned.
     """
 
-    ollama_server = CONFIG.get('service','OLLAMA_API_URL')
+    if stop_when is not None and not stream:
+        raise ValueError('stop_when needs stream=True')
 
-    if not check_endpoint_health(ollama_server):
-       logging.error('Ollama Server %s is not available', ollama_server)
-       return False
+    options = {
+               'temperature' : 0
+              }
+    chat_args = {'format': output_format} if output_format else {}
 
     dt = ts_int_to_dt_obj()
-    client = AsyncClient(host=ollama_server)
+
+    key = None
+    if use_cache and LLM_CACHE_ENABLED:
+        # an early stop changes the reply, so it is part of the key
+        key_options = dict(options, **chat_args)
+        if stop_when is not None:
+            key_options['stop_when'] = getattr(stop_when, '__name__', repr(stop_when))
+        key = cache_key(llm, key_options, content)
+        cached = await asyncio.to_thread(LLM_CACHE.get, key)
+        if cached is not None:
+            logging.info('Cache hit for %s', llm)
+            return analyzed_object(dt, cached['shasum_512'], cached['analysis'], encrypt_analysis)
+
     logging.info('Running for %s', llm)
+    messages = [
+                {
+                 'role': 'user',
+                 'content': content
+                },
+               ]
+    while True:
+        try:
+            endpoint = await OLLAMA_ROUTER.acquire(llm)
+        except NoEndpointError as e:
+            logging.error('Ollama Server is not available: %s', e)
+            return False
+
+        client = OLLAMA_CLIENTS.get_client(endpoint.url)
+        send_args = dict(chat_args, keep_alive=OLLAMA_ROUTER.keep_alive_for(llm))
+        try:
+            if stream:
+                response = {}
+                analysis, analysis_sha512 = await stream_chat(client, llm, messages, options,
+                                                              stop_when, send_args, response)
+            else:
+                response = await client.chat(
+                                                model=llm,
+                                                stream=False,
+                                                messages=messages,
+                                                options = options,
+                                                **send_args
+                                            )
+
+                # chatgpt analysis
+                analysis = response['message']['content']
+                analysis = strip_boilerplate(analysis)
+
+                # this is for the analysis text only - the idea is to avoid
+                #  duplicate text document, to allow indexing the column so
+                #  to speed up search/lookups
+                analysis_sha512 = hashlib.sha512(str.encode(analysis)).hexdigest()
+        except (httpx.ReadError, httpx.ConnectError, httpx.RemoteProtocolError) as e:
+            OLLAMA_ROUTER.release(endpoint, ok=False)
+            logging.error('Error: %s', e.args[0])
+            logging.error('Unable to reach Ollama Server: %s', endpoint.url)
+            continue
+        except ResponseError as e:
+            OLLAMA_ROUTER.release(endpoint)
+            if e.status_code != 400 or not isinstance(chat_args.get('format'), dict):
+                raise
+            schema_unsupported(endpoint.url, e)
+            chat_args['format'] = 'json'
+            continue
+        except BaseException:
+            OLLAMA_ROUTER.release(endpoint)
+            raise
+        OLLAMA_ROUTER.release(endpoint, llm, ok=True)
+        record_model_load(endpoint, llm, response)
+        break
+
+    if key is not None:
+        await asyncio.to_thread(LLM_CACHE.put, key, llm, {
+                                                          'shasum_512': analysis_sha512,
+                                                          'analysis': analysis
+                                                         })
+
+    return analyzed_object(dt, analysis_sha512, analysis, encrypt_analysis)
+
+async def prompt_chat_stream(llm,
+                             content,
+                             encrypt_analysis=CONFIG.patient_data_encryption_enabled,
+                             use_cache=True,
+                             stop_when=None,
+                             output_format=None
+                            ):
+    """Streaming variant of prompt_chat, same result object
+
+        Chunks are sanitized and hashed as they arrive. stop_when is called
+        with every chunk, when it returns an offset into the chunk the reply
+        is cut there and generation is cancelled, e.g. json_object_closed()
+        for prompts that only need a JSON object.
+    """
+
+    return await prompt_chat(llm, content, encrypt_analysis, use_cache,
+                             stream=True, stop_when=stop_when, output_format=output_format)
+
+async def stream_chat(client, llm, messages, options, stop_when=None, chat_args=None,
+                      final_chunk=None):
+    """Consume a streamed chat reply, returns (analysis, sha512 hexdigest).
+        The last chunk, with Ollama's timings, is copied into final_chunk
+        when the reply is read to the end.
+    """
+
+    sanitizer = StreamSanitizer()
+    hasher = hashlib.sha512()
+    parts = []
+
+    def take(text):
+        hasher.update(str.encode(text))
+        parts.append(text)
+
+    chunks = await client.chat(model=llm, stream=True, messages=messages, options=options,
+                               **(chat_args or {}))
     try:
-        response = await client.chat(
-                                        model=llm,
-                                        stream=False,
-                                        messages=[
-                                                  {
-                                                   'role': 'user',
-                                                   'content': content
-                                                  },
-                                                 ],
-                                        options = {
-                                                    'temperature' : 0
-                                                  }
-                                    )
-
-        # chatgpt analysis
-        analysis = response['message']['content']
-        analysis = sanitize_string(analysis)
-
-        # this is for the analysis text only - the idea is to avoid
-        #  duplicate text document, to allow indexing the column so
-        #  to speed up search/lookups
-        analysis_sha512 = hashlib.sha512(str.encode(analysis)).hexdigest()
-
-        # see encryption.py module
-        # encrypt text *** make sure that encryption key file is secure! ***
-
-        if encrypt_analysis:
-            analysis = encrypt_text(analysis).decode('utf-8')
-
-        analyzed_obj = {
-                        'timestamp' : dt,
-                        'shasum_512' : analysis_sha512,
-                        'analysis' : analysis
-                        }
-
-        return analyzed_obj
-    except (httpx.ReadError, httpx.ConnectError, httpx.RemoteProtocolError) as e:
-        logging.error('Error: %s', e.args[0])
-        logging.error('Unable to reach Ollama Server: %s', CONFIG.get('service','OLLAMA_API_URL'))
+        async for chunk in chunks:
+            if chunk.get('done') and final_chunk is not None:
+                final_chunk.update(chunk)
+            text = chunk['message']['content']
+            end = stop_when(text) if stop_when is not None else None
+            if end is not None:
+                take(sanitizer.feed(text[:end]))
+                logging.info('Stopped %s early', llm)
+                break
+            take(sanitizer.feed(text))
+    finally:
+        # closing the stream closes the response, which makes ollama
+        #  cancel the generation
+        await chunks.aclose()
+
+    take(sanitizer.flush())
+    return ''.join(parts), hasher.hexdigest()
+
+def record_model_load(endpoint, llm, response, seconds=None):
+    """Count the model load a reply reports in load_duration (nanoseconds),
+        or that took seconds when the reply has none
+    """
+
+    if response and response.get('load_duration') is not None:
+        seconds = response['load_duration'] / 1e9
+    if seconds is not None and OLLAMA_ROUTER.record_load(endpoint, llm, seconds):
+        logging.info('Loaded %s on %s in %.1fs', llm, endpoint.url, seconds)
+
+async def _preload(endpoint, model, keep_alive):
+    client = OLLAMA_CLIENTS.get_client(endpoint.url)
+    started = time.monotonic()
+    try:
+        # a generate request without a prompt only loads, or with
+        #  keep_alive 0 unloads, the model
+        response = await client.generate(model=model, keep_alive=keep_alive)
+    except (httpx.HTTPError, ResponseError) as e:
+        logging.error('Unable to load %s on %s: %s', model, endpoint.url, e)
         return False
+    if keep_alive == 0:
+        OLLAMA_ROUTER.mark_unloaded(endpoint, model)
+    else:
+        record_model_load(endpoint, model, None, time.monotonic() - started)
+        OLLAMA_ROUTER.mark_loaded(endpoint, model)
+    return True
+
+async def preload_models(models, keep_alive=None):
+    """Load models on every host that serves them, a host loads them one
+        at a time. keep_alive defaults to each model's usual one, see
+        OllamaRouter.keep_alive_for(). Returns {host name: {model: loaded}}
+    """
+
+    async def preload_endpoint(endpoint):
+        loaded = {}
+        for model in models:
+            if endpoint.serves(model) and endpoint.is_up(time.monotonic()):
+                loaded[model] = await _preload(endpoint, model,
+                                               OLLAMA_ROUTER.keep_alive_for(model)
+                                               if keep_alive is None else keep_alive)
+        return loaded
+
+    results = await asyncio.gather(*(preload_endpoint(endpoint)
+                                     for endpoint in OLLAMA_ROUTER.endpoints))
+    return {endpoint.name: loaded for endpoint, loaded in zip(OLLAMA_ROUTER.endpoints, results)}
+
+async def resident_models():
+    """Models each host has loaded, as Ollama reports them (/api/ps),
+        None for a host that can't tell. Returns {host name: [model]}
+    """
+
+    async def endpoint_models(endpoint):
+        client = OLLAMA_CLIENTS.get_client(endpoint.url)
+        try:
+            response = await client._request('GET', '/api/ps')
+        except (httpx.HTTPError, ResponseError) as e:
+            logging.error('Unable to list loaded models on %s: %s', endpoint.url, e)
+            return None
+        models = [{
+                   'name': model['name'],
+                   'size_vram': model.get('size_vram'),
+                   'expires_at': model.get('expires_at')
+                  } for model in response.json().get('models') or []]
+        OLLAMA_ROUTER.set_resident(endpoint, [model['name'] for model in models])
+        return models
+
+    results = await asyncio.gather(*(endpoint_models(endpoint)
+                                     for endpoint in OLLAMA_ROUTER.endpoints))
+    return {endpoint.name: models for endpoint, models in zip(OLLAMA_ROUTER.endpoints, results)}
+
+async def pin_model(model):
+    """Load model and keep it loaded for good on every host that serves
+        it, prompts of this process keep it pinned
+    """
+
+    OLLAMA_ROUTER.pin(model)
+    return await preload_models([model])
+
+async def unpin_model(model, unload=False):
+    """Let model be unloaded OLLAMA_KEEP_ALIVE seconds after its last
+        prompt again, or right away with unload=True
+    """
+
+    OLLAMA_ROUTER.unpin(model)
+    return await preload_models([model], 0 if unload else None)
+
+class StreamSanitizer:
+    """strip_boilerplate for text that arrives in chunks
+
+        The last len(longest phrase) - 1 characters are held back, a phrase
+        that is not complete yet can only start inside that tail, so
+        everything before it is final.
+    """
+
+    HOLD_BACK = max(len(phrase) for phrase in BOILERPLATE_PHRASES) - 1
+
+    def __init__(self):
+        self._pending = ''
+
+    def feed(self, text):
+        """Sanitized text that is safe to emit
+        """
+
+        buffered = strip_boilerplate(self._pending + text)
+        cutoff = max(0, len(buffered) - self.HOLD_BACK)
+        self._pending = buffered[cutoff:]
+        return buffered[:cutoff]
+
+    def flush(self):
+        """Whatever is still held back
+        """
+
+        rest, self._pending = self._pending, ''
+        return rest
+
+def _json_closed(openers, name):
+    state = {'open': [], 'quote': None, 'escape': False}
+    closing = {'{': '}', '[': ']'}
+
+    def stop_when(text):
+        for position, char in enumerate(text):
+            if state['quote']:
+                if state['escape']:
+                    state['escape'] = False
+                elif char == '\\':
+                    state['escape'] = True
+                elif char == state['quote']:
+                    state['quote'] = None
+            elif char in '"\'' and state['open']:
+                state['quote'] = char
+            elif char in closing and (state['open'] or char in openers):
+                state['open'].append(closing[char])
+            elif state['open'] and char == state['open'][-1]:
+                state['open'].pop()
+                if not state['open']:
+                    return position + 1
+        return None
+
+    stop_when.__name__ = name
+    return stop_when
+
+def json_object_closed():
+    """Stop condition for prompt_chat_stream, the reply ends where its
+        first top level {...} object closes, brackets inside strings are
+        ignored. Both JSON and python style quotes are understood.
+    """
+
+    return _json_closed('{', 'json_object_closed')
+
+def json_value_closed():
+    """Like json_object_closed(), a top level [...] array ends the reply
+        too, for prompts whose reply may be a bare array
+    """
+
+    return _json_closed('{[', 'json_value_closed')
+
+def analyzed_object(dt, analysis_sha512, analysis, encrypt_analysis):
+    """Build the object prompt_chat returns
+    """
+
+    # see encryption.py module
+    # encrypt text *** make sure that encryption key file is secure! ***
+
+    if encrypt_analysis:
+        analysis = encrypt_text(analysis).decode('utf-8')
+
+    analyzed_obj = {
+                    'timestamp' : dt,
+                    'shasum_512' : analysis_sha512,
+                    'analysis' : analysis
+                    }
+
+    return analyzed_obj
+
+async def run_prompt_graph(stages, max_concurrency=None):
+    """Run a dependency graph of prompt stages on a single event loop
+
+        stages maps a stage name to a (dependencies, stage_func) tuple.
+        stage_func is called with a dict of {dependency_name: result} and
+        must return an awaitable. A stage starts as soon as all of its
+        dependencies have finished, so independent stages run concurrently,
+        at most max_concurrency of them at once when given.
+
+        A stage that fails fails the stages that depend on it, the others
+        carry on. Once every stage has finished the first failure, in
+        stages order, is raised.
+
+        Returns a dict of {stage_name: result}.
+    """
+
+    for name, (dependencies, _) in stages.items():
+        unknown = [dep for dep in dependencies if dep not in stages]
+        if unknown:
+            raise ValueError(f'Stage {name} depends on unknown stage(s) {unknown}')
+
+    # reject cycles up front, they would otherwise deadlock the graph
+    def check_cycle(name, path):
+        if name in path:
+            raise ValueError(f'Stage graph has a cycle through {name}')
+        for dep in stages[name][0]:
+            check_cycle(dep, path | {name})
+
+    for name in stages:
+        check_cycle(name, frozenset())
+
+    tasks = {}
+    slots = asyncio.Semaphore(max_concurrency) if max_concurrency else None
+
+    async def run_stage(name):
+        dependencies, stage_func = stages[name]
+        dep_results = {}
+        for dep in dependencies:
+            dep_results[dep] = await tasks[dep]
+        if slots is None:
+            return await stage_func(dep_results)
+        async with slots:
+            return await stage_func(dep_results)
+
+    # all tasks are created before any of them runs, so a stage can
+    #  always find the tasks it depends on
+    for name in stages:
+        tasks[name] = asyncio.create_task(run_stage(name), name=name)
+
+    try:
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+    except BaseException:
+        # cancelled from outside
+        for task in tasks.values():
+            task.cancel()
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+        raise
+
+    # result() raises the stage's failure
+    return {name: task.result() for name, task in tasks.items()}
@@ -0,0 +1,14 @@
+"""gunicorn settings, read from the working directory gunicorn runs in
+    ©2024, Ovais Quraishi
+
+    LICENSE: The 3-Clause BSD License - license.txt
+"""
+
+def post_worker_init(worker): # pylint: disable=unused-argument
+    """Start the job workers of each gunicorn worker when it starts, jobs
+        queued before a restart don't wait for the next request
+    """
+
+    from zollama import ensure_job_workers # pylint: disable=import-outside-toplevel
+
+    ensure_job_workers()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""Offline ICD-10-CM resolver
+    ©2024, Ovais Quraishi
+
+    Code validity, billable flag and descriptions come straight from the
+    ICD-10-CM tables shipped with simple_icd_10_cm and icd10, indexed in
+    memory once per process, so they no longer need an LLM round trip.
+
+    Example:
+        ICD10_RESOLVER.resolve('e11.9')
+        {'code': 'E11.9', 'valid': True, 'billable': True,
+         'short_description': 'Type 2 diabetes mellitus without complications',
+         'long_description': 'Type 2 diabetes mellitus without complications'}
+"""
+
+import logging
+import time
+
+import icd10 as icdbilling
+import simple_icd_10_cm as icddetails
+
+class ICD10Resolver:
+    """In-memory index of ICD-10-CM codes, keyed by code without the dot
+    """
+
+    def __init__(self):
+        self._index = {}
+
+    def build(self):
+        """Index every ICD-10-CM category and subcategory
+        """
+
+        started = time.monotonic()
+        index = {}
+
+        # icd10 carries the billable flag per code
+        for code, (billable, description) in icdbilling.codes.items():
+            index[code] = {
+                           'billable': billable,
+                           'short_description': description,
+                           'long_description': description
+                          }
+
+        # simple_icd_10_cm adds codes icd10 lacks, and inclusion terms
+        for code in icddetails.get_all_codes(False):
+            if icddetails.is_chapter_or_block(code):
+                continue
+            description = icddetails.get_description(code)
+            inclusion_terms = icddetails.get_inclusion_term(code)
+            long_description = description
+            if inclusion_terms:
+                long_description = f"{description} (includes: {'; '.join(inclusion_terms)})"
+            entry = index.setdefault(code, {
+                                            'billable': icddetails.is_leaf(code),
+                                            'short_description': description
+                                           })
+            entry['long_description'] = long_description
+
+        self._index = index
+        logging.info('Indexed %s ICD-10-CM codes in %.2fs', len(index), time.monotonic() - started)
+
+    @staticmethod
+    def normalize(code):
+        """E11.9, e119 and ' E11.9 ' all become E119
+        """
+
+        return code.strip().upper().replace('.', '')
+
+    def resolve(self, code):
+        """Validity, billable flag and descriptions for a code
+        """
+
+        if not self._index:
+            self.build()
+
+        key = self.normalize(code)
+        entry = self._index.get(key)
+        if entry is None:
+            return {
+                    'code': code,
+                    'valid': False,
+                    'billable': False,
+                    'short_description': '',
+                    'long_description': ''
+                   }
+
+        dotted = key if len(key) <= 3 else f'{key[:3]}.{key[3:]}'
+        return dict(entry, code=dotted, valid=True)
+
+    def __len__(self):
+        return len(self._index)
+
+ICD10_RESOLVER = ICD10Resolver()
+ICD10_RESOLVER.build()
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+"""Long running job queue backed by the analysis_jobs table
+    ©2024, Ovais Quraishi
+
+    API endpoints only enqueue jobs and return a job id. Job workers claim
+    queued jobs with SELECT ... FOR UPDATE SKIP LOCKED, so any number of
+    workers, in the service process or in standalone worker processes
+    (see zollama_worker.py), can share the same queue.
+
+    Job status: queued -> running -> completed | failed | cancelled
+    A queued job is cancelled right away, a running job is moved to
+    cancelling and its handler is asked to stop.
+
+    A claimed job holds a lease that every progress report renews. When
+    the worker dies the lease runs out and the next worker that polls
+    puts a running job back in the queue and finishes a cancelling one.
+"""
+
+import datetime
+import json
+import logging
+import threading
+import time
+import uuid
+
+from config import get_config
+from database import register_query
+from database import run_modify_query
+from database import run_query
+from utils import ts_int_to_dt_obj
+
+CONFIG = get_config()
+
+# seconds between polls of an idle worker, and between progress updates
+JOB_POLL_INTERVAL = CONFIG.getfloat('service', 'JOB_POLL_INTERVAL', fallback=5)
+JOB_PROGRESS_INTERVAL = CONFIG.getfloat('service', 'JOB_PROGRESS_INTERVAL', fallback=10)
+# seconds a claimed job stays claimed without a progress report
+JOB_LEASE_SECONDS = CONFIG.getfloat('service', 'JOB_LEASE_SECONDS',
+                                    fallback=max(60, 6 * JOB_PROGRESS_INTERVAL))
+
+JOB_FINAL_STATES = ('completed', 'failed', 'cancelled')
+
+# job_type -> callable(JobContext), returns a JSON serializable result
+JOB_HANDLERS = {}
+
+def register_job_handler(job_type, handler):
+    """Register the function that runs jobs of job_type
+    """
+
+    JOB_HANDLERS[job_type] = handler
+
+register_query('submit_job',
+               """INSERT INTO analysis_jobs
+                        (job_id, timestamp, updated, job_type, status, job_document, progress)
+                   VALUES
+                        (%s, %s, %s, %s, 'queued', %s, %s);
+                """)
+
+def submit_job(job_type, visit_note_ids=None):
+    """Enqueue a job, returns the job id
+    """
+
+    if job_type not in JOB_HANDLERS:
+        raise ValueError(f'Unknown job type {job_type}')
+
+    job_id = uuid.uuid4().hex
+    dt = ts_int_to_dt_obj()
+    job_document = {
+                    'visit_note_ids': visit_note_ids
+                   }
+    progress = {
+                'total': len(visit_note_ids) if visit_note_ids is not None else None,
+                'completed': 0,
+                'failed': 0
+               }
+
+    run_modify_query('submit_job', (job_id, dt, dt, job_type,
+                                    json.dumps(job_document), json.dumps(progress)))
+    logging.info('Queued %s job %s', job_type, job_id)
+    return job_id
+
+register_query('get_job',
+               """SELECT
+                        job_id, timestamp, updated, job_type, status, progress, result, error
+                   FROM
+                        analysis_jobs
+                   WHERE job_id = %s;
+                """)
+
+def get_job(job_id):
+    """Get a job's status and progress, None if there is no such job
+    """
+
+    jobs = run_query('get_job', (job_id,))
+    return jobs[0] if jobs else None
+
+register_query('cancel_job',
+               """UPDATE analysis_jobs
+                   SET
+                        status = CASE WHEN status = 'queued' THEN 'cancelled'
+                                      ELSE 'cancelling' END,
+                        updated = %s
+                   WHERE job_id = %s
+                        AND status IN ('queued', 'running')
+                   RETURNING status;
+                """)
+
+def cancel_job(job_id):
+    """Cancel a job, returns the job's status after the request or None if
+        there is no such job
+    """
+
+    updated = run_modify_query('cancel_job', (ts_int_to_dt_obj(), job_id))
+    if updated:
+        return updated[0]['status']
+    job = get_job(job_id)
+    return job['status'] if job else None
+
+register_query('claim_next_job',
+               """UPDATE analysis_jobs
+                   SET
+                        status = 'running',
+                        updated = %s,
+                        lease_expires = %s
+                   WHERE id = (
+                               SELECT id
+                               FROM analysis_jobs
+                               WHERE status = 'queued'
+                               ORDER BY id
+                               FOR UPDATE SKIP LOCKED
+                               LIMIT 1
+                              )
+                   RETURNING job_id, job_type, job_document;
+                """)
+
+def claim_next_job():
+    """Atomically move the oldest queued job to running, None if the queue
+        is empty
+    """
+
+    dt = ts_int_to_dt_obj()
+    claimed = run_modify_query('claim_next_job', (dt, lease_expiry(dt)))
+    return claimed[0] if claimed else None
+
+def lease_expiry(dt):
+    """When a lease taken or renewed at dt runs out
+    """
+
+    return dt + datetime.timedelta(seconds=JOB_LEASE_SECONDS)
+
+register_query('reclaim_stale_jobs',
+               """UPDATE analysis_jobs
+                   SET
+                        status = CASE WHEN status = 'running' THEN 'queued'
+                                      ELSE 'cancelled' END,
+                        updated = %s,
+                        lease_expires = NULL
+                   WHERE status IN ('running', 'cancelling')
+                        AND lease_expires < %s
+                   RETURNING job_id, status;
+                """)
+
+def reclaim_stale_jobs():
+    """Requeue running jobs and cancel cancelling jobs whose lease ran out,
+        their worker is gone. Returns the reclaimed jobs.
+    """
+
+    dt = ts_int_to_dt_obj()
+    reclaimed = run_modify_query('reclaim_stale_jobs', (dt, dt))
+    for job in reclaimed:
+        logging.warning('Job %s lost its worker, now %s', job['job_id'], job['status'])
+    return reclaimed
+
+register_query('update_job',
+               """UPDATE analysis_jobs
+                   SET
+                        updated = %s,
+                        lease_expires = %s,
+                        progress = COALESCE(%s::jsonb, progress),
+                        status = COALESCE(%s, status),
+                        result = COALESCE(%s::jsonb, result),
+                        error = COALESCE(%s, error)
+                   WHERE job_id = %s
+                   RETURNING status;
+                """)
+
+def update_job(job_id, progress=None, status=None, result=None, error=None):
+    """Update progress and/or final state of a job and renew its lease,
+        returns the job's status
+    """
+
+    dt = ts_int_to_dt_obj()
+    updated = run_modify_query('update_job', (dt,
+                                             lease_expiry(dt),
+                                             json.dumps(progress) if progress is not None else None,
+                                             status,
+                                             json.dumps(result) if result is not None else None,
+                                             error,
+                                             job_id))
+    return updated[0]['status'] if updated else None
+
+class JobContext:
+    """Handed to a job handler, the handler registers how to read its
+        progress and how to stop, JobContext reports progress to the
+        database and watches for cancellation in the background
+    """
+
+    def __init__(self, job_id, job_type, visit_note_ids):
+        self.job_id = job_id
+        self.job_type = job_type
+        self.visit_note_ids = visit_note_ids
+        self._progress_func = None
+        self._cancel_funcs = []
+        self._cancelled = threading.Event()
+
+    def track(self, progress_func):
+        """progress_func() returns the progress dict of the running job
+        """
+
+        self._progress_func = progress_func
+
+    def on_cancel(self, cancel_func):
+        """cancel_func() is called when the job gets cancelled
+        """
+
+        self._cancel_funcs.append(cancel_func)
+        if self._cancelled.is_set():
+            cancel_func()
+
+    @property
+    def cancelled(self):
+        """True once the job has been cancelled
+        """
+
+        return self._cancelled.is_set()
+
+    def progress(self):
+        """Current progress of the job
+        """
+
+        if self._progress_func is None:
+            return None
+        return self._progress_func()
+
+    def report(self):
+        """Write progress to the database, pick up cancellation requests
+        """
+
+        status = update_job(self.job_id, progress=self.progress())
+        if status == 'cancelling' and not self._cancelled.is_set():
+            logging.info('Cancelling job %s', self.job_id)
+            self._cancelled.set()
+            for cancel_func in self._cancel_funcs:
+                cancel_func()
+
+def run_job(job):
+    """Run a claimed job to completion
+    """
+
+    job_id = job['job_id']
+    context = JobContext(job_id, job['job_type'], job['job_document'].get('visit_note_ids'))
+    done = threading.Event()
+
+    def monitor():
+        while not done.wait(JOB_PROGRESS_INTERVAL):
+            try:
+                context.report()
+            except Exception as e: # pylint: disable=broad-except
+                logging.error('Unable to report progress of job %s: %s', job_id, e)
+
+    monitor_thread = threading.Thread(target=monitor, name=f'job-monitor-{job_id[0:8]}', daemon=True)
+    monitor_thread.start()
+
+    logging.info('Running %s job %s', job['job_type'], job_id)
+    try:
+        result = JOB_HANDLERS[job['job_type']](context)
+        done.set()
+        monitor_thread.join()
+        context.report()
+        status = 'cancelled' if context.cancelled else 'completed'
+        update_job(job_id, progress=context.progress(), status=status, result=result)
+    except Exception as e: # pylint: disable=broad-except
+        done.set()
+        monitor_thread.join()
+        logging.error('Job %s failed: %s', job_id, e)
+        update_job(job_id, progress=context.progress(), status='failed', error=str(e))
+
+def job_worker(stop_event):
+    """Claim and run jobs until stop_event is set
+    """
+
+    while not stop_event.is_set():
+        try:
+            reclaim_stale_jobs()
+            job = claim_next_job()
+        except Exception as e: # pylint: disable=broad-except
+            logging.error('Unable to claim a job: %s', e)
+            job = None
+        if job is None:
+            stop_event.wait(JOB_POLL_INTERVAL)
+            continue
+        run_job(job)
+
+def start_job_workers(num_workers):
+    """Start job worker threads, returns the event that stops them
+    """
+
+    stop_event = threading.Event()
+    for n in range(num_workers):
+        threading.Thread(target=job_worker,
+                         args=(stop_event,),
+                         name=f'job-worker-{n}',
+                         daemon=True).start()
+    return stop_event
+
+def run_job_workers(num_workers):
+    """Run job workers in the foreground until interrupted
+    """
+
+    stop_event = start_job_workers(num_workers)
+    try:
+        while not stop_event.is_set():
+            time.sleep(1)
+    except KeyboardInterrupt:
+        stop_event.set()
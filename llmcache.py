@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""Content addressed cache for LLM responses
+    ©2024, Ovais Quraishi
+
+    Prompts run with temperature 0, so the same model, options and prompt
+    give the same reply. Replies are cached under a hash of the three in
+    two tiers:
+        - a bounded in-memory LRU, per process
+        - the llm_response_cache table, shared by all processes
+
+    Both tiers expire entries after LLM_CACHE_TTL seconds. Replies stored
+    in the database are encrypted when PATIENT_DATA_ENCRYPTION_ENABLED is
+    set, prompts carry patient data.
+"""
+
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from config import get_config
+from database import register_query
+from database import run_modify_query
+from database import run_modify_query_rowcount
+from database import run_query
+from encryption import decrypt_text
+from encryption import encrypt_text
+from utils import ts_int_to_dt_obj
+
+CONFIG = get_config()
+
+LLM_CACHE_ENABLED = CONFIG.getboolean('service', 'LLM_CACHE_ENABLED', fallback=False)
+LLM_CACHE_PERSIST = CONFIG.getboolean('service', 'LLM_CACHE_PERSIST', fallback=True)
+LLM_CACHE_MAX_ENTRIES = CONFIG.getint('service', 'LLM_CACHE_MAX_ENTRIES', fallback=1024)
+LLM_CACHE_MAX_ROWS = CONFIG.getint('service', 'LLM_CACHE_MAX_ROWS', fallback=1000000)
+LLM_CACHE_TTL = CONFIG.getint('service', 'LLM_CACHE_TTL', fallback=30 * 24 * 3600)
+# database purge runs once every this many stores
+LLM_CACHE_PURGE_EVERY = 1000
+
+def cache_key(llm, options, content):
+    """Hash of model, options and prompt
+    """
+
+    key_document = json.dumps({'model': llm, 'options': options, 'prompt': content},
+                              sort_keys=True)
+    return hashlib.sha256(key_document.encode('utf-8')).hexdigest()
+
+register_query('get_llm_cache_entry',
+               """SELECT
+                        response_document
+                  FROM
+                        llm_response_cache
+                  WHERE cache_key = %s
+                        AND timestamp > %s;
+               """)
+
+# an expired entry is refreshed in place
+register_query('store_llm_cache_entry',
+               """INSERT INTO llm_response_cache
+                        (timestamp, cache_key, model, response_document)
+                  VALUES
+                        (%s, %s, %s, %s)
+                  ON CONFLICT (cache_key) DO UPDATE
+                  SET
+                        timestamp = EXCLUDED.timestamp,
+                        response_document = EXCLUDED.response_document;
+               """)
+
+register_query('purge_expired_llm_cache_entries',
+               """DELETE FROM llm_response_cache
+                  WHERE timestamp < %s;""")
+
+register_query('purge_excess_llm_cache_entries',
+               """DELETE FROM llm_response_cache
+                  WHERE id IN (
+                               SELECT id
+                               FROM llm_response_cache
+                               ORDER BY timestamp DESC
+                               OFFSET %s
+                              );""")
+
+class LLMResponseCache:
+    """Two tier LLM response cache, values are dicts with the sanitized
+        plain text analysis and its shasum_512
+    """
+
+    def __init__(self, max_entries, ttl, persist, max_rows, encrypt):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.persist = persist
+        self.max_rows = max_rows
+        self.encrypt = encrypt
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {
+                          'memory_hits': 0,
+                          'db_hits': 0,
+                          'misses': 0,
+                          'stores': 0,
+                          'evictions': 0,
+                          'errors': 0
+                         }
+
+    def _incr(self, counter):
+        with self._lock:
+            self._counters[counter] += 1
+
+    def stats(self):
+        """Hit/miss counters and memory tier size
+        """
+
+        with self._lock:
+            stats = dict(self._counters, memory_entries=len(self._entries))
+        lookups = stats['memory_hits'] + stats['db_hits'] + stats['misses']
+        stats['hit_ratio'] = round((lookups - stats['misses']) / lookups, 4) if lookups else 0
+        return stats
+
+    def _memory_get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                self._counters['evictions'] += 1
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def _memory_put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._counters['evictions'] += 1
+
+    def _db_get(self, key):
+        rows = run_query('get_llm_cache_entry',
+                         (key, ts_int_to_dt_obj() - timedelta(seconds=self.ttl)))
+        if not rows:
+            return None
+        response_document = rows[0]['response_document']
+        analysis = response_document['analysis']
+        if response_document.get('encrypted'):
+            analysis = decrypt_text(analysis)
+        return {
+                'shasum_512': response_document['shasum_512'],
+                'analysis': analysis
+               }
+
+    def _db_put(self, key, llm, value):
+        analysis = value['analysis']
+        if self.encrypt:
+            analysis = encrypt_text(analysis).decode('utf-8')
+        response_document = {
+                             'shasum_512': value['shasum_512'],
+                             'analysis': analysis,
+                             'encrypted': self.encrypt
+                            }
+        run_modify_query('store_llm_cache_entry', (ts_int_to_dt_obj(),
+                                                   key,
+                                                   llm,
+                                                   json.dumps(response_document)))
+
+    def get(self, key):
+        """Cached value for key or None, memory first then database
+        """
+
+        value = self._memory_get(key)
+        if value is not None:
+            self._incr('memory_hits')
+            return value
+
+        if self.persist:
+            try:
+                value = self._db_get(key)
+            except Exception as e: # pylint: disable=broad-except
+                # the cache must never break a prompt
+                logging.error('LLM cache read failed: %s', e)
+                self._incr('errors')
+            if value is not None:
+                self._incr('db_hits')
+                self._memory_put(key, value)
+                return value
+
+        self._incr('misses')
+        return None
+
+    def put(self, key, llm, value):
+        """Store value in both tiers
+        """
+
+        self._memory_put(key, value)
+        self._incr('stores')
+        if self.persist:
+            try:
+                self._db_put(key, llm, value)
+                if self._counters['stores'] % LLM_CACHE_PURGE_EVERY == 0:
+                    self.purge()
+            except Exception as e: # pylint: disable=broad-except
+                logging.error('LLM cache write failed: %s', e)
+                self._incr('errors')
+
+    def purge(self):
+        """Delete expired rows, then the oldest rows beyond max_rows,
+            returns how many of each were deleted
+        """
+
+        expired = run_modify_query_rowcount('purge_expired_llm_cache_entries',
+                                            (ts_int_to_dt_obj() - timedelta(seconds=self.ttl),))
+        trimmed = run_modify_query_rowcount('purge_excess_llm_cache_entries', (self.max_rows,))
+        logging.info('LLM cache purge removed %s expired and %s excess rows', expired, trimmed)
+        return expired, trimmed
+
+    def clear(self):
+        """Empty the memory tier
+        """
+
+        with self._lock:
+            self._entries.clear()
+
+LLM_CACHE = LLMResponseCache(LLM_CACHE_MAX_ENTRIES,
+                             LLM_CACHE_TTL,
+                             LLM_CACHE_PERSIST,
+                             LLM_CACHE_MAX_ROWS,
+                             CONFIG.patient_data_encryption_enabled)
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""Structured output of the code lookup prompts
+    ©2024, Ovais Quraishi
+
+    Each lookup prompt has a JSON schema that is sent to Ollama as the
+    chat format, so the model can only produce JSON of that shape. Replies
+    are read with repair_json(), which also takes the almost-JSON models
+    write without a schema (python literals, code fences, trailing commas,
+    line breaks inside strings, a reply cut off mid object), and turned
+    into typed result objects. A reply that can't be read raises
+    LLMOutputError instead of taking the rest of the analysis down with it.
+
+    Example:
+        guidelines = parse_reply(reply_text, BillingGuidelines)
+        guidelines.insurance_company.reimbursement_rate
+"""
+
+import ast
+import json
+import re
+from dataclasses import asdict
+from dataclasses import dataclass
+from dataclasses import field
+
+def _object_schema(properties):
+    return {
+            'type': 'object',
+            'properties': properties,
+            'required': list(properties)
+           }
+
+_TEXT = {'type': 'string'}
+_BILLING_GUIDELINE_SCHEMA = _object_schema({
+                                            'reimbursement_rate': _TEXT,
+                                            'billing_instructions': _TEXT
+                                           })
+_DESCRIPTION_SCHEMA = _object_schema({
+                                      'short_description': _TEXT,
+                                      'long_description': _TEXT
+                                     })
+
+ICD_BILLING_GUIDELINES_SCHEMA = _object_schema({
+                                                'insurance_company': _BILLING_GUIDELINE_SCHEMA,
+                                                'medical_provider': _BILLING_GUIDELINE_SCHEMA
+                                               })
+CPT_CODE_SCHEMA = _object_schema({'cpt': _TEXT, 'details': _DESCRIPTION_SCHEMA})
+HCPCS_CODE_SCHEMA = _object_schema({'hcpcs': _TEXT, 'details': _DESCRIPTION_SCHEMA})
+# batched lookups, one entry per code
+CPT_CODE_BATCH_SCHEMA = _object_schema({'codes': {'type': 'array', 'items': CPT_CODE_SCHEMA}})
+HCPCS_CODE_BATCH_SCHEMA = _object_schema({'codes': {'type': 'array', 'items': HCPCS_CODE_SCHEMA}})
+
+# lookup type -> schema of its reply
+LOOKUP_SCHEMAS = {
+                  'icd_billing_guidelines': ICD_BILLING_GUIDELINES_SCHEMA,
+                  'cpt': CPT_CODE_SCHEMA,
+                  'hcpcs': HCPCS_CODE_SCHEMA,
+                  'cpt_batch': CPT_CODE_BATCH_SCHEMA,
+                  'hcpcs_batch': HCPCS_CODE_BATCH_SCHEMA
+                 }
+
+class LLMOutputError(ValueError):
+    """LLM reply that is not a JSON object, even after repair
+    """
+
+CODE_FENCE = re.compile(r'```(?:json|python)?', re.IGNORECASE)
+TRAILING_COMMA = re.compile(r',(\s*[}\]])')
+PYTHON_LITERALS = {'True': 'true', 'False': 'false', 'None': 'null'}
+
+def _closes(text, position, quote):
+    # an apostrophe inside a single quoted python string, "patient's"
+    return text[position] == quote and \
+           not (quote == "'" and text[position + 1:position + 2].isalpha())
+
+def _object_text(text):
+    """The first {...} object in text, closed if the reply was cut off
+    """
+
+    start = text.find('{')
+    if start == -1:
+        raise LLMOutputError('No JSON object in reply')
+
+    closers = []
+    quote = None
+    escape = False
+    for position in range(start, len(text)):
+        char = text[position]
+        if quote:
+            if escape:
+                escape = False
+            elif char == '\\':
+                escape = True
+            elif _closes(text, position, quote):
+                quote = None
+        elif char in '"\'':
+            quote = char
+        elif char in '{[':
+            closers.append('}' if char == '{' else ']')
+        elif char in '}]':
+            if closers:
+                closers.pop()
+            if not closers:
+                return text[start:position + 1]
+
+    # cut off, close the string and whatever is still open
+    tail = text[start:].rstrip().rstrip(',')
+    return tail + (quote or '') + ''.join(reversed(closers))
+
+def _to_json(text):
+    """Rewrite almost-JSON as JSON: single quoted strings, python literals,
+        raw line breaks inside strings, trailing commas
+    """
+
+    out = []
+    quote = None
+    escape = False
+    position = 0
+    while position < len(text):
+        char = text[position]
+        if quote:
+            if escape:
+                # \' is not a JSON escape
+                out.append("'" if char == "'" else '\\' + char)
+                escape = False
+            elif char == '\\':
+                escape = True
+            elif _closes(text, position, quote):
+                out.append('"')
+                quote = None
+            elif char == '"':
+                out.append('\\"')
+            elif char == '\n':
+                out.append('\\n')
+            elif char in '\r\t':
+                out.append(' ')
+            else:
+                out.append(char)
+        elif char in '"\'':
+            out.append('"')
+            quote = char
+        else:
+            for literal, replacement in PYTHON_LITERALS.items():
+                if text.startswith(literal, position) and \
+                   not text[position + len(literal):position + len(literal) + 1].isalnum():
+                    out.append(replacement)
+                    position += len(literal) - 1
+                    break
+            else:
+                out.append(char)
+        position += 1
+    return TRAILING_COMMA.sub(r'\1', ''.join(out))
+
+def repair_json(text):
+    """Dict from an LLM reply that should be a JSON object
+    """
+
+    if isinstance(text, dict):
+        return text
+    if not isinstance(text, str) or not text.strip():
+        raise LLMOutputError('Empty reply')
+
+    candidate = _object_text(CODE_FENCE.sub('', text))
+    for parse in (json.loads,
+                  ast.literal_eval,
+                  lambda candidate: json.loads(_to_json(candidate))):
+        try:
+            value = parse(candidate)
+        except (ValueError, SyntaxError, MemoryError, RecursionError):
+            continue
+        if isinstance(value, dict):
+            return value
+    raise LLMOutputError(f'Unreadable JSON object in reply: {candidate[:80]}')
+
+def _text(value):
+    if value is None:
+        return ''
+    return value.strip() if isinstance(value, str) else str(value)
+
+def _section(value):
+    return value if isinstance(value, dict) else {}
+
+@dataclass
+class BillingGuideline:
+    """Reimbursement rate and billing instructions of one party
+    """
+
+    reimbursement_rate: str = ''
+    billing_instructions: str = ''
+
+    @classmethod
+    def from_dict(cls, data):
+        data = _section(data)
+        return cls(_text(data.get('reimbursement_rate')), _text(data.get('billing_instructions')))
+
+@dataclass
+class BillingGuidelines:
+    """Billing guidelines of an icd code
+    """
+
+    insurance_company: BillingGuideline = field(default_factory=BillingGuideline)
+    medical_provider: BillingGuideline = field(default_factory=BillingGuideline)
+
+    @classmethod
+    def from_dict(cls, data):
+        data = _section(data)
+        return cls(BillingGuideline.from_dict(data.get('insurance_company')),
+                   BillingGuideline.from_dict(data.get('medical_provider')))
+
+    def to_dict(self):
+        return asdict(self)
+
+@dataclass
+class CodeDescription:
+    """Reply of the cpt and hcpcs code lookup prompts
+    """
+
+    code_system: str
+    code: str
+    short_description: str = ''
+    long_description: str = ''
+
+    @classmethod
+    def from_dict(cls, data, code_system):
+        details = _section(data.get('details'))
+        return cls(code_system,
+                   _text(data.get(code_system)),
+                   _text(details.get('short_description')),
+                   _text(details.get('long_description')))
+
+    def to_dict(self):
+        """Same shape as the JSON the prompt asks for
+        """
+
+        return {
+                self.code_system: self.code,
+                'details': {
+                            'short_description': self.short_description,
+                            'long_description': self.long_description
+                           }
+               }
+
+def parse_reply(text, result_type, *args):
+    """Typed result from an LLM reply, raises LLMOutputError
+    """
+
+    return result_type.from_dict(repair_json(text), *args)
+
+def parse_code_batch(text, code_system):
+    """{code: CodeDescription} from the reply of a batched cpt/hcpcs lookup,
+        codes are upper case. Takes {"codes": [...]}, a bare list or a
+        single entry, raises LLMOutputError.
+    """
+
+    if isinstance(text, str) and text.lstrip().startswith('['):
+        text = '{"codes": ' + text + '}'
+    data = repair_json(text)
+    entries = data.get('codes') if isinstance(data.get('codes'), list) else [data]
+
+    descriptions = {}
+    for entry in entries:
+        if isinstance(entry, dict):
+            description = CodeDescription.from_dict(entry, code_system)
+            if description.code:
+                descriptions.setdefault(description.code.upper(), description)
+    return descriptions
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""Apply database schema migrations
+    ©2024, Ovais Quraishi
+
+    Migrations are the .sql files in MIGRATIONS_DIR, named
+    <version>_<name>.sql, and are applied in version order. Each one runs
+    in its own transaction and is recorded in the schema_migrations
+    table, so a rerun only applies the ones that are missing. zollama.sql
+    already has the schema every migration builds, and migrations are
+    written to be safe to apply on top of it. A database built from an
+    older zollama.sql gets the same schema from the migrations, 0000 adds
+    the tables and columns the later ones build on.
+
+    Run:
+        > python migrate.py
+    Show what is applied and what is pending:
+        > python migrate.py --list
+"""
+
+import argparse
+import logging
+import os
+import re
+
+import psycopg2
+
+from database import db_connection
+from utils import ts_int_to_dt_obj
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+MIGRATION_FILE = re.compile(r'^(\d+)_(\w+)\.sql$')
+# advisory lock key, keeps two migrate runs from applying the same migration
+MIGRATION_LOCK_ID = 7369782
+
+def find_migrations(migrations_dir=MIGRATIONS_DIR):
+    """(version, name, path) of every migration file, in version order
+    """
+
+    migrations = []
+    for filename in os.listdir(migrations_dir):
+        match = MIGRATION_FILE.match(filename)
+        if match:
+            migrations.append((match.group(1), match.group(2), os.path.join(migrations_dir, filename)))
+    migrations.sort(key=lambda migration: int(migration[0]))
+
+    versions = [int(version) for version, _, _ in migrations]
+    if len(versions) != len(set(versions)):
+        raise ValueError(f'Duplicate migration versions in {migrations_dir}')
+    return migrations
+
+def ensure_migrations_table(conn):
+    """Create the schema_migrations table if it's not there
+    """
+
+    with conn.cursor() as cur:
+        cur.execute("""CREATE TABLE IF NOT EXISTS public.schema_migrations (
+                            version text PRIMARY KEY,
+                            name text NOT NULL,
+                            applied timestamp with time zone NOT NULL
+                       );
+                    """)
+    conn.commit()
+
+def applied_versions(conn):
+    """Versions already applied
+    """
+
+    with conn.cursor() as cur:
+        cur.execute('SELECT version FROM public.schema_migrations;')
+        return {row[0] for row in cur.fetchall()}
+
+def apply_migration(conn, version, name, path):
+    """Run a migration and record it, in one transaction
+    """
+
+    with open(path, encoding='utf-8') as afile:
+        sql_script = afile.read()
+    logging.info('Applying migration %s_%s', version, name)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(sql_script)
+            cur.execute("""INSERT INTO public.schema_migrations
+                                (version, name, applied)
+                           VALUES (%s, %s, %s);
+                        """, (version, name, ts_int_to_dt_obj()))
+        conn.commit()
+    except psycopg2.Error as e:
+        conn.rollback()
+        logging.error('Migration %s_%s failed: %s', version, name, e)
+        raise
+
+def migrate(migrations_dir=MIGRATIONS_DIR):
+    """Apply pending migrations, returns the versions applied
+    """
+
+    applied = []
+    with db_connection() as conn:
+        ensure_migrations_table(conn)
+        with conn.cursor() as cur:
+            cur.execute('SELECT pg_advisory_lock(%s);', (MIGRATION_LOCK_ID,))
+        try:
+            done = applied_versions(conn)
+            for version, name, path in find_migrations(migrations_dir):
+                if version in done:
+                    continue
+                apply_migration(conn, version, name, path)
+                applied.append(version)
+        finally:
+            if not conn.closed:
+                conn.rollback()
+                with conn.cursor() as cur:
+                    cur.execute('SELECT pg_advisory_unlock(%s);', (MIGRATION_LOCK_ID,))
+                conn.commit()
+    return applied
+
+def main():
+    """Apply or list migrations
+    """
+
+    parser = argparse.ArgumentParser(description='Apply database schema migrations')
+    parser.add_argument('--list', action='store_true', help='list applied and pending migrations')
+    parser.add_argument('--migrations-dir', default=MIGRATIONS_DIR)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO) # init logging
+
+    if args.list:
+        with db_connection() as conn:
+            ensure_migrations_table(conn)
+            done = applied_versions(conn)
+        for version, name, _ in find_migrations(args.migrations_dir):
+            print(f"{version}_{name}\t{'applied' if version in done else 'pending'}")
+        return
+
+    applied = migrate(args.migrations_dir)
+    print(f"Applied {len(applied)} migration(s){': ' + ', '.join(applied) if applied else ''}")
+
+if __name__ == '__main__':
+    main()
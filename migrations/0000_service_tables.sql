@@ -0,0 +1,60 @@
+--©2024, Ovais Quraishi
+-- Tables and columns the service needs that a database built from an
+--  older zollama.sql does not have: fee schedule snapshots and the
+--  snapshot columns of cpt_hcpcs_codes (cms.py), the job queue (jobs.py),
+--  the LLM response cache (llmcache.py) and the code details dictionary
+--  (codedetails.py). Later migrations build on these.
+
+CREATE TABLE IF NOT EXISTS public.fee_schedule_snapshots (
+    id integer GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    "timestamp" timestamp with time zone NOT NULL,
+    label text NOT NULL,
+    effective_date date NOT NULL,
+    status text DEFAULT 'loading'::text NOT NULL,
+    stats jsonb,
+    CONSTRAINT fee_schedule_snapshots_label_key UNIQUE (label)
+);
+
+ALTER TABLE public.cpt_hcpcs_codes
+    ADD COLUMN IF NOT EXISTS first_snapshot_id integer,
+    ADD COLUMN IF NOT EXISTS retired_snapshot_id integer;
+
+CREATE TABLE IF NOT EXISTS public.analysis_jobs (
+    id integer GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    job_id text NOT NULL,
+    "timestamp" timestamp with time zone NOT NULL,
+    updated timestamp with time zone NOT NULL,
+    job_type text NOT NULL,
+    status text NOT NULL,
+    job_document jsonb NOT NULL,
+    progress jsonb NOT NULL,
+    result jsonb,
+    error text,
+    CONSTRAINT analysis_jobs_job_id_key UNIQUE (job_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_analysis_jobs_queued
+    ON public.analysis_jobs USING btree (id) WHERE (status = 'queued'::text);
+
+CREATE TABLE IF NOT EXISTS public.llm_response_cache (
+    id integer GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    "timestamp" timestamp with time zone NOT NULL,
+    cache_key text NOT NULL,
+    model text NOT NULL,
+    response_document jsonb NOT NULL,
+    CONSTRAINT llm_response_cache_cache_key_key UNIQUE (cache_key)
+);
+
+CREATE INDEX IF NOT EXISTS idx_llm_response_cache_timestamp
+    ON public.llm_response_cache USING btree ("timestamp");
+
+CREATE TABLE IF NOT EXISTS public.code_details (
+    id integer GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    "timestamp" timestamp with time zone NOT NULL,
+    code_system text NOT NULL,
+    code text NOT NULL,
+    prompt_version text NOT NULL,
+    details_document jsonb NOT NULL,
+    CONSTRAINT code_details_code_system_code_prompt_version_key
+        UNIQUE (code_system, code, prompt_version)
+);
@@ -0,0 +1,43 @@
+--©2024, Ovais Quraishi
+-- Typed, indexed columns generated from the JSONB keys the hot queries
+--  filter and price on. ->> equality filters can't use the jsonb_path_ops
+--  GIN indexes, and prices were cast to numeric on every row read.
+-- Adding a stored generated column rewrites the table, run it off hours
+--  on a large cpt_hcpcs_codes.
+
+ALTER TABLE public.cpt_hcpcs_codes
+    ADD COLUMN IF NOT EXISTS hcpc text
+        GENERATED ALWAYS AS (codes_document ->> 'hcpc') STORED,
+    ADD COLUMN IF NOT EXISTS locality text
+        GENERATED ALWAYS AS (codes_document ->> 'locality') STORED,
+    ADD COLUMN IF NOT EXISTS modifier text
+        GENERATED ALWAYS AS (COALESCE(codes_document ->> 'modifier', '')) STORED,
+    ADD COLUMN IF NOT EXISTS fac_price numeric
+        GENERATED ALWAYS AS (CAST(NULLIF(codes_document ->> 'fac_price', '') AS numeric)) STORED,
+    ADD COLUMN IF NOT EXISTS nfac_price numeric
+        GENERATED ALWAYS AS (CAST(NULLIF(codes_document ->> 'nfac_price', '') AS numeric)) STORED,
+    ADD COLUMN IF NOT EXISTS fac_limiting_charge numeric
+        GENERATED ALWAYS AS (CAST(NULLIF(codes_document ->> 'fac_limiting_charge', '') AS numeric)) STORED,
+    ADD COLUMN IF NOT EXISTS nfac_limiting_charge numeric
+        GENERATED ALWAYS AS (CAST(NULLIF(codes_document ->> 'nfac_limiting_charge', '') AS numeric)) STORED,
+    ADD COLUMN IF NOT EXISTS conv_fact numeric
+        GENERATED ALWAYS AS (CAST(NULLIF(codes_document ->> 'conv_fact', '') AS numeric)) STORED;
+
+-- fee lookups by code and locality
+CREATE INDEX IF NOT EXISTS idx_cpt_codes_hcpc_locality
+    ON public.cpt_hcpcs_codes USING btree (hcpc, locality);
+
+-- replaces the expression index on codes_document ->> 'hcpc'
+DROP INDEX IF EXISTS public.idx_cpt_codes_current_hcpc;
+CREATE INDEX IF NOT EXISTS idx_cpt_codes_current_hcpc
+    ON public.cpt_hcpcs_codes USING btree (hcpc) WHERE (retired_snapshot_id IS NULL);
+
+ALTER TABLE public.patient_notes
+    ADD COLUMN IF NOT EXISTS patient_locality text
+        GENERATED ALWAYS AS (patient_note ->> 'locality') STORED;
+
+CREATE INDEX IF NOT EXISTS patient_locality_index
+    ON public.patient_notes USING btree (patient_locality);
+
+CREATE INDEX IF NOT EXISTS patient_documents_locality_index
+    ON public.patient_documents USING btree (patient_locality);
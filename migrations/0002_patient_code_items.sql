@@ -0,0 +1,30 @@
+--©2024, Ovais Quraishi
+-- One row per code extracted for a patient document, so billing reads
+--  are index scans instead of jsonb_array_elements over codes_document.
+-- Existing documents are backfilled with: python patientcodes.py
+
+CREATE TABLE IF NOT EXISTS public.patient_code_items (
+    id integer GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    "timestamp" timestamp with time zone NOT NULL,
+    patient_id text NOT NULL,
+    patient_document_id text NOT NULL,
+    source text NOT NULL,
+    code_system text NOT NULL,
+    code text NOT NULL,
+    "position" integer NOT NULL,
+    billable boolean,
+    short_description text,
+    insurance_reimbursement_rate text,
+    insurance_reimbursement_min numeric,
+    insurance_reimbursement_max numeric,
+    provider_reimbursement_rate text,
+    provider_reimbursement_min numeric,
+    provider_reimbursement_max numeric,
+    CONSTRAINT patient_code_items_document_source_code_key UNIQUE (patient_document_id, source, code)
+);
+
+CREATE INDEX IF NOT EXISTS idx_patient_code_items_patient_id
+    ON public.patient_code_items USING btree (patient_id, code_system);
+
+CREATE INDEX IF NOT EXISTS idx_patient_code_items_code
+    ON public.patient_code_items USING btree (code_system, code);
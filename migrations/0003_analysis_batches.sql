@@ -0,0 +1,33 @@
+--©2024, Ovais Quraishi
+-- Batches of a bulk analysis run and the results of the phases they
+--  went through, so a run can pick up at the phase it stopped in.
+--  See analysisbatches.py
+
+CREATE TABLE IF NOT EXISTS public.analysis_batches (
+    id integer GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    batch_id text NOT NULL,
+    run_id text NOT NULL,
+    "timestamp" timestamp with time zone NOT NULL,
+    updated timestamp with time zone NOT NULL,
+    phase text NOT NULL,
+    visit_note_ids jsonb NOT NULL,
+    CONSTRAINT analysis_batches_batch_id_key UNIQUE (batch_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_analysis_batches_open
+    ON public.analysis_batches USING btree (id) WHERE (phase <> 'done'::text);
+
+CREATE INDEX IF NOT EXISTS idx_analysis_batches_run_id
+    ON public.analysis_batches USING btree (run_id);
+
+CREATE TABLE IF NOT EXISTS public.analysis_batch_results (
+    id integer GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    batch_id text NOT NULL,
+    patient_note_id text NOT NULL,
+    phase text NOT NULL,
+    llm text DEFAULT ''::text NOT NULL,
+    "timestamp" timestamp with time zone NOT NULL,
+    result_document jsonb NOT NULL,
+    CONSTRAINT analysis_batch_results_batch_note_phase_llm_key
+        UNIQUE (batch_id, patient_note_id, phase, llm)
+);
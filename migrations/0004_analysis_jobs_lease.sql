@@ -0,0 +1,14 @@
+--©2024, Ovais Quraishi
+-- Lease of a claimed job, renewed by every progress report. Jobs whose
+--  lease ran out lost their worker and are reclaimed, see jobs.py
+
+ALTER TABLE public.analysis_jobs ADD COLUMN IF NOT EXISTS lease_expires timestamp with time zone;
+
+-- jobs claimed before the lease existed get one from their last update
+UPDATE public.analysis_jobs
+    SET lease_expires = updated + interval '5 minutes'
+    WHERE lease_expires IS NULL AND status IN ('running', 'cancelling');
+
+CREATE INDEX IF NOT EXISTS idx_analysis_jobs_lease
+    ON public.analysis_jobs USING btree (lease_expires)
+    WHERE (status = ANY (ARRAY['running'::text, 'cancelling'::text]));
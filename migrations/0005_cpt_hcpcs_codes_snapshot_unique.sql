@@ -0,0 +1,18 @@
+--©2024, Ovais Quraishi
+-- A fee row is unique per snapshot it first appeared in, not overall, so
+--  a row that was retired and comes back in a later snapshot is inserted
+--  again under that snapshot instead of being skipped as a conflict.
+
+ALTER TABLE public.cpt_hcpcs_codes DROP CONSTRAINT IF EXISTS cpt_hcpcs_codes_sha256_key;
+
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1
+                   FROM pg_constraint
+                   WHERE conname = 'cpt_hcpcs_codes_sha256_first_snapshot_id_key') THEN
+        ALTER TABLE public.cpt_hcpcs_codes
+            ADD CONSTRAINT cpt_hcpcs_codes_sha256_first_snapshot_id_key
+                UNIQUE (sha256, first_snapshot_id);
+    END IF;
+END
+$$;
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""LLM output normalization
+    ©2024, Ovais Quraishi
+
+    Boilerplate phrases are matched by one precompiled regular
+    expression, tried only next to the text every phrase shares, so a
+    reply is scanned once however many phrases there are.
+    Whitespace runs are collapsed with str.split(). Nested replies (dicts
+    and lists of JSON) are walked once with an explicit stack, every
+    string is normalized exactly once at any depth.
+
+    Example:
+        normalize_text(reply)                 # boilerplate and whitespace
+        strip_boilerplate(analysis)           # keep the formatting
+        normalize(codes_document)             # every string, in place
+"""
+
+import re
+
+# substrings to be replaced
+BOILERPLATE_PHRASES = [
+    "As an AI language model, I don't have personal preferences or feelings. However,",
+    "As an AI language model, I don't have personal preferences or opinions, but ",
+    "I'm sorry to hear you're feeling that way! As an AI language model, I don't have access to real-time information on Hypmic or its future plans. However,",
+    "As an AI language model, I don't have personal beliefs or experiences. However,",
+    "I'm just an AI, I don't have personal beliefs or opinions, and I cannot advocate for or against any particular religion. However,",
+    "As an AI, I don't have real-time information on specific individuals or their projects. However,"
+]
+BOILERPLATE_REPLACEMENT = 'FWIW - '
+
+# longest first, so a phrase that starts another one never cuts it short
+_BOILERPLATE = '|'.join(re.escape(phrase)
+                        for phrase in sorted(BOILERPLATE_PHRASES, key=len, reverse=True))
+
+def _common_substring(phrases):
+    shortest = min(phrases, key=len)
+    for size in range(len(shortest), 0, -1):
+        for start in range(len(shortest) - size + 1):
+            candidate = shortest[start:start + size]
+            if all(candidate in phrase for phrase in phrases):
+                return candidate
+    return ''
+
+# every phrase contains this, the pattern is only tried where a phrase
+#  would have to start for its marker to be where str.find() saw one
+BOILERPLATE_MARKER = _common_substring(BOILERPLATE_PHRASES)
+_MARKER_OFFSETS = sorted({phrase.index(BOILERPLATE_MARKER) for phrase in BOILERPLATE_PHRASES},
+                         reverse=True)
+
+BOILERPLATE_PATTERN = re.compile(_BOILERPLATE)
+
+def strip_boilerplate(text):
+    """Replace boilerplate phrases with BOILERPLATE_REPLACEMENT
+    """
+
+    position = text.find(BOILERPLATE_MARKER)
+    if position == -1:
+        return text
+
+    parts = []
+    done = 0
+    while position != -1:
+        for offset in _MARKER_OFFSETS:
+            start = position - offset
+            if start < done:
+                continue
+            match = BOILERPLATE_PATTERN.match(text, start)
+            if match:
+                parts += [text[done:start], BOILERPLATE_REPLACEMENT]
+                done = match.end()
+                break
+        position = text.find(BOILERPLATE_MARKER, max(position + 1, done))
+    parts.append(text[done:])
+    return ''.join(parts)
+
+def collapse_whitespace(text, replacement=' '):
+    """Replace every run of whitespace, line breaks included, with
+        replacement, leading and trailing whitespace is dropped
+    """
+
+    return replacement.join(text.split())
+
+def normalize_text(text, boilerplate=True, replacement=' '):
+    """Strip boilerplate phrases and collapse whitespace
+    """
+
+    if boilerplate:
+        text = strip_boilerplate(text)
+    return collapse_whitespace(text, replacement)
+
+def normalize(obj, boilerplate=False, replacement=' '):
+    """Normalize every string in a nested structure of dicts and lists,
+        in place, see normalize_text(). Keys are left alone. Returns obj,
+        or the normalized string when obj is a string.
+    """
+
+    if isinstance(obj, str):
+        return normalize_text(obj, boilerplate, replacement)
+
+    stack = [obj]
+    while stack:
+        container = stack.pop()
+        items = container.items() if isinstance(container, dict) else enumerate(container)
+        for key, value in items:
+            if isinstance(value, str):
+                container[key] = normalize_text(value, boilerplate, replacement)
+            elif isinstance(value, (dict, list)):
+                stack.append(value)
+    return obj
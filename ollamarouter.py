@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+"""Routing of prompts over several Ollama hosts
+    ©2024, Ovais Quraishi
+
+    Every host is an OllamaEndpoint with the models it serves and the
+    number of prompts it is given at once. A prompt goes to the healthy
+    host that serves its model and has a free slot, hosts that ran the
+    model recently (its weights are likely still loaded) first, then the
+    one with the fewest outstanding prompts for its size. When every such
+    host is full the prompt waits for a slot.
+
+    Health is tracked from prompt outcomes: a host that fails to answer is
+    left out for OLLAMA_ENDPOINT_COOLDOWN seconds, doubled after every
+    failure in a row up to OLLAMA_ENDPOINT_MAX_COOLDOWN, and the first
+    prompt after the cooldown tries it again.
+
+    Every prompt tells Ollama how long to keep its model loaded, the
+    router's keep_alive, or forever for a pinned model. Model loads that
+    took longer than load_threshold seconds are counted per host and
+    model, see stats().
+
+    Hosts are listed in setup.config, one section per host:
+        [ollama:gpu1]
+        url=http://gpu1:11434
+        models=llama3.1, deepseek-llm
+        max_concurrency=4
+    An empty models list serves any model. Without [ollama:*] sections
+    OLLAMA_API_URL is the only host.
+"""
+
+import asyncio
+import threading
+import time
+
+from utils import check_endpoint_health
+
+ENDPOINT_SECTION_PREFIX = 'ollama:'
+
+def model_name(model):
+    """Model name without the default tag, llama3.1:latest -> llama3.1
+    """
+
+    return model[:-len(':latest')] if model.endswith(':latest') else model
+
+class NoEndpointError(RuntimeError):
+    """No healthy host serves the model
+    """
+
+class OllamaEndpoint:
+    """One Ollama host, its models, slots and health
+    """
+
+    def __init__(self, name, url, models=None, max_concurrency=4):
+        self.name = name
+        self.url = url
+        self.models = {model_name(model) for model in models or ()}
+        self.max_concurrency = max(1, max_concurrency)
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.down_until = 0
+        self.checked_until = 0
+        # model -> monotonic time its weights are assumed to stay loaded until
+        self.loaded = {}
+        # model -> [loads, seconds spent loading]
+        self.model_loads = {}
+
+    def serves(self, model):
+        return not self.models or model_name(model) in self.models
+
+    def is_up(self, now):
+        return now >= self.down_until
+
+    def has_loaded(self, model, now):
+        return self.loaded.get(model_name(model), 0) > now
+
+    def load(self):
+        """Outstanding prompts for the host's size, 0 idle, 1 full
+        """
+
+        return self.outstanding / self.max_concurrency
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+                'url': self.url,
+                'models': sorted(self.models),
+                'max_concurrency': self.max_concurrency,
+                'outstanding': self.outstanding,
+                'requests': self.requests,
+                'failures': self.failures,
+                'healthy': self.is_up(now),
+                'loaded': sorted(model for model, until in self.loaded.items() if until > now),
+                'model_loads': {model: {'count': count, 'seconds': round(seconds, 3)}
+                                for model, (count, seconds) in self.model_loads.items()}
+               }
+
+class OllamaRouter:
+    """Least outstanding requests balancing over OllamaEndpoints
+
+        Safe to share between threads and event loops, a prompt waiting
+        for a slot is woken on its own loop.
+    """
+
+    def __init__(self, endpoints, keep_alive=300, cooldown=5, max_cooldown=300,
+                 health_check_ttl=30, load_threshold=0.5, pinned=()):
+        if not endpoints:
+            raise ValueError('At least one Ollama endpoint is required')
+        self.endpoints = list(endpoints)
+        self.keep_alive = keep_alive
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.health_check_ttl = health_check_ttl
+        self.load_threshold = load_threshold
+        self.pinned = {model_name(model) for model in pinned}
+        self._lock = threading.Lock()
+        self._waiters = []
+
+    def _pick(self, model, now):
+        candidates = [endpoint for endpoint in self.endpoints
+                      if endpoint.serves(model) and endpoint.is_up(now)]
+        if not candidates:
+            raise NoEndpointError(f'No healthy Ollama endpoint serves {model}')
+        free = [endpoint for endpoint in candidates
+                if endpoint.outstanding < endpoint.max_concurrency]
+        if not free:
+            return None
+        return min(free, key=lambda endpoint: (not endpoint.has_loaded(model, now),
+                                               endpoint.load(),
+                                               endpoint.outstanding))
+
+    async def acquire(self, model):
+        """Endpoint with a slot taken for model, waits for a slot when
+            every host that serves model is full, raises NoEndpointError
+            when none of them is healthy. Hand it back with release().
+        """
+
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._lock:
+                endpoint = self._pick(model, time.monotonic())
+                if endpoint is not None:
+                    endpoint.outstanding += 1
+                    endpoint.requests += 1
+                    return endpoint
+                waiter = loop.create_future()
+                self._waiters.append((loop, waiter))
+            await waiter
+
+    def release(self, endpoint, model=None, ok=None):
+        """Give the slot back and record how the prompt went: ok=True when
+            the host answered with model, ok=False when it could not be
+            reached, None when the prompt tells nothing about the host
+        """
+
+        now = time.monotonic()
+        with self._lock:
+            endpoint.outstanding -= 1
+            if ok:
+                endpoint.consecutive_failures = 0
+                endpoint.down_until = 0
+                if model:
+                    self._mark_loaded(endpoint, model, now)
+            elif ok is not None:
+                self._mark_down(endpoint, now)
+            waiters, self._waiters = self._waiters, []
+        # every waiter picks again, a host that went down may leave them
+        #  with no host at all
+        for loop, waiter in waiters:
+            try:
+                loop.call_soon_threadsafe(_wake, waiter)
+            except RuntimeError:
+                # loop closed
+                pass
+
+    def keep_alive_for(self, model):
+        """Seconds Ollama should keep model loaded after a prompt, -1 for
+            a pinned model
+        """
+
+        return -1 if model_name(model) in self.pinned else self.keep_alive
+
+    def pin(self, model):
+        with self._lock:
+            self.pinned.add(model_name(model))
+
+    def unpin(self, model):
+        with self._lock:
+            self.pinned.discard(model_name(model))
+
+    def _mark_loaded(self, endpoint, model, now):
+        keep_alive = self.keep_alive_for(model)
+        endpoint.loaded[model_name(model)] = float('inf') if keep_alive < 0 else now + keep_alive
+
+    def mark_loaded(self, endpoint, model):
+        with self._lock:
+            self._mark_loaded(endpoint, model, time.monotonic())
+
+    def mark_unloaded(self, endpoint, model):
+        with self._lock:
+            endpoint.loaded.pop(model_name(model), None)
+
+    def set_resident(self, endpoint, models):
+        """Replace what the router assumes endpoint has loaded with the
+            models Ollama reports as resident
+        """
+
+        now = time.monotonic()
+        with self._lock:
+            endpoint.loaded.clear()
+            for model in models:
+                self._mark_loaded(endpoint, model, now)
+
+    def record_load(self, endpoint, model, seconds):
+        """Count a model load that took seconds, returns True when it took
+            long enough to count as one, shorter ones were already loaded
+        """
+
+        if seconds < self.load_threshold:
+            return False
+        with self._lock:
+            loads = endpoint.model_loads.setdefault(model_name(model), [0, 0.0])
+            loads[0] += 1
+            loads[1] += seconds
+        return True
+
+    def _mark_down(self, endpoint, now):
+        endpoint.failures += 1
+        if not endpoint.is_up(now):
+            # prompts that were already running when it went down
+            return
+        endpoint.consecutive_failures += 1
+        cooldown = self.cooldown * 2 ** (endpoint.consecutive_failures - 1)
+        endpoint.down_until = now + min(cooldown, self.max_cooldown)
+        endpoint.loaded.clear()
+
+    async def is_available(self):
+        """True when any host answers, hosts in their cooldown are skipped
+            and a good check is trusted for health_check_ttl seconds
+        """
+
+        now = time.monotonic()
+        for endpoint in self.endpoints:
+            if not endpoint.is_up(now):
+                continue
+            if now < endpoint.checked_until:
+                return True
+            healthy = await asyncio.to_thread(check_endpoint_health, endpoint.url)
+            with self._lock:
+                if healthy:
+                    endpoint.checked_until = time.monotonic() + self.health_check_ttl
+                else:
+                    self._mark_down(endpoint, time.monotonic())
+            if healthy:
+                return True
+        return False
+
+    def stats(self):
+        """{endpoint name: stats}
+        """
+
+        with self._lock:
+            return {endpoint.name: endpoint.stats() for endpoint in self.endpoints}
+
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+def endpoints_from_config(config, default_url=None, default_concurrency=4):
+    """OllamaEndpoints from the [ollama:<name>] sections of setup.config,
+        or a single endpoint for default_url that serves every model
+    """
+
+    endpoints = []
+    for section in config.sections():
+        if not section.startswith(ENDPOINT_SECTION_PREFIX):
+            continue
+        models = [model.strip() for model in config.get(section, 'models', fallback='').split(',')]
+        endpoints.append(OllamaEndpoint(section[len(ENDPOINT_SECTION_PREFIX):],
+                                        config.get(section, 'url'),
+                                        [model for model in models if model and model != '*'],
+                                        config.getint(section, 'max_concurrency',
+                                                      fallback=default_concurrency)))
+    if not endpoints and default_url:
+        endpoints.append(OllamaEndpoint('default', default_url,
+                                        max_concurrency=default_concurrency))
+    return endpoints
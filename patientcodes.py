@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""Patient code items
+    ©2024, Ovais Quraishi
+
+    Every code extracted for a patient document is also stored as a row
+    of patient_code_items, next to the codes_document it came from in
+    patient_codes. Billing reads are then index scans on that table
+    instead of jsonb_array_elements over every codes_document.
+
+    Backfill the table from the codes documents stored before it
+    existed, documents that already have items are skipped:
+        > python patientcodes.py
+        > python patientcodes.py --batch-size 500
+"""
+
+import argparse
+import decimal
+import json
+import logging
+import re
+
+from database import insert_many_into_table
+from database import register_query
+from database import run_query
+
+# codes_document sections that hold codes, and the code system of each
+CODE_SECTIONS = {
+                 'icd': 'icd',
+                 'cpt': 'cpt',
+                 'hcpcs': 'hcpcs',
+                 'prescription_cpt': 'cpt',
+                 'prescription_hcpcs': 'hcpcs'
+                }
+
+AMOUNT_PATTERN = re.compile(r'\$\s*(\d[\d,]*(?:\.\d+)?)')
+
+def parse_reimbursement_range(rate_text):
+    """Lowest and highest dollar amount in an LLM reimbursement rate,
+        '$50 - $100 per visit' is (50, 100), '$75' is (75, 75), text
+        without dollar amounts is (None, None)
+    """
+
+    amounts = []
+    for amount in AMOUNT_PATTERN.findall(rate_text or ''):
+        try:
+            amounts.append(decimal.Decimal(amount.replace(',', '')))
+        except decimal.InvalidOperation:
+            continue
+    if not amounts:
+        return None, None
+    return min(amounts), max(amounts)
+
+def _as_dict(detail):
+    """Code details are dicts for icd codes and LLM JSON text for cpt and
+        hcpcs codes
+    """
+
+    if isinstance(detail, dict):
+        return detail
+    if isinstance(detail, str):
+        try:
+            detail = json.loads(detail)
+        except ValueError:
+            return {}
+        return detail if isinstance(detail, dict) else {}
+    return {}
+
+def code_item(source, code, detail):
+    """patient_code_items columns for one code, without the document keys
+    """
+
+    detail = _as_dict(detail)
+    item = {
+            'source': source,
+            'code_system': CODE_SECTIONS[source],
+            'code': code,
+            'billable': None,
+            'short_description': None,
+            'insurance_reimbursement_rate': None,
+            'insurance_reimbursement_min': None,
+            'insurance_reimbursement_max': None,
+            'provider_reimbursement_rate': None,
+            'provider_reimbursement_min': None,
+            'provider_reimbursement_max': None
+           }
+
+    if source == 'icd':
+        full_data = detail.get('full_data') or {}
+        guidelines = full_data.get('billing_guidelines') or {}
+        billable = detail.get('billable')
+        item['billable'] = billable if isinstance(billable, bool) else None
+        item['short_description'] = full_data.get('short_description')
+        for prefix, party in (('insurance', 'insurance_company'), ('provider', 'medical_provider')):
+            rate = (guidelines.get(party) or {}).get('reimbursement_rate')
+            if isinstance(rate, str) and rate:
+                low, high = parse_reimbursement_range(rate)
+                item.update({
+                             f'{prefix}_reimbursement_rate': rate,
+                             f'{prefix}_reimbursement_min': low,
+                             f'{prefix}_reimbursement_max': high
+                            })
+    else:
+        item['short_description'] = (detail.get('details') or {}).get('short_description')
+
+    return item
+
+def code_items(patient_id, patient_document_id, codes_document, timestamp):
+    """patient_code_items rows for a codes document, one per distinct code
+        of each section
+    """
+
+    rows = []
+    for source in CODE_SECTIONS:
+        section = codes_document.get(source) or {}
+        codes = section.get('codes') or []
+        details = section.get('details') or []
+        seen = set()
+        for position, code in enumerate(codes):
+            if code in seen:
+                continue
+            seen.add(code)
+            detail = details[position] if position < len(details) else None
+            row = {
+                   'timestamp': timestamp,
+                   'patient_id': patient_id,
+                   'patient_document_id': patient_document_id,
+                   'position': position
+                  }
+            row.update(code_item(source, code, detail))
+            rows.append(row)
+    return rows
+
+def store_code_items(patient_id, patient_document_id, codes_document, timestamp):
+    """Store the code items of a codes document, items already stored
+        are left alone
+    """
+
+    rows = code_items(patient_id, patient_document_id, codes_document, timestamp)
+    if not rows:
+        return 0
+    batches = insert_many_into_table('patient_code_items', rows)
+    return sum(batch['inserted'] for batch in batches)
+
+register_query('get_patient_codes_without_items',
+               """SELECT
+                        pc.id, pc.timestamp, pc.patient_id, pc.patient_document_id, pc.codes_document
+                  FROM
+                        patient_codes pc
+                  WHERE pc.id > %(last_id)s
+                        AND NOT EXISTS (SELECT 1
+                                        FROM patient_code_items pci
+                                        WHERE pci.patient_document_id = pc.patient_document_id)
+                  ORDER BY pc.id
+                  LIMIT %(batch_size)s;
+               """)
+
+def backfill(batch_size=1000):
+    """Store code items for every patient_codes row that has none yet,
+        batch_size documents at a time, returns counts
+    """
+
+    stats = {'documents': 0, 'items': 0}
+    last_id = 0
+    while True:
+        documents = run_query('get_patient_codes_without_items', {'last_id': last_id,
+                                                                  'batch_size': batch_size})
+        if not documents:
+            return stats
+        rows = []
+        for document in documents:
+            rows.extend(code_items(document['patient_id'], document['patient_document_id'],
+                                   document['codes_document'], document['timestamp']))
+        if rows:
+            stats['items'] += sum(batch['inserted']
+                                  for batch in insert_many_into_table('patient_code_items', rows))
+        stats['documents'] += len(documents)
+        last_id = documents[-1]['id']
+        logging.info('Backfilled %s documents, %s items', stats['documents'], stats['items'])
+
+def main():
+    """Backfill patient_code_items
+    """
+
+    parser = argparse.ArgumentParser(description='Backfill patient_code_items from patient_codes')
+    parser.add_argument('--batch-size', type=int, default=1000, help='documents per batch')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO) # init logging
+
+    print(json.dumps(backfill(args.batch_size)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""Staged, bounded-concurrency work pipeline
+    ©2024, Ovais Quraishi
+
+    Each stage has its own bounded queue and worker threads, so slow
+    stages (LLM prompts) and fast stages (database, decryption) overlap
+    instead of running one after another. A stage function takes one item
+    and returns an iterable of items for the next stage; returning an
+    empty iterable drops the item. A stage can also be keyed, in which
+    case every key gets its own queue and worker count, e.g. one queue
+    per LLM.
+
+    Stats count submitted items: an item is completed once everything it
+    fanned out into has gone through the last stage, and failed when any
+    of it failed or was dropped on the way. Per stage counts are of the
+    items each stage saw.
+
+    Example:
+        stages = [
+                  Stage('fetch', fetch_func, 2),
+                  Stage('diagnose', diagnose_func, {'medllama2': 2, 'meditron': 1},
+                        key=lambda item: item['llm']),
+                  Stage('persist', persist_func, 1)
+                 ]
+        stats = StagedPipeline(stages).run(visit_note_ids)
+"""
+
+import logging
+import queue
+import threading
+import time
+
+# marks the end of a stage's input
+_DONE = object()
+
+class _Submitted:
+    """Number of the items a submitted item became that are still in the
+        pipeline, and whether all of them went well so far
+    """
+
+    __slots__ = ('pending', 'ok')
+
+    def __init__(self):
+        self.pending = 1
+        self.ok = True
+
+class Stage:
+    """A pipeline stage
+
+        name: stage name, used in logs and stats
+        func: callable(item) -> iterable of items for the next stage
+        workers: worker count, or {key: worker count} for a keyed stage
+        key: callable(item) -> key, selects the queue of a keyed stage
+    """
+
+    def __init__(self, name, func, workers=1, key=None):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.key = key
+
+        if key is None and isinstance(workers, dict):
+            raise ValueError(f'Stage {name} has per-key workers but no key function')
+
+    def worker_counts(self):
+        """{queue key: worker count} for the stage
+        """
+
+        if self.key is None:
+            return {None: max(1, int(self.workers))}
+        return {k: max(1, int(v)) for k, v in self.workers.items()}
+
+class StagedPipeline:
+    """Run items through a list of stages, one failed item never stops
+        the run, it is logged and counted instead
+    """
+
+    def __init__(self, stages, queue_size=32, item_id=str):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.item_id = item_id
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+        self.stats = {}
+
+    def cancel(self):
+        """Stop feeding new items, items already queued are dropped
+        """
+
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        """True once cancel() has been called
+        """
+
+        return self._cancelled.is_set()
+
+    def _count(self, stage_name, outcome, item=None):
+        with self._lock:
+            stage_stats = self.stats['stages'].setdefault(stage_name,
+                                                          {'processed': 0, 'failed': 0,
+                                                           'dropped': 0})
+            stage_stats[outcome] += 1
+            if outcome == 'failed':
+                self.stats['failed_items'].append((stage_name, self.item_id(item)))
+
+    def _settle(self, submitted, items=1, ok=True, cancelled=False):
+        """items of submitted left the pipeline, it is completed or failed
+            once none of its items are left
+        """
+
+        with self._lock:
+            submitted.pending -= items
+            submitted.ok = submitted.ok and ok
+            if submitted.pending or cancelled:
+                return
+            self.stats['completed' if submitted.ok else 'failed'] += 1
+
+    def _route(self, stage_index, submitted, item):
+        """Put an item on the queue of the given stage
+        """
+
+        stage = self.stages[stage_index]
+        key = stage.key(item) if stage.key else None
+        stage_queue = self._queues[stage_index].get(key)
+        if stage_queue is None:
+            logging.error('Stage %s has no queue for %s, dropping %s',
+                          stage.name, key, self.item_id(item))
+            self._count(stage.name, 'failed', item)
+            self._settle(submitted, ok=False)
+            return
+        stage_queue.put((submitted, item))
+
+    def _worker(self, stage_index, stage_queue):
+        stage = self.stages[stage_index]
+        while True:
+            entry = stage_queue.get()
+            if entry is _DONE:
+                return
+            submitted, item = entry
+            if self._cancelled.is_set():
+                self._settle(submitted, cancelled=True)
+                continue
+            try:
+                results = stage.func(item)
+                if results is None or results is False:
+                    raise ValueError(f'stage {stage.name} returned no result')
+                results = list(results)
+            except Exception as e: # pylint: disable=broad-except
+                logging.error('Stage %s failed for %s: %s', stage.name, self.item_id(item), e)
+                self._count(stage.name, 'failed', item)
+                self._settle(submitted, ok=False)
+                continue
+
+            self._count(stage.name, 'processed')
+            if stage_index == len(self.stages) - 1:
+                self._settle(submitted)
+                continue
+            if not results:
+                logging.error('Stage %s dropped %s', stage.name, self.item_id(item))
+                self._count(stage.name, 'dropped')
+                self._settle(submitted, ok=False)
+                continue
+            # count the new items before any of them can finish
+            with self._lock:
+                submitted.pending += len(results)
+            for result in results:
+                self._route(stage_index + 1, submitted, result)
+            self._settle(submitted)
+
+    def run(self, items):
+        """Feed items into the first stage and wait for the pipeline to drain
+
+            Returns a stats dict, completed and failed count submitted
+            items, stages has item counts per stage.
+        """
+
+        started = time.monotonic()
+        self.stats = {
+                      'submitted': 0,
+                      'completed': 0,
+                      'failed': 0,
+                      'failed_items': [],
+                      'stages': {}
+                     }
+        self._queues = []
+        workers = []
+        for stage_index, stage in enumerate(self.stages):
+            stage_queues = {}
+            stage_workers = []
+            for key, count in stage.worker_counts().items():
+                stage_queue = queue.Queue(maxsize=self.queue_size)
+                stage_queues[key] = stage_queue
+                for n in range(count):
+                    name = f'{stage.name}-{key}-{n}' if key else f'{stage.name}-{n}'
+                    thread = threading.Thread(target=self._worker,
+                                              args=(stage_index, stage_queue),
+                                              name=name,
+                                              daemon=True)
+                    thread.start()
+                    stage_workers.append((stage_queue, thread))
+            self._queues.append(stage_queues)
+            workers.append(stage_workers)
+
+        for item in items:
+            if self._cancelled.is_set():
+                break
+            self.stats['submitted'] += 1
+            self._route(0, _Submitted(), item)
+
+        # shut stages down in order, a stage only gets its end markers
+        #  once every upstream worker has exited
+        for stage_workers in workers:
+            for stage_queue, _ in stage_workers:
+                stage_queue.put(_DONE)
+            for _, thread in stage_workers:
+                thread.join()
+
+        self.stats['cancelled'] = self._cancelled.is_set()
+        self.stats['elapsed_seconds'] = round(time.monotonic() - started, 3)
+        return self.stats
+
+def parse_worker_counts(value, names, default=1):
+    """Parse "name:count,name:count" into {name: count} for the given names,
+        names that are not listed get the default count
+    """
+
+    counts = {name: default for name in names}
+    for entry in filter(None, (part.strip() for part in (value or '').split(','))):
+        name, _, count = entry.rpartition(':')
+        if name in counts:
+            counts[name] = int(count)
+    return counts
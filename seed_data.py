@@ -10,9 +10,9 @@ from pathlib import Path
 import sys
 sys.path.insert(0, str(Path('../').resolve()))
 
-from database import insert_data_into_table
-from database import get_select_query_result_dicts
-from encryption import encrypt_text
+from database import insert_many_into_table
+from database import stream_query_rows
+from encryption import encrypt_many
 from utils import gen_internal_id, ts_int_to_dt_obj
 
 
@@ -21,19 +21,14 @@ def get_localities():
         this will be used to seed data
     """
 
-    localities = []
-
-    sql_query = """select
-                       codes_document ->> 'locality'
-                       as locality
+    sql_query = """select distinct
+                       locality
                    from
                        cpt_hcpcs_codes;
                 """
 
-    # list of dicts
-    dicts = get_select_query_result_dicts(sql_query)
-    # list of localities
-    localities = list(item['locality'] for item in dicts)
+    # list of localities, rows come back as plain tuples
+    localities = [row[0] for row in stream_query_rows(sql_query, row_type='tuple')]
     return localities
 
 def get_filenames(extension, directory):
@@ -81,23 +76,27 @@ def file_to_db(encrypt_analysis=False):
     dt = ts_int_to_dt_obj()
     pt_localities = get_localities()
     all_files = get_filenames('txt', 'MedData/Clean Transcripts')
+    patient_notes = []
     if all_files:
+        contents = []
         for a_file in all_files:
             print(a_file)
+            contents.append(read_file(a_file))
+        stored_contents = contents
+        if encrypt_analysis:
+            stored_contents = [text.decode('utf-8') for text in encrypt_many(contents)]
+        for content, stored_content in zip(contents, stored_contents):
             source = 'file'
             category = 'OSCE'
             patient_id = gen_internal_id()
-            content = read_file(a_file)
             content_sha512 = hashlib.sha512(str.encode(content)).hexdigest()
-            if encrypt_analysis:
-                content = encrypt_text(content).decode('utf-8')
             patient_note_document = {
                                 'schema_version' : '1',
                                 'source' : source,
                                 'category' : category,
                                 'patient_id' : patient_id,
                                 'locality' : random.choice(pt_localities),
-                                'note' : content.replace('\u0000','')
+                                'note' : stored_content.replace('\u0000','')
                                 }
             patient_note_data = {
                             'timestamp': dt,
@@ -105,6 +104,9 @@ def file_to_db(encrypt_analysis=False):
                             'patient_note_id' : content_sha512,
                             'patient_note' : json.dumps(patient_note_document)
                             }
-            insert_data_into_table('patient_notes', patient_note_data)
+            patient_notes.append(patient_note_data)
+        batches = insert_many_into_table('patient_notes', patient_notes)
+        print(sum(batch['inserted'] for batch in batches), 'notes inserted,',
+              sum(batch['skipped'] for batch in batches), 'already present')
 
 file_to_db(True)
@@ -7,7 +7,7 @@ import csv
 import json
 from utils import ts_int_to_dt_obj
 from utils import serialize_datetime
-from database import insert_data_into_table
+from database import insert_many_into_table
 
 class TabDelimitedDictReader(csv.DictReader):
     def __init__(self, f, fieldnames=None, restkey=None, restval=None, dialect="excel", *args, **kwds):
@@ -22,7 +22,7 @@ class TabDelimitedDictReader(csv.DictReader):
             self._fieldnames = [fieldname.strip() for fieldname in self._fieldnames]
         return self._fieldnames
 
-foo = []
+medicare_rows = []
 with open('medicare_locality_configuration.txt', 'r', newline='') as csvfile:
     reader = TabDelimitedDictReader(csvfile, delimiter='\t')
     for row in reader:
@@ -33,4 +33,5 @@ with open('medicare_locality_configuration.txt', 'r', newline='') as csvfile:
                          'fsa': row['Fee Schedule Area'],
                          'counties': row['Counties']
                         }
-        insert_data_into_table('medicare_data', medicare_data)
+        medicare_rows.append(medicare_data)
+insert_many_into_table('medicare_data', medicare_rows)
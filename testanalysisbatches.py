@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""Tests for phase by phase batch analysis, the database is stubbed out
+"""
+
+import contextlib
+import datetime
+import unittest
+from unittest import mock
+
+import analysisbatches
+from analysisbatches import AnalysisBatch
+from analysisbatches import run_bulk
+
+class FakeStore:
+    """Just enough of the analysis_batches tables for run_bulk
+    """
+
+    def __init__(self, open_batches=(), results=(), unanalyzed=()):
+        self.open_batches = list(open_batches)
+        self.results = list(results)
+        self.unanalyzed = list(unanalyzed)
+        self.phases = {}
+        self.stored = []
+
+    def run_query(self, name, params=None):
+        if name == 'get_open_analysis_batches':
+            return self.open_batches
+        if name == 'get_analysis_batch_results':
+            return [result for result in self.results if result['batch_id'] == params[0]]
+        if name == 'get_next_bulk_visit_notes':
+            rows, self.unanalyzed = self.unanalyzed[:params[1]], self.unanalyzed[params[1]:]
+            return [{'patient_note_id': visit_note_id} for visit_note_id in rows]
+        raise AssertionError(name)
+
+    def run_modify_query(self, name, params=None):
+        if name == 'set_analysis_batch_phase':
+            self.phases[params[2]] = params[0]
+        elif name == 'store_analysis_batch_result':
+            self.stored.append(params[:4])
+        return []
+
+class TestRunBulk(unittest.TestCase):
+
+    def run_bulk(self, store, phases, **kwargs):
+        lock = mock.MagicMock()
+        lock.return_value.__enter__.return_value = True
+        with mock.patch.object(analysisbatches, 'run_query', store.run_query), \
+             mock.patch.object(analysisbatches, 'run_modify_query', store.run_modify_query), \
+             mock.patch.object(analysisbatches, 'bulk_run_lock', lock):
+            return run_bulk(phases, **kwargs)
+
+    def test_phase_by_phase(self):
+        """Every note of a batch finishes a phase before the next phase,
+            batches are bounded by batch_size.
+        """
+
+        calls = []
+
+        def summarize(batch):
+            for visit_note_id in batch.pending('summarize'):
+                calls.append(('summarize', visit_note_id))
+                if visit_note_id != 'n2':
+                    batch.store('summarize', visit_note_id, {'analysis': 'summary'})
+
+        def diagnose(batch):
+            for llm in ['medllama2', 'meditron']:
+                for visit_note_id in batch.pending('diagnose', llm, 'summarize'):
+                    calls.append((llm, visit_note_id))
+                    batch.store('diagnose', visit_note_id, {'analysis': 'diagnosis'}, llm)
+
+        store = FakeStore(unanalyzed=['n1', 'n2', 'n3'])
+        stats = self.run_bulk(store, [('summarize', summarize), ('diagnose', diagnose)],
+                              batch_size=2)
+        self.assertEqual(calls, [('summarize', 'n1'), ('summarize', 'n2'),
+                                 ('medllama2', 'n1'), ('meditron', 'n1'),
+                                 ('summarize', 'n3'),
+                                 ('medllama2', 'n3'), ('meditron', 'n3')])
+        self.assertEqual(set(store.phases.values()), {'done'})
+        self.assertEqual((stats['batches'], stats['submitted'], stats['completed'], stats['failed']),
+                         (2, 3, 2, 1))
+
+    def test_resume(self):
+        """An open batch goes on at its phase with the results it stored,
+            timestamps come back as datetimes.
+        """
+
+        seen = []
+        store = FakeStore(open_batches=[{'batch_id': 'b1', 'phase': 'diagnose',
+                                         'visit_note_ids': ['n1']}],
+                          results=[{'batch_id': 'b1', 'patient_note_id': 'n1',
+                                    'phase': 'summarize', 'llm': '',
+                                    'result_document': {'timestamp': '2024-05-01T10:00:00+00:00',
+                                                        'analysis': 'summary'}}])
+
+        def summarize(batch):
+            raise AssertionError('summarize ran again')
+
+        def diagnose(batch):
+            seen.append(batch.result('summarize', 'n1'))
+            batch.store('diagnose', 'n1', {'analysis': 'diagnosis'}, 'meditron')
+
+        stats = self.run_bulk(store, [('summarize', summarize), ('diagnose', diagnose)],
+                              visit_note_ids=[])
+        self.assertIsInstance(seen[0]['timestamp'], datetime.datetime)
+        self.assertEqual(store.phases, {'b1': 'done'})
+        self.assertEqual(stats['completed'], 1)
+
+    def test_cancel_between_phases(self):
+        """A cancelled run stops between phases, the batch stays at the
+            phase it would have run next.
+        """
+
+        cancel = []
+
+        def summarize(batch):
+            cancel.append(True)
+
+        store = FakeStore()
+        stats = self.run_bulk(store, [('summarize', summarize), ('diagnose', summarize)],
+                              visit_note_ids=['n1', 'n2'], cancelled=lambda: bool(cancel))
+        self.assertTrue(stats['cancelled'])
+        self.assertEqual(list(store.phases.values()), ['diagnose'])
+        self.assertEqual(len(cancel), 1)
+
+    def test_pending(self):
+        """Pending notes are the ones without a result, of those that have
+            what the phase needs.
+        """
+
+        batch = AnalysisBatch('b1', 'diagnose', ['n1', 'n2', 'n3'],
+                              {('summarize', '', 'n1'): {}, ('summarize', '', 'n2'): {},
+                               ('diagnose', 'meditron', 'n1'): {}})
+        self.assertEqual(batch.pending('diagnose', 'meditron', 'summarize'), ['n2'])
+        self.assertEqual(batch.pending('diagnose', 'medllama2', 'summarize'), ['n1', 'n2'])
+        self.assertEqual(batch.pending('summarize'), ['n3'])
+
+class FakeLockConnection:
+    """Pooled connection that grants the advisory lock when free
+    """
+
+    def __init__(self, free):
+        self.free = free
+        self.closed = False
+        self.executed = []
+
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def execute(self, sql_query, params=None):
+        self.executed.append(sql_query.split('(')[0])
+
+    def fetchone(self):
+        return (self.free,)
+
+    def commit(self):
+        pass
+
+class TestBulkRunLock(unittest.TestCase):
+
+    def lock(self, conn):
+        with mock.patch.object(analysisbatches, 'db_connection',
+                               return_value=contextlib.nullcontext(conn)):
+            with analysisbatches.bulk_run_lock() as locked:
+                return locked
+
+    def test_released_before_return(self):
+        """A lock that was taken is released before the pooled connection
+            goes back, one that wasn't is left alone.
+        """
+
+        conn = FakeLockConnection(True)
+        self.assertTrue(self.lock(conn))
+        self.assertEqual(conn.executed, ['SELECT pg_try_advisory_lock',
+                                         'SELECT pg_advisory_unlock'])
+
+        conn = FakeLockConnection(False)
+        self.assertFalse(self.lock(conn))
+        self.assertEqual(conn.executed, ['SELECT pg_try_advisory_lock'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""Tests for the CMS fee schedule harvester, runs against a local
+    stand-in for the pfs.data.cms.gov datastore
+"""
+
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+from urllib.parse import parse_qs, urlparse
+
+import cms
+
+# code -> number of fee schedule records the stand-in returns
+FEE_SCHEDULES = {
+    '99213': 3,
+    '99214': 250, # more than one page
+    '0001U': 0
+}
+ORIGINAL_FEE_SCHEDULES = dict(FEE_SCHEDULES)
+# codes the stand-in fails with HTTP 500
+BROKEN_CODES = {'77777'}
+
+class DatastoreHandler(BaseHTTPRequestHandler):
+    """Minimal pfs.data.cms.gov datastore query endpoint"""
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        search = parse_qs(urlparse(self.path).query)['search'][0]
+        query = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.server.requests.append(search)
+
+        code = search.replace('hcpcsCheck', '').replace('pricing_single_', '')
+        if code in BROKEN_CODES:
+            self.send_response(500)
+            self.end_headers()
+            return
+
+        count = FEE_SCHEDULES.get(code, 0)
+        if search.startswith('hcpcsCheck'):
+            results = [{'hcpc': code, 'proc_stat': 'A'}] if code in FEE_SCHEDULES else []
+        else:
+            records = [{'hcpc': code, 'locality': f'{n:07d}', 'fac_price': '10.00'}
+                       for n in range(count)]
+            results = records[query['offset']:query['offset'] + query['limit']]
+
+        body = json.dumps({'results': results}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class TestFeeScheduleHarvester(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), DatastoreHandler)
+        cls.server.requests = []
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = f'http://127.0.0.1:{cls.server.server_port}/api/1/datastore/query'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+
+    def setUp(self):
+        self.server.requests.clear()
+        FEE_SCHEDULES.update(ORIGINAL_FEE_SCHEDULES)
+        self.table = [] # stand-in for cpt_hcpcs_codes
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.checkpoint_file = os.path.join(self.tmp_dir.name, 'cms.checkpoint.json')
+
+        def insert_many(table_name, rows):
+            # ON CONFLICT (sha256, first_snapshot_id) DO NOTHING
+            keys = {(row['sha256'], row['first_snapshot_id']) for row in self.table}
+            inserted = 0
+            for row in rows:
+                if (row['sha256'], row['first_snapshot_id']) not in keys:
+                    self.table.append(dict(row, id=len(self.table), retired_snapshot_id=None))
+                    inserted += 1
+            return [{'batch': 0, 'rows': len(rows), 'inserted': inserted,
+                     'skipped': len(rows) - inserted}]
+
+        def current_rows(hcpcs_codes):
+            return {row['sha256']: row['id'] for row in self.table
+                    if row['retired_snapshot_id'] is None
+                    and json.loads(row['codes_document'])['hcpc'] in hcpcs_codes}
+
+        def retire_rows(row_ids, snapshot_id):
+            for row_id in row_ids:
+                self.table[row_id]['retired_snapshot_id'] = snapshot_id
+            return len(row_ids)
+
+        for name, func in (('insert_many_into_table', insert_many),
+                           ('get_current_rows', current_rows),
+                           ('retire_rows', retire_rows)):
+            patcher = patch(f'cms.{name}', side_effect=func)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(self.tmp_dir.cleanup)
+
+    def harvester(self, snapshot_id=1, snapshot='2024Q1'):
+        return cms.FeeScheduleHarvester(base_url=self.base_url,
+                                        concurrency=3,
+                                        rate=0,
+                                        checkpoint_file=self.checkpoint_file,
+                                        flush_size=10,
+                                        retries=1,
+                                        snapshot_id=snapshot_id,
+                                        snapshot=snapshot)
+
+    def test_harvest(self):
+        """All pages of every code are stored and checkpointed."""
+
+        stats = asyncio.run(self.harvester().harvest(['99213', '99214', '0001U', '12345']))
+
+        self.assertEqual(stats['rows'], 253)
+        self.assertEqual(stats['no_data'], 1 + 1) # 0001U and the unknown 12345
+        self.assertEqual(stats['inserted'], 253)
+        self.assertEqual(len({row['sha256'] for row in self.table}), 253)
+
+        with open(self.checkpoint_file, encoding='utf-8') as afile:
+            done = set(json.load(afile)['done'])
+        self.assertEqual(done, {'99213', '99214', '0001U', '12345'})
+
+    def test_resume(self):
+        """Checkpointed and already ingested codes are not fetched again,
+            failed codes are not checkpointed."""
+
+        asyncio.run(self.harvester().harvest(['99213', '77777']))
+        self.assertNotIn('77777', cms.Checkpoint(self.checkpoint_file).done)
+
+        self.server.requests.clear()
+        stats = asyncio.run(self.harvester().harvest(['99213', '99214', '0001U'],
+                                                     skip_codes={'99214'}))
+        self.assertEqual(stats['skipped'], 2)
+        self.assertEqual(self.server.requests, ['hcpcsCheck0001U', 'pricing_single_0001U'])
+
+    def test_failed_code(self):
+        """A code that keeps failing is counted, the run carries on."""
+
+        stats = asyncio.run(self.harvester().harvest(['77777', '99213']))
+        self.assertEqual(stats['failed'], 1)
+        self.assertEqual(stats['rows'], 3)
+
+    def test_delta_refresh(self):
+        """A refresh into a new snapshot only writes what changed."""
+
+        asyncio.run(self.harvester().harvest(['99213', '99214']))
+
+        # next release: 99214 loses 50 localities, 99213 gains one
+        FEE_SCHEDULES.update({'99213': 4, '99214': 200})
+        os.remove(self.checkpoint_file)
+        stats = asyncio.run(self.harvester(2, '2024Q2').harvest(['99213', '99214']))
+
+        self.assertEqual(stats['inserted'], 1)
+        self.assertEqual(stats['unchanged'], 3 + 200)
+        self.assertEqual(stats['retired'], 50)
+        self.assertEqual(len(self.table), 254)
+        self.assertEqual(sum(1 for row in self.table if row['retired_snapshot_id'] is None), 204)
+        self.assertEqual([row['first_snapshot_id'] for row in self.table[253:]], [2])
+
+    def test_retired_rows_come_back(self):
+        """Rows retired in one snapshot and harvested again in a later one
+            are current again, under the later snapshot."""
+
+        asyncio.run(self.harvester().harvest(['99214']))
+        FEE_SCHEDULES['99214'] = 200
+        os.remove(self.checkpoint_file)
+        asyncio.run(self.harvester(2, '2024Q2').harvest(['99214']))
+
+        FEE_SCHEDULES['99214'] = 250
+        os.remove(self.checkpoint_file)
+        stats = asyncio.run(self.harvester(3, '2024Q3').harvest(['99214']))
+
+        self.assertEqual((stats['inserted'], stats['unchanged'], stats['retired']), (50, 200, 0))
+        current = [row for row in self.table if row['retired_snapshot_id'] is None]
+        self.assertEqual(len(current), 250)
+        self.assertEqual({row['sha256'] for row in current},
+                         {row['sha256'] for row in self.table[:250]})
+        self.assertEqual({row['first_snapshot_id'] for row in self.table[250:]}, {3})
+
+    def test_checkpoint_snapshot(self):
+        """A checkpoint is only resumed by a run for the same snapshot."""
+
+        asyncio.run(self.harvester().harvest(['99213']))
+        self.assertEqual(cms.Checkpoint(self.checkpoint_file, '2024Q1').done, {'99213'})
+        self.assertEqual(cms.Checkpoint(self.checkpoint_file, '2024Q2').done, set())
+
+if __name__ == '__main__':
+    unittest.main()
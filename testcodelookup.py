@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""Tests for batched cpt/hcpcs code lookups, the LLM is stubbed out
+"""
+
+import asyncio
+import json
+import unittest
+from unittest import mock
+
+import clincodeutils
+import codedetails
+import gptutils
+from codedetails import CodeDetailsDictionary
+from llmoutput import parse_code_batch
+
+def description(code_system, code, short_description='desc'):
+    return {code_system: code, 'details': {'short_description': short_description,
+                                           'long_description': ''}}
+
+class FakeStreamingClient:
+    """Streams reply in chunks of chunk_size, counts the chunks read
+    """
+
+    def __init__(self, reply, chunk_size=7):
+        self.chunks = [reply[i:i + chunk_size] for i in range(0, len(reply), chunk_size)]
+        self.read = 0
+
+    async def chat(self, **kwargs):
+        async def chunks():
+            for text in self.chunks:
+                self.read += 1
+                yield {'message': {'content': text}, 'done': False}
+        return chunks()
+
+class TestBatchedLookup(unittest.TestCase):
+
+    def test_parse_code_batch(self):
+        """Lists, bare arrays and single entries, keyed by upper case code."""
+
+        reply = json.dumps({'codes': [description('hcpcs', 'j1100'), description('hcpcs', '')]})
+        self.assertEqual(list(parse_code_batch(reply, 'hcpcs')), ['J1100'])
+        reply = json.dumps([description('cpt', '99213'), description('cpt', '99214')])
+        self.assertEqual(list(parse_code_batch(reply, 'cpt')), ['99213', '99214'])
+        self.assertEqual(list(parse_code_batch(json.dumps(description('cpt', '99213')), 'cpt')),
+                         ['99213'])
+
+    def test_bare_array_reply(self):
+        """A bare array reply is read up to its closing bracket, not cut
+            after its first object.
+        """
+
+        array = json.dumps([description('cpt', '99213'), description('cpt', '99214')])
+        client = FakeStreamingClient(array + ' These are the codes you asked for.')
+        analysis, _ = asyncio.run(gptutils.stream_chat(client, 'llama3.1', [], {},
+                                                       gptutils.json_value_closed()))
+        self.assertEqual(analysis, array)
+        self.assertEqual(list(parse_code_batch(analysis, 'cpt')), ['99213', '99214'])
+        self.assertLess(client.read, len(client.chunks))
+
+        # a single object reply still ends at its object, brackets in
+        #  text before it don't count
+        reply = 'Details [1]: ' + json.dumps(description('cpt', '99213'))
+        client = FakeStreamingClient(reply + ' [2] more text')
+        analysis, _ = asyncio.run(gptutils.stream_chat(client, 'llama3.1', [], {},
+                                                       gptutils.json_object_closed()))
+        self.assertEqual(analysis, reply)
+
+    def test_lookup_batched(self):
+        """Codes are asked for batch_size at a time, known codes are not."""
+
+        batches = []
+
+        async def fetch_batch(batch):
+            batches.append(batch)
+            return {code: description('cpt', code) for code in batch}
+
+        dictionary = CodeDetailsDictionary(persist=False)
+        codes = ['1', '2', '3', '2', '4', '5']
+        details = asyncio.run(dictionary.lookup_batched('cpt', codes, fetch_batch, 2))
+        self.assertEqual([detail['cpt'] for detail in details], codes)
+        self.assertEqual(batches, [['1', '2'], ['3', '4'], ['5']])
+
+        asyncio.run(dictionary.lookup_batched('cpt', ['5', '6'], fetch_batch, 2))
+        self.assertEqual(batches[-1], ['6'])
+        self.assertEqual(dictionary.stats()['llm_lookups'], 6)
+
+    def test_missing_codes_are_asked_again(self):
+        """Codes left out of a batch reply get a prompt of their own."""
+
+        batch_reply = {'analysis': json.dumps({'codes': [description('cpt', '99213'),
+                                                         description('cpt', '11111')]})}
+        prompt = mock.AsyncMock(return_value=batch_reply)
+        single = mock.AsyncMock(side_effect=lambda code: description('cpt', code, 'single'))
+
+        with mock.patch.object(clincodeutils, 'prompt_chat_stream', prompt), \
+             mock.patch.dict(clincodeutils.CODE_DETAIL_FETCHERS, {'cpt': single}):
+            details = asyncio.run(clincodeutils.fetch_code_details_batch_gpt('cpt', ['99213', '99214']))
+
+        self.assertEqual(prompt.await_count, 1)
+        self.assertIn('99213, 99214', prompt.await_args.args[1])
+        single.assert_awaited_once_with('99214')
+        self.assertEqual(details['99213']['details']['short_description'], 'desc')
+        self.assertEqual(details['99214']['details']['short_description'], 'single')
+
+    def test_icd_without_reply(self):
+        """An icd code whose billing guidelines prompt got no reply keeps
+            its index details and is marked incomplete, an unknown code
+            is not prompted for.
+        """
+
+        prompt = mock.AsyncMock(return_value=False)
+        with mock.patch.object(clincodeutils, 'prompt_chat_stream', prompt):
+            details = asyncio.run(clincodeutils.fetch_icd_details_gpt('J11.1'))
+            self.assertEqual((details['valid'], details['billable'], details['incomplete']),
+                             (True, True, True))
+            self.assertEqual(details['full_data']['billing_guidelines'],
+                             clincodeutils.BillingGuidelines().to_dict())
+
+            with mock.patch.object(clincodeutils.ICD10_RESOLVER, 'resolve', return_value=None):
+                details = asyncio.run(clincodeutils.fetch_icd_details_gpt('J11.1'))
+        self.assertEqual((details['code'], details['valid']), ('J11.1', False))
+        self.assertNotIn('incomplete', details)
+        self.assertEqual(prompt.await_count, 1)
+
+class TestCodeDetailsDictionary(unittest.TestCase):
+
+    def setUp(self):
+        # code -> details in the code_details table
+        self.table = {'1': description('cpt', '1', 'stored')}
+        self.queries = []
+        self.fetched = []
+
+        def run_query(name, params):
+            self.queries.append((name, params))
+            code_system, codes, prompt_version = params
+            return [{'code': code, 'details_document': {'details': self.table[code]}}
+                    for code in codes if code in self.table]
+
+        def insert_data_into_table(table, data):
+            self.table[data['code']] = json.loads(data['details_document'])['details']
+
+        for name, func in (('run_query', run_query),
+                           ('insert_data_into_table', insert_data_into_table)):
+            patcher = mock.patch.object(codedetails, name, func)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.dictionary = CodeDetailsDictionary(persist=True)
+
+    async def fetch_batch(self, batch):
+        self.fetched.append(batch)
+        return {code: dict(description('cpt', code, 'llm'), incomplete=code == '3')
+                for code in batch}
+
+    def lookup(self, codes):
+        details = asyncio.run(self.dictionary.lookup_batched('cpt', codes, self.fetch_batch, 10))
+        return [detail['details']['short_description'] for detail in details]
+
+    def test_hits_and_misses(self):
+        """Codes the table has are read with one query, the rest go to the
+            LLM and are stored, known codes are served from memory.
+        """
+
+        self.assertEqual(self.lookup(['1', '2', '1']), ['stored', 'llm', 'stored'])
+        self.assertEqual(self.queries, [('get_many_code_details',
+                                         ('cpt', ['1', '2'], codedetails.CODE_PROMPT_VERSIONS['cpt']))])
+        self.assertEqual(self.fetched, [['2']])
+        self.assertIn('2', self.table)
+
+        self.assertEqual(self.lookup(['2', '1']), ['llm', 'stored'])
+        self.assertEqual(len(self.queries), 1)
+        stats = self.dictionary.stats()
+        self.assertEqual((stats['memory_hits'], stats['db_hits'], stats['llm_lookups']), (2, 1, 1))
+
+    def test_incomplete_details_are_not_kept(self):
+        """A reply that could not be read is returned, not stored, and
+            asked for again.
+        """
+
+        self.assertEqual(self.lookup(['3']), ['llm'])
+        self.assertNotIn('3', self.table)
+        self.assertEqual(self.lookup(['3']), ['llm'])
+        self.assertEqual(self.fetched, [['3'], ['3']])
+        self.assertEqual(self.dictionary.stats()['memory_entries'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
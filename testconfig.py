@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""Tests for the shared, self reloading config in config.py
+"""
+
+import os
+import tempfile
+import unittest
+
+import config
+
+class TestConfig(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.file_path = os.path.join(tmp_dir.name, 'setup.config')
+        self.write("LLMS=llama3, gemma ,\nPATIENT_DATA_ENCRYPTION_ENABLED=True\n", 1)
+        self.config = config.Config(self.file_path, check_interval=0)
+
+    def write(self, service, mtime):
+        with open(self.file_path, 'w', encoding='utf-8') as afile:
+            afile.write(f'[service]\n{service}')
+        os.utime(self.file_path, ns=(mtime, mtime))
+
+    def test_typed_accessors(self):
+        """Lists are split and stripped, booleans parsed."""
+
+        self.assertEqual(self.config.llms, ['llama3', 'gemma'])
+        self.assertTrue(self.config.patient_data_encryption_enabled)
+        self.assertEqual(self.config.getlist('service', 'NONE', fallback=[]), [])
+        self.assertEqual(self.config.get('service', 'LLMS'), 'llama3, gemma ,')
+        self.assertIn('service', self.config)
+
+    def test_reload(self):
+        """The file is parsed again only when its mtime changes or a
+            reload is requested, a broken file keeps the last config.
+        """
+
+        reloads = []
+        self.config.on_reload(reloads.append)
+        parser = self.config.parser
+        self.assertIs(self.config.parser, parser)
+
+        self.write('LLMS=mistral\n', 2)
+        self.assertEqual(self.config.llms, ['mistral'])
+        self.assertEqual(len(reloads), 1)
+
+        self.config.request_reload()
+        self.assertEqual(self.config.llms, ['mistral'])
+        self.assertEqual(len(reloads), 2)
+
+        self.write('LLMS\n[broken', 3)
+        self.assertEqual(self.config.llms, ['mistral'])
+
+    def test_get_config_is_shared(self):
+        """get_config() parses setup.config once per process."""
+
+        self.assertIs(config.get_config(), config.get_config())
+
+if __name__ == '__main__':
+    unittest.main()
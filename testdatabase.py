@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""Tests for the registered query layer and row streaming in
+    database.py, runs against stand-in cursors, no PostgreSQL server needed
+"""
+
+import contextlib
+import os
+import threading
+import unittest
+from unittest import mock
+
+import psycopg2.extensions
+import psycopg2.pool
+
+import database
+
+class FakeConnection:
+    def __init__(self):
+        self.prepared = set()
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.executed = []
+
+    def execute(self, sql_query, params=None):
+        self.executed.append((sql_query, params))
+
+class FakeNamedCursor:
+    """Server-side cursor over rows, counts the rows it has handed out
+    """
+
+    def __init__(self, name, rows):
+        self.name = name
+        self.rows = rows
+        self.fetched = 0
+        self.itersize = None
+        self.description = None
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.closed = True
+
+    def execute(self, sql_query, params=None):
+        pass
+
+    def fetchmany(self, size):
+        self.description = (('id',), ('code',))
+        rows = self.rows[self.fetched:self.fetched + size]
+        self.fetched += len(rows)
+        return rows
+
+class FakePooledConnection:
+    def __init__(self, number):
+        self.number = number
+        self.closed = False
+        self.info = mock.Mock(transaction_status=psycopg2.extensions.TRANSACTION_STATUS_IDLE)
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+class FakeThreadedPool(psycopg2.pool.ThreadedConnectionPool):
+    """ThreadedConnectionPool whose connections are FakePooledConnections
+    """
+
+    opened = []
+
+    def _connect(self, key=None):
+        conn = FakePooledConnection(len(self.opened))
+        self.opened.append(conn)
+        if key is not None:
+            self._used[key] = conn
+            self._rused[id(conn)] = key
+        else:
+            self._pool.append(conn)
+        return conn
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        FakeThreadedPool.opened = []
+        config = {'psqldb': {'host': 'db', 'pool_minconn': '1', 'pool_maxconn': '2'}}
+        for target, attribute, value in ((database, 'get_config', lambda: config),
+                                         (database.psycopg2.pool, 'ThreadedConnectionPool',
+                                          FakeThreadedPool)):
+            patcher = mock.patch.object(target, attribute, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.pool = database.ConnectionPool()
+
+    def test_getconn_putconn(self):
+        """A connection goes back to the pool and is handed out again,
+            callers wait for a free connection.
+        """
+
+        with self.pool.connection() as first:
+            pass
+        with self.pool.connection() as again:
+            self.assertIs(again, first)
+            with self.pool.connection() as second:
+                self.assertIsNot(second, first)
+        self.assertEqual(len(FakeThreadedPool.opened), 2)
+        # beyond pool_minconn idle connections are closed, the first one
+        #  back is kept
+        self.assertEqual([conn.closed for conn in FakeThreadedPool.opened], [True, False])
+
+        with self.pool.connection(), self.pool.connection():
+            waiting = threading.Thread(target=lambda: self.pool.connection().__enter__())
+            waiting.start()
+            waiting.join(0.1)
+            self.assertTrue(waiting.is_alive())
+        waiting.join(1)
+        self.assertFalse(waiting.is_alive())
+
+    def test_fork(self):
+        """A forked child opens its own connections and never closes the
+            ones it inherited.
+        """
+
+        checkout = self.pool.connection()
+        parent_conn = checkout.__enter__()
+        with self.pool.connection() as idle_conn:
+            pass
+
+        # the child goes on with the checked out connection, then uses and
+        #  closes its own pool
+        with mock.patch.object(database.os, 'getpid', return_value=os.getpid() + 1):
+            with mock.patch.object(parent_conn, 'rollback') as rollback:
+                checkout.__exit__(None, None, None)
+            rollback.assert_not_called()
+            with self.pool.connection() as child_conn:
+                self.assertNotIn(child_conn, (idle_conn, parent_conn))
+            self.pool.close()
+        self.assertFalse(idle_conn.closed or parent_conn.closed)
+        self.assertTrue(child_conn.closed)
+        self.assertEqual(self.pool._inherited, [idle_conn, parent_conn])
+
+class TestRegisteredQueries(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(database.QUERIES.pop, 'test_named', None)
+        self.addCleanup(database.QUERIES.pop, 'test_positional', None)
+
+    def test_register_query(self):
+        """Placeholders become $n, a repeated name reuses its number."""
+
+        database.register_query('test_named',
+                                """SELECT 1 FROM t WHERE (%(a)s IS NULL OR a = %(a)s)
+                                   AND b = %(b)s AND c LIKE 'x%%';""",
+                                types=('text', 'int'))
+        query = database.QUERIES['test_named']
+        self.assertEqual(query['params'], ['a', 'b'])
+        self.assertIn('($1 IS NULL OR a = $1)', query['statement'])
+        self.assertIn("b = $2 AND c LIKE 'x%'", query['statement'])
+        self.assertFalse(query['statement'].endswith(';'))
+
+        # registering the same SQL again is fine, different SQL is not
+        database.register_query('test_named',
+                                """SELECT 1 FROM t WHERE (%(a)s IS NULL OR a = %(a)s)
+                                   AND b = %(b)s AND c LIKE 'x%%';""",
+                                types=('text', 'int'))
+        with self.assertRaises(ValueError):
+            database.register_query('test_named', 'SELECT 2;')
+        with self.assertRaises(ValueError):
+            database.register_query('test_positional', 'SELECT %s, %(a)s;')
+
+    def test_execute_prepared(self):
+        """A query is prepared once per connection, then only executed."""
+
+        database.register_query('test_positional', 'SELECT * FROM t WHERE a = %s AND b = %s;')
+        cursor = FakeCursor(FakeConnection())
+
+        database.execute_prepared(cursor, 'test_positional', ('x', 1))
+        database.execute_prepared(cursor, 'test_positional', ('y', 2))
+        self.assertEqual(cursor.executed, [
+            ('PREPARE test_positional AS SELECT * FROM t WHERE a = $1 AND b = $2', None),
+            ('EXECUTE test_positional (%s, %s)', ['x', 1]),
+            ('EXECUTE test_positional (%s, %s)', ['y', 2])
+        ])
+
+        other_cursor = FakeCursor(FakeConnection())
+        database.execute_prepared(other_cursor, 'test_positional', ('z', 3))
+        self.assertTrue(other_cursor.executed[0][0].startswith('PREPARE'))
+
+        with self.assertRaises(ValueError):
+            database.execute_prepared(cursor, 'test_positional', ('x',))
+
+class TestStreamQueryRows(unittest.TestCase):
+
+    def setUp(self):
+        self.cursors = []
+        rows = [(n, f'code{n}') for n in range(10)]
+
+        def cursor(name=None):
+            self.cursors.append(FakeNamedCursor(name, rows))
+            return self.cursors[-1]
+
+        connection = mock.Mock(cursor=cursor)
+        patcher = mock.patch.object(database, 'db_connection',
+                                    lambda: contextlib.nullcontext(connection))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_rows_are_fetched_lazily(self):
+        """Rows are fetched itersize at a time on a named cursor."""
+
+        rows = database.stream_query_rows('SELECT id, code FROM t;', itersize=3)
+        self.assertEqual(next(rows), {'id': 0, 'code': 'code0'})
+        cursor = self.cursors[0]
+        self.assertTrue(cursor.name.startswith('stream_'))
+        self.assertEqual(cursor.itersize, 3)
+        self.assertEqual(cursor.fetched, 3)
+
+        rows.close()
+        self.assertTrue(cursor.closed)
+
+    def test_row_types_and_batches(self):
+        """Tuples, namedtuples and batches of rows."""
+
+        self.assertEqual(list(database.stream_query_rows('SELECT 1;', row_type='tuple'))[9],
+                         (9, 'code9'))
+        row = next(database.stream_query_rows('SELECT 1;', row_type='namedtuple'))
+        self.assertEqual((row.id, row.code), (0, 'code0'))
+        self.assertFalse(hasattr(row, '__dict__'))
+
+        batches = list(database.stream_query_rows('SELECT 1;', batch_size=4, row_type='tuple'))
+        self.assertEqual([len(batch) for batch in batches], [4, 4, 2])
+
+        with self.assertRaises(ValueError):
+            next(database.stream_query_rows('SELECT 1;', row_type='record'))
+
+class TestInsertMany(unittest.TestCase):
+
+    def setUp(self):
+        self.statements = []
+        connection = mock.MagicMock()
+        patcher = mock.patch.object(database, 'db_connection',
+                                    lambda: contextlib.nullcontext(connection))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        existing = {'a', 'b'}
+
+        def execute_values(cur, sql_query, batch, page_size, fetch):
+            # a row that exists is updated with DO UPDATE, left alone
+            #  with DO NOTHING
+            self.statements.append(sql_query)
+            update = 'DO UPDATE' in sql_query
+            return [(code not in existing,) for code, _ in batch
+                    if update or code not in existing]
+
+        patcher = mock.patch.object(database.psycopg2.extras, 'execute_values', execute_values)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_counts(self):
+        """Inserted, updated and skipped rows are counted apart."""
+
+        rows = [{'code': code, 'description': code.upper()} for code in 'abcde']
+        batches = database.insert_many_into_table('codes', rows, on_conflict='update',
+                                                  conflict_target='code', batch_size=3)
+        self.assertEqual(batches, [{'batch': 0, 'rows': 3, 'inserted': 1, 'updated': 2, 'skipped': 0},
+                                   {'batch': 1, 'rows': 2, 'inserted': 2, 'updated': 0, 'skipped': 0}])
+        self.assertIn('ON CONFLICT (code) DO UPDATE SET description = EXCLUDED.description',
+                      self.statements[0])
+        self.assertIn('RETURNING (xmax = 0)', self.statements[0])
+
+        batches = database.insert_many_into_table('codes', rows)
+        self.assertEqual(batches, [{'batch': 0, 'rows': 5, 'inserted': 3, 'updated': 0, 'skipped': 2}])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""Tests for encryption.py, runs against a throwaway key
+"""
+
+import os
+import tempfile
+import unittest
+
+from cryptography.fernet import Fernet
+from cryptography.fernet import InvalidToken
+
+import encryption
+
+class TestEncryption(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.key_file = os.path.join(tmp_dir.name, 'test.key')
+        self.write_key()
+
+        key_setting = encryption.CONFIG.get('service', 'ENCRYPTION_KEY', fallback='')
+        encryption.CONFIG.set('service', 'ENCRYPTION_KEY', self.key_file)
+        self.addCleanup(encryption.CONFIG.set, 'service', 'ENCRYPTION_KEY', key_setting)
+        encryption.reload_key()
+        self.addCleanup(setattr, encryption, '_CIPHER', None)
+
+    def write_key(self):
+        with open(self.key_file, 'wb') as afile:
+            afile.write(Fernet.generate_key())
+
+    def test_cipher_is_cached_until_reload(self):
+        """The key file is read once, reload_key() picks up a new key."""
+
+        token = encryption.encrypt_text('visit note')
+        self.write_key()
+        self.assertIs(encryption.get_cipher(), encryption.get_cipher())
+        self.assertEqual(encryption.decrypt_text(token), 'visit note')
+
+        encryption.reload_key()
+        with self.assertRaises(InvalidToken):
+            encryption.decrypt_text(token)
+
+    def test_many(self):
+        """Batches round trip in order, threaded or not."""
+
+        texts = [f'note {n}' for n in range(50)]
+        for workers in (1, 4):
+            tokens = encryption.encrypt_many(texts, workers=workers)
+            self.assertEqual([encryption.decrypt_text(token) for token in tokens], texts)
+            self.assertEqual(encryption.decrypt_many(tokens, workers=workers), texts)
+        self.assertEqual(encryption.encrypt_many([]), [])
+
+if __name__ == '__main__':
+    unittest.main()
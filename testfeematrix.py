@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""Tests for the fee schedule price matrix, built from in-memory price
+    rows into a temporary directory
+"""
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+import feematrix
+
+def price_rows(price=10.0):
+    rows = []
+    for code in ('99213', '99214'):
+        for locality in ('0111205', '0211201'):
+            for modifier in ('', '26'):
+                rows.append({
+                             'hcpc': code,
+                             'locality': locality,
+                             'modifier': modifier or None,
+                             'sdesc': f'Office visit {code}',
+                             'fac_price': price,
+                             'nfac_price': price + 1,
+                             'fac_limiting_charge': price + 2,
+                             'nfac_limiting_charge': None
+                            })
+        price += 100
+    return rows
+
+class TestFeeMatrix(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.write(price_rows(), snapshot='2024Q1')
+        self.matrix = feematrix.FeeMatrix(self.tmp_dir.name)
+
+    def write(self, rows, snapshot):
+        prices, index = feematrix.build_matrix(rows)
+        index['snapshot'] = snapshot
+        return feematrix.write_matrix(self.tmp_dir.name, prices, index)
+
+    def test_build(self):
+        """Every code, locality and modifier gets a cell."""
+
+        prices, index = feematrix.build_matrix(price_rows())
+        self.assertEqual(prices.shape, (2, 2, 2, len(feematrix.PRICE_COLUMNS)))
+        self.assertEqual(index['modifiers'], ['', '26'])
+        self.assertTrue(np.isnan(prices[..., 3]).all())
+
+    def test_lookup(self):
+        """Unknown codes, localities and modifiers come back as NaN."""
+
+        result = self.matrix.lookup(['99214', '99213', '00000', '99213'],
+                                    ['0111205', '0211201', '0111205', '9999999'],
+                                    ['26', None, '', ''])
+        self.assertEqual(result[:2, 0].tolist(), [110.0, 10.0])
+        self.assertTrue(np.isnan(result[2:]).all())
+
+    def test_price_claim(self):
+        """Totals only add up the lines that could be priced."""
+
+        claim = self.matrix.price_claim(['99213', '99214', '00000'], '0111205')
+        self.assertEqual(claim['snapshot'], '2024Q1')
+        self.assertEqual(claim['totals']['fac_price'], 120.0)
+        self.assertEqual(claim['totals']['nfac_limiting_charge'], 0.0)
+        self.assertEqual(claim['unpriced'], ['00000'])
+        self.assertEqual(claim['lines'][0]['short_description'], 'Office visit 99213')
+        self.assertIsNone(claim['lines'][0]['nfac_limiting_charge'])
+
+    def test_reload(self):
+        """A rebuilt matrix is picked up, the old prices file is removed."""
+
+        self.assertEqual(self.matrix.snapshot, '2024Q1')
+        index = self.write(price_rows(price=20.0), snapshot='2024Q2')
+
+        self.assertEqual(self.matrix.snapshot, '2024Q2')
+        self.assertEqual(self.matrix.lookup(['99213'], '0111205')[0, 0], 20.0)
+        self.assertEqual([name for name in os.listdir(self.tmp_dir.name) if name.endswith('.npy')],
+                         [index['prices_file']])
+
+if __name__ == '__main__':
+    unittest.main()
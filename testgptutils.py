@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""Tests for streamed prompts, prompt graphs and pooled Ollama clients
+    in gptutils.py, no Ollama server needed
+"""
+
+import asyncio
+import hashlib
+import threading
+import unittest
+
+import gptutils
+from gptutils import StreamSanitizer
+from normalize import BOILERPLATE_PHRASES
+from normalize import strip_boilerplate
+
+REPLY = (f'{BOILERPLATE_PHRASES[0]} the patient most likely has {BOILERPLATE_PHRASES[3]} '
+         'influenza. {"icd": "J11.1", "note": "a } in a string"} Anything else?')
+
+def chunked(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+class FakeStreamingClient:
+    """Streams reply in chunks of chunk_size, counts the chunks read and
+        whether the stream was closed
+    """
+
+    def __init__(self, reply, chunk_size):
+        self.chunks = chunked(reply, chunk_size)
+        self.read = 0
+        self.closed = False
+
+    async def chat(self, **kwargs):
+        async def chunks():
+            try:
+                for number, text in enumerate(self.chunks, 1):
+                    self.read += 1
+                    yield {'message': {'content': text}, 'done': number == len(self.chunks)}
+            finally:
+                self.closed = True
+        return chunks()
+
+class TestStreaming(unittest.TestCase):
+
+    def stream(self, client, stop_when=None):
+        return asyncio.run(gptutils.stream_chat(client, 'llama3.1', [], {}, stop_when))
+
+    def test_sanitizer_split_chunks(self):
+        """Phrases split over chunks are stripped like in the whole text."""
+
+        self.assertNotIn(BOILERPLATE_PHRASES[3], strip_boilerplate(REPLY))
+        for size in (1, 5, 17, len(REPLY)):
+            sanitizer = StreamSanitizer()
+            text = ''.join(sanitizer.feed(chunk) for chunk in chunked(REPLY, size))
+            self.assertEqual(text + sanitizer.flush(), strip_boilerplate(REPLY), size)
+
+    def test_hash_matches_whole_reply(self):
+        """The incremental sha512 is the one of the sanitized whole reply."""
+
+        for size in (1, 3, 64):
+            analysis, analysis_sha512 = self.stream(FakeStreamingClient(REPLY, size))
+            self.assertEqual(analysis, strip_boilerplate(REPLY))
+            self.assertEqual(analysis_sha512, hashlib.sha512(str.encode(analysis)).hexdigest())
+
+    def test_early_stop(self):
+        """The reply ends where the JSON object closes, the rest is not
+            read and the stream is closed.
+        """
+
+        client = FakeStreamingClient(REPLY, 4)
+        analysis, analysis_sha512 = self.stream(client, gptutils.json_object_closed())
+        self.assertTrue(analysis.endswith('"note": "a } in a string"}'))
+        self.assertLess(client.read, len(client.chunks))
+        self.assertTrue(client.closed)
+        self.assertEqual(analysis_sha512, hashlib.sha512(str.encode(analysis)).hexdigest())
+
+    def test_stop_when_needs_stream(self):
+        """stop_when on a prompt that isn't streamed is an error."""
+
+        with self.assertRaises(ValueError):
+            asyncio.run(gptutils.prompt_chat('llama3.1', 'note', False,
+                                             stop_when=gptutils.json_object_closed()))
+
+class TestRunPromptGraph(unittest.TestCase):
+
+    def setUp(self):
+        self.events = []
+        self.running = 0
+        self.max_running = 0
+
+    def stage(self, name, delay=0.01, error=None):
+        async def stage_func(dep_results):
+            self.events.append(('start', name, sorted(dep_results)))
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+            try:
+                await asyncio.sleep(delay)
+                if error is not None:
+                    raise error
+            finally:
+                self.running -= 1
+            self.events.append(('end', name))
+            return name.upper()
+        return stage_func
+
+    def test_stage_order(self):
+        """A stage starts once its dependencies end, with their results,
+            independent stages run at the same time.
+        """
+
+        stages = {
+                  'diagnosis': ((), self.stage('diagnosis', 0.02)),
+                  'icd': (('diagnosis',), self.stage('icd')),
+                  'icd_details': (('icd', 'diagnosis'), self.stage('icd_details')),
+                  'prescription': ((), self.stage('prescription'))
+                 }
+        results = asyncio.run(gptutils.run_prompt_graph(stages))
+        self.assertEqual(results, {name: name.upper() for name in stages})
+        self.assertEqual(self.events[:2], [('start', 'diagnosis', []),
+                                           ('start', 'prescription', [])])
+        self.assertLess(self.events.index(('end', 'diagnosis')),
+                        self.events.index(('start', 'icd', ['diagnosis'])))
+        self.assertLess(self.events.index(('end', 'icd')),
+                        self.events.index(('start', 'icd_details', ['diagnosis', 'icd'])))
+        self.assertEqual(self.max_running, 2)
+
+        with self.assertRaises(ValueError):
+            asyncio.run(gptutils.run_prompt_graph({'a': (('b',), self.stage('a')),
+                                                   'b': (('a',), self.stage('b'))}))
+
+    def test_max_concurrency(self):
+        """No more than max_concurrency stages run at once."""
+
+        stages = {f'stage{n}': ((), self.stage(f'stage{n}')) for n in range(6)}
+        results = asyncio.run(gptutils.run_prompt_graph(stages, max_concurrency=2))
+        self.assertEqual(len(results), 6)
+        self.assertEqual(self.max_running, 2)
+
+    def test_failure_leaves_siblings_running(self):
+        """A failing stage fails its dependents, its siblings finish, then
+            the failure is raised.
+        """
+
+        stages = {
+                  'icd': ((), self.stage('icd', 0.01, RuntimeError('icd failed'))),
+                  'icd_details': (('icd',), self.stage('icd_details')),
+                  'cpt': ((), self.stage('cpt', 0.05))
+                 }
+        with self.assertRaisesRegex(RuntimeError, 'icd failed'):
+            asyncio.run(gptutils.run_prompt_graph(stages))
+        self.assertIn(('end', 'cpt'), self.events)
+        self.assertNotIn('icd_details', [event[1] for event in self.events])
+
+class TestOllamaClientManager(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = gptutils.OllamaClientManager('http://127.0.0.1:1', 4, 2, 30)
+        self.addCleanup(self.manager.shutdown)
+
+    async def client(self, host=None):
+        return self.manager.get_client(host)
+
+    def test_client_per_loop_and_host(self):
+        """A loop gets one client per host, another loop its own."""
+
+        async def clients():
+            return [await self.client(), await self.client(), await self.client('http://b:1')]
+
+        first, again, other_host = asyncio.run(clients())
+        self.assertIs(first, again)
+        self.assertIsNot(first, other_host)
+        self.assertIsNot(asyncio.run(self.client()), first)
+
+    def test_run_reuses_background_loop(self):
+        """run() from any thread uses the shared loop and its client."""
+
+        clients = [self.manager.run(self.client())]
+        threads = [threading.Thread(target=lambda: clients.append(self.manager.run(self.client())))
+                   for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(clients), 4)
+        self.assertEqual(len({id(client) for client in clients}), 1)
+
+        async def nested():
+            return self.manager.run(self.client())
+
+        with self.assertRaises(RuntimeError):
+            self.manager.run(nested())
+
+    def test_shutdown_closes_clients(self):
+        """aclose() closes the clients of its own loop, shutdown() those of
+            the background loop and stops it, run() starts a new one.
+        """
+
+        async def close_own():
+            client = await self.client()
+            await self.manager.aclose()
+            return client
+
+        self.assertTrue(asyncio.run(close_own())._client.is_closed)
+
+        client = self.manager.run(self.client())
+        loop_thread = self.manager._loop_thread
+        self.assertFalse(client._client.is_closed)
+        self.manager.shutdown()
+        self.assertTrue(client._client.is_closed)
+        self.assertFalse(loop_thread.is_alive())
+        self.assertIsNot(self.manager.run(self.client()), client)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,14 +1,16 @@
 #!/usr/bin/env python3
 
+import datetime
 import unittest
 import json
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, PropertyMock
 
 from config import get_config
 CONFIG = get_config()
 SRVC_SHARED_SECRET=CONFIG.get('service', 'SRVC_SHARED_SECRET')
 
 # Import the Flask app
+import zollama
 from zollama import app
 
 class TestFlaskApp(unittest.TestCase):
@@ -67,12 +69,12 @@ class TestFlaskApp(unittest.TestCase):
         data = json.loads(response.data)
         self.assertIn('access_token', data)
 
-    @patch('zollama.analyze_visit_notes')
-    def test_analyze_visit_notes_endpoint(self, mock_analyze_visit_notes):
+    @patch('zollama.submit_analysis_job')
+    def test_analyze_visit_notes_endpoint(self, mock_submit_analysis_job):
         """Test /analyze_visit_notes endpoint."""
 
-        # Mock the analyze_visit_notes function
-        mock_analyze_visit_notes.return_value = True
+        # Mock the job queue
+        mock_submit_analysis_job.return_value = 'job1'
 
         # Define headers with JWT token
         headers = {
@@ -82,19 +84,21 @@ class TestFlaskApp(unittest.TestCase):
         # Send GET request to /analyze_visit_notes endpoint with headers
         response = self.app.get('/analyze_visit_notes', headers=headers)
 
-        # Check if response status code is 200 OK
-        self.assertEqual(response.status_code, 200)
+        # Check if response status code is 202 Accepted
+        self.assertEqual(response.status_code, 202)
 
-        # Check if response contains expected message
+        # Check if response contains expected message and job id
         data = json.loads(response.data)
         self.assertEqual(data['message'], 'analyze_visit_notes endpoint')
+        self.assertEqual(data['job_id'], 'job1')
+        mock_submit_analysis_job.assert_called_once_with('analyze_visit_notes')
 
-    @patch('zollama.analyze_visit_note')
-    def test_analyze_visit_note_endpoint(self, mock_analyze_visit_note):
+    @patch('zollama.submit_analysis_job')
+    def test_analyze_visit_note_endpoint(self, mock_submit_analysis_job):
         """Test /analyze_visit_note endpoint."""
 
-        # Mock the analyze_visit_note function
-        mock_analyze_visit_note.return_value = True
+        # Mock the job queue
+        mock_submit_analysis_job.return_value = 'job2'
 
         # Define headers with JWT token
         headers = {
@@ -104,12 +108,150 @@ class TestFlaskApp(unittest.TestCase):
         # Send GET request to /analyze_visit_note endpoint with visit_note_id parameter
         response = self.app.get('/analyze_visit_note?visit_note_id=1', headers=headers)
 
-        # Check if response status code is 200 OK
-        self.assertEqual(response.status_code, 200)
+        # Check if response status code is 202 Accepted
+        self.assertEqual(response.status_code, 202)
 
-        # Check if response contains expected message
+        # Check if response contains expected message and job id
         data = json.loads(response.data)
         self.assertEqual(data['message'], 'analyze_visit_note endpoint')
+        self.assertEqual(data['job_id'], 'job2')
+        mock_submit_analysis_job.assert_called_once_with('analyze_visit_notes', ['1'])
+
+    @patch('zollama.submit_analysis_job')
+    def test_analyze_visit_notes_batch_endpoint(self, mock_submit_analysis_job):
+        """Test /analyze_visit_notes/batch endpoint."""
+
+        mock_submit_analysis_job.return_value = 'job3'
+
+        headers = {
+            'Authorization': f'Bearer {self.jwt_token}'
+        }
+
+        response = self.app.post('/analyze_visit_notes/batch',
+                                 json={'visit_note_ids': ['1', '2']},
+                                 headers=headers)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(json.loads(response.data)['job_id'], 'job3')
+        mock_submit_analysis_job.assert_called_once_with('analyze_visit_notes', ['1', '2'])
+
+        # a batch needs a list of ids
+        response = self.app.post('/analyze_visit_notes/batch',
+                                 json={'visit_note_ids': '1'},
+                                 headers=headers)
+        self.assertEqual(response.status_code, 400)
+
+    @patch('zollama.get_job')
+    def test_job_status_endpoint(self, mock_get_job):
+        """Test /jobs/<job_id> and /jobs/<job_id>/progress endpoints."""
+
+        mock_get_job.return_value = {
+            'job_id': 'job1',
+            'job_type': 'analyze_visit_notes',
+            'status': 'running',
+            'progress': {'total': 10, 'completed': 4, 'failed': 1}
+        }
+
+        headers = {
+            'Authorization': f'Bearer {self.jwt_token}'
+        }
+
+        response = self.app.get('/jobs/job1', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)['status'], 'running')
+
+        response = self.app.get('/jobs/job1/progress', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)['progress']['completed'], 4)
+
+        mock_get_job.return_value = None
+        response = self.app.get('/jobs/nope', headers=headers)
+        self.assertEqual(response.status_code, 404)
+
+    @patch('zollama.cancel_job')
+    def test_job_cancel_endpoint(self, mock_cancel_job):
+        """Test /jobs/<job_id>/cancel endpoint."""
+
+        mock_cancel_job.return_value = 'cancelling'
+
+        headers = {
+            'Authorization': f'Bearer {self.jwt_token}'
+        }
+
+        response = self.app.post('/jobs/job1/cancel', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)['status'], 'cancelling')
+        mock_cancel_job.assert_called_once_with('job1')
+
+    @patch('zollama.FEE_MATRIX')
+    @patch('zollama.get_pt_locality_and_codes')
+    def test_estimate_fees_endpoint(self, mock_locality_codes, mock_fee_matrix):
+        """Test /estimate_fees endpoint."""
+
+        mock_locality_codes.return_value = {'patient_id': 'p1', 'locality': '0111205',
+                                            'codes': ['99213']}
+        mock_fee_matrix.price_claim.return_value = {'snapshot': '2024Q1', 'lines': [],
+                                                    'totals': {}, 'unpriced': []}
+
+        headers = {
+            'Authorization': f'Bearer {self.jwt_token}'
+        }
+
+        response = self.app.get('/estimate_fees?patient_document_id=d1', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)['patient_id'], 'p1')
+        mock_fee_matrix.price_claim.assert_called_once_with(['99213'], '0111205')
+
+        mock_locality_codes.side_effect = IndexError
+        response = self.app.get('/estimate_fees?patient_document_id=nope', headers=headers)
+        self.assertEqual(response.status_code, 404)
+
+        # no fee matrix has been built yet
+        mock_locality_codes.side_effect = None
+        mock_fee_matrix.price_claim.side_effect = FileNotFoundError
+        response = self.app.get('/estimate_fees?patient_document_id=d1', headers=headers)
+        self.assertEqual(response.status_code, 503)
+        self.assertIn(b'Fee matrix not built', response.data)
+
+    def test_build_codes_document(self):
+        """Code details in a codes document have their whitespace
+            collapsed, the prescriptions are left as written.
+        """
+
+        prompt_result = {'timestamp': datetime.datetime(2024, 1, 1), 'analysis': 'I10 99213'}
+        details = [{'code': '99213',
+                    'details': {'short_description': 'Office visit\n  established patient'}}]
+        results = {name: dict(prompt_result) for name in ('icd', 'cpt', 'hcpcs', 'prescription',
+                                                          'prescription_cpt', 'prescription_hcpcs')}
+        results['prescription']['analysis'] = 'Lisinopril\n  10 mg'
+        results.update({f'{name}_details': [] for name in ('icd', 'hcpcs', 'prescription_cpt',
+                                                           'prescription_hcpcs')},
+                       cpt_details=details)
+
+        codes_document = zollama.build_codes_document(results)
+        self.assertEqual(codes_document['cpt']['details'][0]['details']['short_description'],
+                         'Office visit established patient')
+        self.assertEqual(codes_document['prescription']['prescriptions'], 'Lisinopril\n  10 mg')
+
+    def test_prompt_results_encrypted(self):
+        """Code prompt results a bulk run keeps are encrypted when patient
+            data encryption is enabled and read back as they were.
+        """
+
+        results = {'prescription': {'timestamp': datetime.datetime(2024, 1, 1),
+                                    'shasum_512': 'sha', 'analysis': 'Lisinopril 10 mg'}}
+        encryption_setting = patch.object(type(zollama.CONFIG), 'patient_data_encryption_enabled',
+                                          new_callable=PropertyMock)
+        with encryption_setting as enabled, \
+             patch('zollama.encrypt_text', lambda text: text[::-1].encode()), \
+             patch('zollama.decrypt_text', lambda text: text[::-1]):
+            enabled.return_value = True
+            stored = zollama.encrypt_prompt_results(results)
+            self.assertEqual(stored['prescription']['analysis'], 'gm 01 lirponisiL')
+            self.assertEqual(zollama.decrypt_prompt_results(stored), results)
+
+            enabled.return_value = False
+            self.assertEqual(zollama.encrypt_prompt_results(results), results)
+            self.assertEqual(zollama.decrypt_prompt_results(results), results)
 
     # Add more test cases for other endpoints...
 
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""Tests for job leases and reclaiming jobs of workers that are gone, the
+    database is stubbed out
+"""
+
+import threading
+import unittest
+from unittest import mock
+
+import jobs
+
+class FakeJobs:
+    """analysis_jobs rows in memory, the registered queries jobs.py runs
+        against them
+    """
+
+    def __init__(self, rows=()):
+        self.rows = {row['job_id']: dict(row) for row in rows}
+        self.calls = []
+
+    def run_modify_query(self, name, params=None):
+        self.calls.append(name)
+        if name == 'reclaim_stale_jobs':
+            updated, now = params
+            reclaimed = []
+            for row in self.rows.values():
+                if row['status'] in ('running', 'cancelling') and row['lease_expires'] < now:
+                    row['status'] = 'queued' if row['status'] == 'running' else 'cancelled'
+                    row['updated'], row['lease_expires'] = updated, None
+                    reclaimed.append({'job_id': row['job_id'], 'status': row['status']})
+            return reclaimed
+        if name == 'claim_next_job':
+            for row in self.rows.values():
+                if row['status'] == 'queued':
+                    row['status'] = 'running'
+                    row['updated'], row['lease_expires'] = params
+                    return [dict(row)]
+            return []
+        if name == 'update_job':
+            row = self.rows[params[-1]]
+            row['updated'], row['lease_expires'] = params[0], params[1]
+            if params[3]:
+                row['status'] = params[3]
+            return [{'status': row['status']}]
+        raise AssertionError(name)
+
+class TestJobLeases(unittest.TestCase):
+
+    def setUp(self):
+        self.now = jobs.ts_int_to_dt_obj()
+        self.expired = self.now - jobs.datetime.timedelta(seconds=1)
+        self.later = self.now + jobs.datetime.timedelta(seconds=60)
+
+    def patch(self, store):
+        patcher = mock.patch.object(jobs, 'run_modify_query', store.run_modify_query)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def job(self, job_id, status, lease_expires):
+        return {'job_id': job_id, 'job_type': 'test', 'status': status,
+                'job_document': {}, 'updated': None, 'lease_expires': lease_expires}
+
+    def test_reclaim(self):
+        """Running jobs with an expired lease are queued again, cancelling
+            ones are cancelled, jobs with a lease are left alone.
+        """
+
+        store = FakeJobs([self.job('j1', 'running', self.expired),
+                          self.job('j2', 'cancelling', self.expired),
+                          self.job('j3', 'running', self.later),
+                          self.job('j4', 'completed', None)])
+        self.patch(store)
+        reclaimed = jobs.reclaim_stale_jobs()
+        self.assertEqual(reclaimed, [{'job_id': 'j1', 'status': 'queued'},
+                                     {'job_id': 'j2', 'status': 'cancelled'}])
+        self.assertEqual([row['status'] for row in store.rows.values()],
+                         ['queued', 'cancelled', 'running', 'completed'])
+
+    def test_claim_and_report_renew_lease(self):
+        """Claiming a job takes a lease, every update renews it."""
+
+        store = FakeJobs([self.job('j1', 'queued', None)])
+        self.patch(store)
+        job = jobs.claim_next_job()
+        lease = job['lease_expires']
+        self.assertGreaterEqual((lease - job['updated']).total_seconds(), jobs.JOB_LEASE_SECONDS)
+        store.rows['j1']['lease_expires'] = self.expired
+        jobs.update_job('j1', progress={'completed': 1})
+        self.assertGreater(store.rows['j1']['lease_expires'], self.now)
+        self.assertEqual(jobs.reclaim_stale_jobs(), [])
+
+    def test_worker_reclaims_before_claiming(self):
+        """A worker picks up the job a dead worker left running."""
+
+        store = FakeJobs([self.job('j1', 'running', self.expired)])
+        self.patch(store)
+        stop_event = threading.Event()
+        ran = []
+
+        def handler(context):
+            ran.append(context.job_id)
+            stop_event.set()
+            return {}
+
+        with mock.patch.dict(jobs.JOB_HANDLERS, {'test': handler}):
+            jobs.job_worker(stop_event)
+        self.assertEqual(ran, ['j1'])
+        self.assertEqual(store.calls[:2], ['reclaim_stale_jobs', 'claim_next_job'])
+        self.assertEqual(store.rows['j1']['status'], 'completed')
+
+if __name__ == '__main__':
+    unittest.main()
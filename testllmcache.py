@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""Tests for the two tier LLM response cache, the database is stubbed out
+"""
+
+import json
+import unittest
+from unittest import mock
+
+import llmcache
+from llmcache import LLMResponseCache
+
+class FakeCacheTable:
+    """llm_response_cache rows in memory, keyed by cache_key
+    """
+
+    def __init__(self):
+        self.rows = {}
+        self.fail = False
+
+    def run_query(self, name, params=None):
+        if self.fail:
+            raise RuntimeError('database is down')
+        key, oldest = params
+        row = self.rows.get(key)
+        if row is None or row['timestamp'] <= oldest:
+            return []
+        return [{'response_document': json.loads(row['response_document'])}]
+
+    def run_modify_query(self, name, params=None):
+        if self.fail:
+            raise RuntimeError('database is down')
+        assert name == 'store_llm_cache_entry', name
+        timestamp, key, model, response_document = params
+        # ON CONFLICT (cache_key) DO UPDATE timestamp and response_document
+        row = self.rows.setdefault(key, {'model': model})
+        row.update(timestamp=timestamp, response_document=response_document)
+        return []
+
+class TestLLMResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.table = FakeCacheTable()
+        for name in ('run_query', 'run_modify_query'):
+            patcher = mock.patch.object(llmcache, name, getattr(self.table, name))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.clock = [1000.0]
+        patcher = mock.patch.object(llmcache.time, 'monotonic', lambda: self.clock[0])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def cache(self, max_entries=2, ttl=60, persist=True):
+        return LLMResponseCache(max_entries, ttl, persist, 100, encrypt=False)
+
+    def value(self, analysis):
+        return {'shasum_512': f'sha-{analysis}', 'analysis': analysis}
+
+    def test_ttl(self):
+        """A memory entry expires after ttl seconds."""
+
+        cache = self.cache(persist=False)
+        cache.put('k1', 'llama3.1', self.value('a'))
+        self.clock[0] += 59
+        self.assertEqual(cache.get('k1'), self.value('a'))
+        self.clock[0] += 2
+        self.assertIsNone(cache.get('k1'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_lru_eviction(self):
+        """Past max_entries the least recently used entry goes."""
+
+        cache = self.cache(persist=False)
+        cache.put('k1', 'llama3.1', self.value('a'))
+        cache.put('k2', 'llama3.1', self.value('b'))
+        cache.get('k1')
+        cache.put('k3', 'llama3.1', self.value('c'))
+        self.assertIsNone(cache.get('k2'))
+        self.assertEqual(cache.get('k1'), self.value('a'))
+        self.assertEqual(cache.get('k3'), self.value('c'))
+        stats = cache.stats()
+        self.assertEqual((stats['memory_entries'], stats['evictions'], stats['misses']), (2, 1, 1))
+
+    def test_db_fallback(self):
+        """A memory miss is read from the database and kept in memory, a
+            database error is a miss.
+        """
+
+        self.cache().put('k1', 'llama3.1', self.value('a'))
+        cache = self.cache()
+        self.assertEqual(cache.get('k1'), self.value('a'))
+        self.assertEqual(cache.get('k1'), self.value('a'))
+        stats = cache.stats()
+        self.assertEqual((stats['db_hits'], stats['memory_hits']), (1, 1))
+
+        self.table.fail = True
+        self.assertIsNone(cache.get('k2'))
+        cache.put('k2', 'llama3.1', self.value('b'))
+        self.assertEqual(cache.stats()['errors'], 2)
+
+    def test_expired_row_is_refreshed(self):
+        """Storing a key whose row expired replaces the row."""
+
+        self.cache().put('k1', 'llama3.1', self.value('old'))
+        old_timestamp = self.table.rows['k1']['timestamp']
+        with mock.patch.object(llmcache, 'ts_int_to_dt_obj',
+                               lambda: old_timestamp + llmcache.timedelta(seconds=120)):
+            cache = self.cache()
+            self.assertIsNone(cache.get('k1'))
+            cache.put('k1', 'llama3.1', self.value('new'))
+            cache.clear()
+            self.assertEqual(cache.get('k1'), self.value('new'))
+
+    def test_purge_counts_rows(self):
+        """Purge reports the rows each delete removed."""
+
+        with mock.patch.object(llmcache, 'run_modify_query_rowcount',
+                               side_effect=[3, 2]) as rowcount:
+            self.assertEqual(self.cache().purge(), (3, 2))
+        self.assertEqual([call.args[0] for call in rowcount.call_args_list],
+                         ['purge_expired_llm_cache_entries', 'purge_excess_llm_cache_entries'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""Tests for reading structured LLM replies, llmoutput.py
+"""
+
+import asyncio
+import unittest
+
+from codedetails import CodeDetailsDictionary
+from llmoutput import BillingGuidelines
+from llmoutput import CodeDescription
+from llmoutput import LLMOutputError
+from llmoutput import parse_reply
+from llmoutput import repair_json
+
+class TestRepairJson(unittest.TestCase):
+
+    def test_repairs(self):
+        """JSON, python literals and the usual ways models get JSON wrong."""
+
+        expected = {'code': 'I10', 'billable': True, 'notes': "patient's BP\nis high"}
+        replies = [
+            '{"code": "I10", "billable": true, "notes": "patient\'s BP\\nis high"}',
+            "Sure! {'code': 'I10', 'billable': True, 'notes': \"patient's BP\\nis high\"} Hope it helps",
+            '```json\n{"code": "I10", "billable": true, "notes": "patient\'s BP\nis high",}\n```',
+            "{'code': 'I10', 'billable': True, 'notes': 'patient's BP\nis high'}",
+        ]
+        for reply in replies:
+            self.assertEqual(repair_json(reply), expected, reply)
+
+        # cut off mid reply
+        self.assertEqual(repair_json('{"cpt": "99213", "details": {"short_description": "Office vi'),
+                         {'cpt': '99213', 'details': {'short_description': 'Office vi'}})
+
+        for reply in ('', 'no JSON here', '{"a": [1, 2}', None):
+            with self.assertRaises(LLMOutputError):
+                repair_json(reply)
+
+    def test_typed_results(self):
+        """Missing keys and odd values end up as empty strings."""
+
+        guidelines = parse_reply("{'insurance_company': {'reimbursement_rate': '$75 ',"
+                                 " 'billing_instructions': None}}", BillingGuidelines)
+        self.assertEqual(guidelines.insurance_company.reimbursement_rate, '$75')
+        self.assertEqual(guidelines.to_dict()['medical_provider'],
+                         {'reimbursement_rate': '', 'billing_instructions': ''})
+
+        description = parse_reply('{"cpt": 99213, "details": {"short_description": "Office visit"}}',
+                                  CodeDescription, 'cpt')
+        self.assertEqual(description.to_dict(), {'cpt': '99213',
+                                                  'details': {'short_description': 'Office visit',
+                                                              'long_description': ''}})
+
+    def test_incomplete_details_are_not_kept(self):
+        """A reply that could not be read is asked for again next time."""
+
+        replies = [{'cpt': '', 'incomplete': True}, {'cpt': '99213'}]
+
+        async def fetch(code):
+            return replies.pop(0)
+
+        dictionary = CodeDetailsDictionary(persist=False)
+        self.assertTrue(asyncio.run(dictionary.lookup('cpt', '99213', fetch))['incomplete'])
+        self.assertEqual(asyncio.run(dictionary.lookup('cpt', '99213', fetch)), {'cpt': '99213'})
+        self.assertEqual(asyncio.run(dictionary.lookup('cpt', '99213', fetch)), {'cpt': '99213'})
+
+if __name__ == '__main__':
+    unittest.main()
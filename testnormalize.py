@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""Tests for the LLM output normalization in normalize.py
+"""
+
+import ast
+import unittest
+
+from normalize import BOILERPLATE_PATTERN
+from normalize import BOILERPLATE_PHRASES
+from normalize import collapse_whitespace
+from normalize import normalize
+from normalize import normalize_text
+from normalize import strip_boilerplate
+
+ICD_REPLY = """{'insurance_company': {
+        'reimbursement_rate': '$50 - $100  per visit',
+        'billing_instructions': 'Bill with
+ modifier 25'
+    },
+    'medical_provider': {'reimbursement_rate': '$75', 'billing_instructions': ''}}"""
+
+class TestNormalize(unittest.TestCase):
+
+    def test_strip_boilerplate(self):
+        """Every phrase is replaced, text around it is kept as is."""
+
+        for phrase in BOILERPLATE_PHRASES:
+            self.assertEqual(strip_boilerplate(f'{phrase}\n\nrest  of it'), 'FWIW - \n\nrest  of it')
+        self.assertEqual(strip_boilerplate('nothing to do'), 'nothing to do')
+
+        text = f"x{BOILERPLATE_PHRASES[2]}{BOILERPLATE_PHRASES[0]}, I don't have y {BOILERPLATE_PHRASES[5]}"
+        self.assertEqual(strip_boilerplate(text), BOILERPLATE_PATTERN.sub('FWIW - ', text))
+
+    def test_collapse_whitespace(self):
+        """Line breaks and runs of blanks collapse, an LLM dict parses."""
+
+        self.assertEqual(collapse_whitespace(' a  b\n  c\r\n\td e\n'), 'a b c d e')
+        guidelines = ast.literal_eval(collapse_whitespace(ICD_REPLY))
+        self.assertEqual(guidelines['insurance_company'],
+                         {'reimbursement_rate': '$50 - $100 per visit',
+                          'billing_instructions': 'Bill with modifier 25'})
+        self.assertEqual(normalize_text(f'{BOILERPLATE_PHRASES[0]}\nok'), 'FWIW - ok')
+
+    def test_normalize_nested(self):
+        """Every string at any depth is normalized once, keys are not."""
+
+        nested = {'a\nb': 'x\ny'}
+        for _ in range(50):
+            nested = {'level': [nested, 'p  q'], 'text': 'r\n s'}
+        result = normalize(nested)
+        self.assertIs(result, nested)
+        for _ in range(50):
+            self.assertEqual(nested['text'], 'r s')
+            self.assertEqual(nested['level'][1], 'p q')
+            nested = nested['level'][0]
+        self.assertEqual(nested, {'a\nb': 'x y'})
+        self.assertEqual(normalize('a\n\nb', replacement=''), 'ab')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""Tests for routing prompts over several Ollama hosts, the hosts are
+    stub servers on localhost
+"""
+
+import asyncio
+import json
+import socket
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from unittest import mock
+
+import gptutils
+from ollamarouter import NoEndpointError
+from ollamarouter import OllamaEndpoint
+from ollamarouter import OllamaRouter
+
+class StubOllama(ThreadingHTTPServer):
+    """Answers /api/chat with its name after delay seconds, keeps count
+        of the prompts it has running at once. A model that is not
+        resident yet takes a second to load, /api/generate loads and
+        unloads models, /api/ps lists them. With takes_schema=False a JSON
+        schema format is answered with a 400, like Ollama before 0.5.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, name, delay=0.05):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.name = name
+        self.delay = delay
+        self.models = []
+        self.keep_alives = []
+        self.resident = set()
+        self.formats = []
+        self.takes_schema = True
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+        self.url = f'http://127.0.0.1:{self.server_address[1]}'
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self): # pylint: disable=invalid-name
+        self.reply({'models': [{'name': f'{model}:latest', 'size_vram': 1}
+                               for model in sorted(self.server.resident)]})
+
+    def do_POST(self): # pylint: disable=invalid-name
+        server = self.server
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        model = request['model']
+        if isinstance(request.get('format'), dict) and not server.takes_schema:
+            self.reply({'error': 'json: cannot unmarshal object into Go struct field'}, 400)
+            return
+        with server.lock:
+            server.formats.append(request.get('format'))
+            server.keep_alives.append((self.path, model, request.get('keep_alive')))
+            load_duration = 0 if model in server.resident else 10**9
+            if request.get('keep_alive') == 0:
+                server.resident.discard(model)
+            else:
+                server.resident.add(model)
+        if self.path == '/api/generate':
+            self.reply({'model': model, 'response': '', 'done': True})
+            return
+
+        with server.lock:
+            server.running += 1
+            server.max_running = max(server.max_running, server.running)
+            server.models.append(model)
+        time.sleep(server.delay)
+        with server.lock:
+            server.running -= 1
+        self.reply({'model': model,
+                    'message': {'role': 'assistant', 'content': server.name},
+                    'done': True,
+                    'load_duration': load_duration})
+
+    def reply(self, document, status=200):
+        body = json.dumps(document).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args): # pylint: disable=arguments-differ
+        pass
+
+def closed_port_url():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return f'http://127.0.0.1:{sock.getsockname()[1]}'
+
+class TestOllamaRouter(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = [StubOllama('gpu1'), StubOllama('gpu2')]
+        for server in self.servers:
+            self.addCleanup(server.server_close)
+            self.addCleanup(server.shutdown)
+        patcher = mock.patch.object(gptutils, 'LLM_CACHE_ENABLED', False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def route(self, endpoints, **kwargs):
+        router = OllamaRouter(endpoints, cooldown=60, **kwargs)
+        patcher = mock.patch.object(gptutils, 'OLLAMA_ROUTER', router)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return router
+
+    def run_async(self, coro):
+        async def run_and_close():
+            try:
+                return await coro
+            finally:
+                await gptutils.OLLAMA_CLIENTS.aclose()
+        return asyncio.run(run_and_close())
+
+    def prompt(self, llm, count=1):
+        async def prompts():
+            return await asyncio.gather(*(gptutils.prompt_chat(llm, 'note', False)
+                                          for _ in range(count)))
+        results = self.run_async(prompts())
+        return [result['analysis'] if result else result for result in results]
+
+    def test_spread_over_hosts(self):
+        """Prompts are spread over both hosts, never more than a host's
+            max_concurrency at once.
+        """
+
+        router = self.route([OllamaEndpoint('gpu1', self.servers[0].url, max_concurrency=2),
+                             OllamaEndpoint('gpu2', self.servers[1].url, max_concurrency=3)])
+        replies = self.prompt('llama3.1', 12)
+        self.assertEqual(len(replies), 12)
+        self.assertEqual(set(replies), {'gpu1', 'gpu2'})
+        self.assertLessEqual(self.servers[0].max_running, 2)
+        self.assertLessEqual(self.servers[1].max_running, 3)
+        stats = router.stats()
+        self.assertEqual(stats['gpu1']['requests'] + stats['gpu2']['requests'], 12)
+        self.assertEqual(stats['gpu1']['outstanding'] + stats['gpu2']['outstanding'], 0)
+        self.assertEqual(stats['gpu1']['loaded'], ['llama3.1'])
+
+    def test_models_per_host(self):
+        """A model only goes to the hosts that serve it."""
+
+        self.route([OllamaEndpoint('gpu1', self.servers[0].url, ['deepseek-llm']),
+                    OllamaEndpoint('gpu2', self.servers[1].url, ['llama3.1:latest'])])
+        self.assertEqual(self.prompt('llama3.1', 3), ['gpu2'] * 3)
+        self.assertEqual(self.prompt('deepseek-llm'), ['gpu1'])
+        self.assertEqual(self.prompt('meditron'), [False])
+
+    def test_failover(self):
+        """A host that can't be reached is left out, the prompt is answered
+            by another one.
+        """
+
+        router = self.route([OllamaEndpoint('down', closed_port_url()),
+                             OllamaEndpoint('gpu1', self.servers[0].url)])
+        self.assertEqual(self.prompt('llama3.1', 4), ['gpu1'] * 4)
+        stats = router.stats()
+        self.assertFalse(stats['down']['healthy'])
+        self.assertGreaterEqual(stats['down']['failures'], 1)
+        self.assertEqual(router.endpoints[0].consecutive_failures, 1)
+        self.assertTrue(stats['gpu1']['healthy'])
+
+        self.servers[0].shutdown()
+        self.servers[0].server_close()
+        self.assertEqual(self.prompt('llama3.1'), [False])
+
+    def test_schema_format_fallback(self):
+        """A server that turns a schema format down is sent json, the
+            prompt is answered.
+        """
+
+        self.route([OllamaEndpoint('gpu1', self.servers[0].url)])
+        self.servers[0].takes_schema = False
+        schema = {'type': 'object'}
+
+        async def prompts():
+            return [await gptutils.prompt_chat('llama3.1', 'note', False,
+                                               output_format=gptutils.json_format(schema))
+                    for _ in range(2)]
+
+        with mock.patch.object(gptutils, 'LLM_JSON_FORMAT', 'schema'):
+            replies = self.run_async(prompts())
+            self.assertEqual(gptutils.LLM_JSON_FORMAT, 'json')
+        self.assertEqual([reply['analysis'] for reply in replies], ['gpu1', 'gpu1'])
+        self.assertEqual(self.servers[0].formats, ['json', 'json'])
+
+    def test_keep_alive_and_load_events(self):
+        """Prompts send the keep_alive of their model, loads that took
+            long are counted.
+        """
+
+        router = self.route([OllamaEndpoint('gpu1', self.servers[0].url)],
+                            keep_alive=120, pinned=['deepseek-llm:latest'])
+        self.prompt('llama3.1', 2)
+        self.prompt('deepseek-llm')
+        self.assertEqual(self.servers[0].keep_alives, [('/api/chat', 'llama3.1', 120),
+                                                       ('/api/chat', 'llama3.1', 120),
+                                                       ('/api/chat', 'deepseek-llm', -1)])
+        loads = router.stats()['gpu1']['model_loads']
+        self.assertEqual(loads['llama3.1'], {'count': 1, 'seconds': 1.0})
+        self.assertEqual(loads['deepseek-llm'], {'count': 1, 'seconds': 1.0})
+
+    def test_preload_pin_unpin(self):
+        """Models are preloaded on the hosts that serve them, resident
+            models are read back, pinned models are kept loaded.
+        """
+
+        router = self.route([OllamaEndpoint('gpu1', self.servers[0].url, ['llama3.1']),
+                             OllamaEndpoint('gpu2', self.servers[1].url)])
+        loaded = self.run_async(gptutils.preload_models(['llama3.1', 'meditron']))
+        self.assertEqual(loaded, {'gpu1': {'llama3.1': True},
+                                  'gpu2': {'llama3.1': True, 'meditron': True}})
+        self.assertEqual(self.servers[1].keep_alives[-1], ('/api/generate', 'meditron', 300))
+
+        resident = self.run_async(gptutils.resident_models())
+        self.assertEqual([model['name'] for model in resident['gpu2']],
+                         ['llama3.1:latest', 'meditron:latest'])
+        self.assertEqual(router.stats()['gpu2']['loaded'], ['llama3.1', 'meditron'])
+
+        self.run_async(gptutils.pin_model('meditron'))
+        self.assertEqual(self.servers[1].keep_alives[-1], ('/api/generate', 'meditron', -1))
+        self.assertEqual(router.keep_alive_for('meditron:latest'), -1)
+
+        self.run_async(gptutils.unpin_model('meditron', unload=True))
+        self.assertEqual(self.servers[1].keep_alives[-1], ('/api/generate', 'meditron', 0))
+        self.assertEqual(router.keep_alive_for('meditron'), 300)
+        self.assertEqual(router.stats()['gpu2']['loaded'], ['llama3.1'])
+        self.assertEqual(self.servers[1].resident, {'llama3.1'})
+
+    def test_prefers_loaded_model(self):
+        """An idle host that ran the model comes before an idle one that
+            did not, then the least loaded host.
+        """
+
+        async def pick():
+            router = OllamaRouter([OllamaEndpoint('a', 'http://a', max_concurrency=4),
+                                   OllamaEndpoint('b', 'http://b', max_concurrency=2)])
+            first = await router.acquire('llama3.1')
+            self.assertEqual(first.name, 'a')
+            router.release(first, 'llama3.1', ok=True)
+
+            picked = [(await router.acquire('llama3.1')).name for _ in range(4)]
+            self.assertEqual(picked, ['a', 'a', 'a', 'a'])
+            # a is full, b takes the rest
+            self.assertEqual((await router.acquire('llama3.1')).name, 'b')
+            self.assertEqual((await router.acquire('gemma')).name, 'b')
+
+            waiting = asyncio.ensure_future(router.acquire('gemma'))
+            await asyncio.sleep(0)
+            self.assertFalse(waiting.done())
+            # both hosts go down, the waiting prompt gives up
+            router.release(router.endpoints[0], ok=False)
+            router.release(router.endpoints[1], ok=False)
+            with self.assertRaises(NoEndpointError):
+                await waiting
+
+        asyncio.run(pick())
+
+if __name__ == '__main__':
+    unittest.main()
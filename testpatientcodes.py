@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""Tests for the patient_code_items rows built from a codes document
+"""
+
+import decimal
+import json
+import unittest
+
+import patientcodes
+
+CODES_DOCUMENT = {
+    'icd': {
+        'codes': ['E11.9', 'I10', 'E11.9'],
+        'details': [
+            {'code': 'E11.9', 'valid': True, 'billable': True,
+             'full_data': {'short_description': 'Type 2 diabetes mellitus without complications',
+                           'billing_guidelines': {
+                               'insurance_company': {'reimbursement_rate': '$1,200 - $80 per year'},
+                               'medical_provider': {'reimbursement_rate': 'varies'}}}},
+            'Unable to parse details',
+            {}
+        ]
+    },
+    'cpt': {
+        'codes': ['99213'],
+        'details': [json.dumps({'cpt': '99213',
+                                'details': {'short_description': 'Office visit'}})]
+    },
+    'prescription': {'prescriptions': 'metformin'},
+    'prescription_cpt': {'codes': ['99213'], 'details': ['not json']}
+}
+
+class TestPatientCodeItems(unittest.TestCase):
+
+    def test_parse_reimbursement_range(self):
+        """Dollar amounts are parsed, anything else is no range."""
+
+        self.assertEqual(patientcodes.parse_reimbursement_range('$50-$100.50 per visit'),
+                         (decimal.Decimal('50'), decimal.Decimal('100.50')))
+        self.assertEqual(patientcodes.parse_reimbursement_range('$75'),
+                         (decimal.Decimal('75'), decimal.Decimal('75')))
+        self.assertEqual(patientcodes.parse_reimbursement_range('80% of allowed'), (None, None))
+        self.assertEqual(patientcodes.parse_reimbursement_range(None), (None, None))
+
+    def test_code_items(self):
+        """One row per distinct code of each section, with parsed details."""
+
+        rows = patientcodes.code_items('p1', 'd1', CODES_DOCUMENT, '2024-01-01T00:00:00+00:00')
+        self.assertEqual([(row['source'], row['code'], row['position']) for row in rows],
+                         [('icd', 'E11.9', 0), ('icd', 'I10', 1),
+                          ('cpt', '99213', 0), ('prescription_cpt', '99213', 0)])
+
+        diabetes, hypertension, cpt, prescription_cpt = rows
+        self.assertTrue(diabetes['billable'])
+        self.assertEqual(diabetes['insurance_reimbursement_min'], decimal.Decimal('80'))
+        self.assertEqual(diabetes['insurance_reimbursement_max'], decimal.Decimal('1200'))
+        self.assertEqual(diabetes['provider_reimbursement_rate'], 'varies')
+        self.assertIsNone(diabetes['provider_reimbursement_min'])
+        self.assertIsNone(hypertension['billable'])
+        self.assertEqual(cpt['code_system'], 'cpt')
+        self.assertEqual(cpt['short_description'], 'Office visit')
+        self.assertIsNone(prescription_cpt['short_description'])
+        self.assertTrue(all(len(row) == len(rows[0]) for row in rows))
+
+if __name__ == '__main__':
+    unittest.main()
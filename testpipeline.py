@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""Tests for the staged pipeline in pipeline.py
+"""
+
+import threading
+import unittest
+
+from pipeline import Stage
+from pipeline import StagedPipeline
+
+MODELS = ['medllama2', 'meditron', 'llama2']
+
+class TestStagedPipeline(unittest.TestCase):
+
+    def run_pipeline(self, fetch, diagnose, notes):
+        stored = []
+        lock = threading.Lock()
+
+        def summarize(note):
+            return [dict(note, llm=llm) for llm in MODELS]
+
+        def persist(note):
+            with lock:
+                stored.append((note['id'], note['llm']))
+            return []
+
+        stages = [
+                  Stage('fetch', fetch, 2),
+                  Stage('summarize', summarize, 2),
+                  Stage('diagnose', diagnose, {llm: 1 for llm in MODELS},
+                        key=lambda note: note['llm']),
+                  Stage('persist', persist, 1)
+                 ]
+        stats = StagedPipeline(stages, queue_size=2, item_id=str).run(notes)
+        return stats, stored
+
+    def test_fan_out_counts_notes(self):
+        """A note that fans out into one item per model is one completion."""
+
+        stats, stored = self.run_pipeline(lambda note_id: [{'id': note_id}],
+                                          lambda note: [note], ['n1', 'n2', 'n3'])
+        self.assertEqual(len(stored), 9)
+        self.assertEqual((stats['submitted'], stats['completed'], stats['failed']), (3, 3, 0))
+        self.assertEqual(stats['stages']['persist']['processed'], 9)
+
+    def test_one_model_failing_fails_the_note(self):
+        """A note is complete only when every one of its items is stored."""
+
+        def diagnose(note):
+            if note['id'] == 'n2' and note['llm'] == 'meditron':
+                raise RuntimeError('prompt failed')
+            return [note]
+
+        stats, stored = self.run_pipeline(lambda note_id: [{'id': note_id}], diagnose,
+                                          ['n1', 'n2', 'n3'])
+        self.assertEqual(len(stored), 8)
+        self.assertEqual((stats['completed'], stats['failed']), (2, 1))
+        self.assertEqual(stats['failed_items'], [('diagnose', str({'id': 'n2', 'llm': 'meditron'}))])
+
+    def test_drops_and_errors(self):
+        """An empty fetch and a stage returning False fail the note."""
+
+        def fetch(note_id):
+            return [] if note_id == 'missing' else [{'id': note_id}]
+
+        def diagnose(note):
+            return False if note['id'] == 'bad' else [note]
+
+        stats, _ = self.run_pipeline(fetch, diagnose, ['n1', 'missing', 'bad', 'n2'])
+        self.assertEqual((stats['submitted'], stats['completed'], stats['failed']), (4, 2, 2))
+        self.assertEqual(stats['stages']['fetch']['dropped'], 1)
+        self.assertEqual(stats['stages']['diagnose']['failed'], 3)
+
+    def test_cancel(self):
+        """Cancelled items are neither completed nor failed."""
+
+        pipeline = None
+
+        def fetch(note_id):
+            pipeline.cancel()
+            return [{'id': note_id}]
+
+        pipeline = StagedPipeline([Stage('fetch', fetch), Stage('persist', lambda note: [])])
+        stats = pipeline.run(['n1', 'n2'])
+        self.assertTrue(stats['cancelled'])
+        self.assertEqual((stats['completed'], stats['failed']), (0, 0))
+
+if __name__ == '__main__':
+    unittest.main()
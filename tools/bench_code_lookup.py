@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""Benchmark of per-code against batched cpt/hcpcs lookup prompts, runs
+    against the Ollama server in setup.config with the LLM response cache
+    and the code details dictionary out of the way
+
+        > ./tools/bench_code_lookup.py
+        > ./tools/bench_code_lookup.py --model llama3.1 --batch-sizes 5,10,15 \
+              --codes 99213,99214,93000,80061,84484,71046,36415,85025,81001,90471
+
+   ©2024, Ovais Quraishi
+"""
+
+import argparse
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import clincodeutils
+import gptutils
+
+CPT_CODES = ['99213', '99214', '99203', '93000', '80061', '84484', '71046', '36415',
+             '85025', '81001', '90471', '90686', '96372', '97110', '11721']
+
+async def per_code(code_system, codes):
+    fetch = clincodeutils.CODE_DETAIL_FETCHERS[code_system]
+    return dict(zip(codes, await asyncio.gather(*(fetch(code) for code in codes))))
+
+async def batched(code_system, codes, batch_size):
+    batches = await asyncio.gather(*(clincodeutils.fetch_code_details_batch_gpt(code_system,
+                                                                                codes[i:i + batch_size])
+                                     for i in range(0, len(codes), batch_size)))
+    return {code: details for batch in batches for code, details in batch.items()}
+
+def report(label, codes, details, seconds):
+    complete = sum(1 for code in codes if not details[code].get('incomplete'))
+    print(f'{label:<22}{seconds:>9.1f}s{len(codes) / seconds:>10.2f} codes/s'
+          f'{complete:>6}/{len(codes)} complete')
+
+def main():
+    """Run the benchmark
+    """
+
+    parser = argparse.ArgumentParser(description='Benchmark code lookup prompts')
+    parser.add_argument('--model', default=clincodeutils.CODE_LOOKUP_LLM)
+    parser.add_argument('--code-system', default='cpt', choices=['cpt', 'hcpcs'])
+    parser.add_argument('--codes', default=','.join(CPT_CODES), help='comma separated codes')
+    parser.add_argument('--batch-sizes', default='5,10,15', help='comma separated batch sizes')
+    args = parser.parse_args()
+
+    codes = [code.strip() for code in args.codes.split(',') if code.strip()]
+    clincodeutils.CODE_LOOKUP_LLM = args.model
+    gptutils.LLM_CACHE_ENABLED = False
+
+    # warm up, loads the model
+    gptutils.run_sync(clincodeutils.CODE_DETAIL_FETCHERS[args.code_system](codes[0]))
+
+    started = time.monotonic()
+    details = gptutils.run_sync(per_code(args.code_system, codes))
+    report('per code', codes, details, time.monotonic() - started)
+
+    for batch_size in (int(size) for size in args.batch_sizes.split(',')):
+        started = time.monotonic()
+        details = gptutils.run_sync(batched(args.code_system, codes, batch_size))
+        report(f'batch of {batch_size}', codes, details, time.monotonic() - started)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""Micro-benchmark of encryption.py, per call cost of reading the key
+    file and building a Fernet cipher every call against the cached
+    cipher, and of encrypt_many/decrypt_many on a batch
+
+    Runs against a throwaway key, the configured key is not touched:
+        > ./tools/bench_encryption.py
+        > ./tools/bench_encryption.py --calls 20000 --batch 5000 --size 4096
+
+   ©2024, Ovais Quraishi
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from cryptography.fernet import Fernet
+
+import encryption
+
+def uncached_encrypt(text):
+    """encrypt_text as it was, key file read and cipher built per call"""
+
+    return Fernet(encryption.load_key()).encrypt(text.encode())
+
+def uncached_decrypt(encrypted_text):
+    """decrypt_text as it was"""
+
+    return Fernet(encryption.load_key()).decrypt(encrypted_text).decode()
+
+def per_call(label, func, arg, calls):
+    seconds = timeit.timeit(lambda: func(arg), number=calls)
+    print(f'{label:<28}{seconds / calls * 1e6:>10.1f} us/call')
+    return seconds / calls
+
+def main():
+    """Run the benchmark
+    """
+
+    parser = argparse.ArgumentParser(description='Benchmark encryption.py')
+    parser.add_argument('--calls', type=int, default=5000, help='calls per single text run')
+    parser.add_argument('--batch', type=int, default=2000, help='texts per batch run')
+    parser.add_argument('--size', type=int, default=2048, help='characters per text')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        key_file = os.path.join(tmp_dir, 'bench.key')
+        with open(key_file, 'wb') as afile:
+            afile.write(Fernet.generate_key())
+        encryption.CONFIG.set('service', 'ENCRYPTION_KEY', key_file)
+        encryption.reload_key()
+
+        text = 'x' * args.size
+        token = encryption.encrypt_text(text)
+
+        before = per_call('encrypt, uncached', uncached_encrypt, text, args.calls)
+        after = per_call('encrypt_text, cached', encryption.encrypt_text, text, args.calls)
+        print(f'{"":<28}{before / after:>10.1f}x')
+        before = per_call('decrypt, uncached', uncached_decrypt, token, args.calls)
+        after = per_call('decrypt_text, cached', encryption.decrypt_text, token, args.calls)
+        print(f'{"":<28}{before / after:>10.1f}x')
+
+        texts = [text] * args.batch
+        tokens = encryption.encrypt_many(texts, workers=1)
+        for label, func, items in (('encrypt_many', encryption.encrypt_many, texts),
+                                   ('decrypt_many', encryption.decrypt_many, tokens)):
+            for workers in sorted({1, encryption.BATCH_WORKERS}):
+                seconds = timeit.timeit(lambda: func(items, workers=workers), number=1)
+                print(f'{label + f", {workers} worker(s)":<28}'
+                      f'{seconds / len(items) * 1e6:>10.1f} us/item')
+
+if __name__ == '__main__':
+    main()
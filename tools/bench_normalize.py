@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""Micro-benchmark of normalize.py against the helpers it replaced,
+    on LLM replies shaped like the ones the service gets back: a long
+    analysis with boilerplate in it, an ICD billing guidelines reply
+    that is fed to ast.literal_eval, and nested codes documents
+
+        > ./tools/bench_normalize.py
+        > ./tools/bench_normalize.py --number 200 --depth 10
+
+   ©2024, Ovais Quraishi
+"""
+
+import argparse
+import ast
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from normalize import BOILERPLATE_PHRASES
+from normalize import collapse_whitespace
+from normalize import normalize
+from normalize import strip_boilerplate
+
+ANALYSIS_PARAGRAPH = """**Summary:** The patient is a 45-year-old male presenting with
+intermittent chest pain radiating to the left arm, worse on exertion.
+
+**Assessment:**  Stable angina is the most likely diagnosis (I20.8),
+hypertension (I10) and hyperlipidemia (E78.5) are contributing factors.
+
+**Plan:**
+  1. ECG and troponin today (93000, 84484)
+  2. Lipid panel (80061)
+  3. Follow up in two weeks (99214)
+"""
+
+ICD_REPLY = """{'insurance_company': {
+        'reimbursement_rate': '$50 - $100 per visit, depending on the plan  and region',
+        'billing_instructions': 'Use as a secondary diagnosis when the encounter
+  addresses the condition, documentation must support medical necessity.'
+    },
+    'medical_provider': {
+        'reimbursement_rate': '$75 - $125 per visit',
+        'billing_instructions': 'Code to the highest degree of specificity.
+  Pair with the appropriate E/M code.'
+    }
+}"""
+
+def legacy_sanitize_string(a_string):
+    """utils.sanitize_string as it was"""
+
+    for i in BOILERPLATE_PHRASES:
+        if i in a_string:
+            a_string = a_string.replace(i, 'FWIW - ')
+    return a_string
+
+def legacy_replace_newline_in_dict(a_dict, replacement=''):
+    """utils.replace_newline_in_dict as it was, every level recursed twice"""
+
+    if isinstance(a_dict, dict):
+        for key, value in a_dict.items():
+            a_dict[key] = legacy_replace_newline_in_dict(value, replacement)
+            a_dict[key] = legacy_replace_newline_in_dict(value, '  ')
+    elif isinstance(a_dict, list):
+        for i, item in enumerate(a_dict):
+            a_dict[i] = legacy_replace_newline_in_dict(item, replacement)
+            a_dict[i] = legacy_replace_newline_in_dict(item, '  ')
+    elif isinstance(a_dict, str):
+        a_dict = a_dict.replace('\n', replacement)
+        a_dict = a_dict.replace('  ', replacement)
+    return a_dict
+
+def legacy_parse_icd(reply):
+    """clincodeutils.parse_icd_10_code_details as it was"""
+
+    return ast.literal_eval(reply.replace('  ', '').replace('\n', ''))
+
+def codes_document(depth):
+    """Codes document with details nested depth levels deep"""
+
+    detail = {'short_description': 'Office visit\n  established patient',
+              'details': ICD_REPLY}
+    for _ in range(depth):
+        detail = {'codes': ['99213', '99214'], 'details': [detail, ANALYSIS_PARAGRAPH]}
+    return detail
+
+def compare(label, legacy, current, make_arg, number):
+    # a fresh argument per call, both versions modify nested input in place
+    legacy_seconds = min(timeit.repeat(lambda: legacy(make_arg()), number=number, repeat=3))
+    current_seconds = min(timeit.repeat(lambda: current(make_arg()), number=number, repeat=3))
+    print(f'{label:<34}{legacy_seconds / number * 1e6:>12.1f}{current_seconds / number * 1e6:>12.1f}'
+          f'{legacy_seconds / current_seconds:>9.1f}x')
+
+def main():
+    """Run the benchmark
+    """
+
+    parser = argparse.ArgumentParser(description='Benchmark normalize.py')
+    parser.add_argument('--number', type=int, default=100, help='calls per measurement')
+    parser.add_argument('--depth', type=int, default=8, help='codes document nesting depth')
+    args = parser.parse_args()
+
+    analysis = f'{BOILERPLATE_PHRASES[3]} {ANALYSIS_PARAGRAPH * 20}'
+    print(f'{"us per call":<34}{"before":>12}{"after":>12}')
+    compare('analysis', legacy_sanitize_string, strip_boilerplate,
+            lambda: ANALYSIS_PARAGRAPH * 20, args.number)
+    compare('analysis, with boilerplate', legacy_sanitize_string, strip_boilerplate,
+            lambda: analysis, args.number)
+    compare('icd reply, literal_eval', legacy_parse_icd,
+            lambda reply: ast.literal_eval(collapse_whitespace(reply)),
+            lambda: ICD_REPLY, args.number)
+    for depth in sorted({2, args.depth // 2, args.depth}):
+        compare(f'codes document, depth {depth}', legacy_replace_newline_in_dict, normalize,
+                lambda depth=depth: codes_document(depth), max(1, args.number // 10))
+
+if __name__ == '__main__':
+    main()
@@ -15,23 +15,6 @@ from database import get_icd_billable_estimates
 # set the locale English (United States)
 locale.setlocale(locale.LC_ALL, 'en_US')
 
-# substrings to be replaced
-TBR = ["As an AI language model, I don't have personal preferences or feelings. However,",
-       "As an AI language model, I don't have personal preferences or opinions, but ",
-       "I'm sorry to hear you're feeling that way! As an AI language model, I don't have access to real-time information on Hypmic or its future plans. However,",
-       "As an AI language model, I don't have personal beliefs or experiences. However,",
-       "I'm just an AI, I don't have personal beliefs or opinions, and I cannot advocate for or against any particular religion. However,",
-       "As an AI, I don't have real-time information on specific individuals or their projects. However,"
-      ]
-
-def sanitize_string(a_string):
-    """Search and replace AI model related text in strings"""
-
-    for i in TBR:
-        if i in a_string:
-            a_string = a_string.replace(i,'FWIW - ')
-    return a_string
-
 def unix_ts_str():
     """Unix time as a string"""
 
@@ -118,23 +101,6 @@ def retry_with_timeout(max_retry_count, timeout_seconds, func, *args, **kwargs):
             print(f"Retry {retry_count} failed. Retrying...")
             time.sleep(1)  # Wait for 1 second before retrying
 
-def replace_newline_in_dict(a_dict, replacement=''):
-    """Remove newlines from a dict object generated by LLM
-    """
-
-    if isinstance(a_dict, dict):
-        for key, value in a_dict.items():
-            a_dict[key] = replace_newline_in_dict(value, replacement)
-            a_dict[key] = replace_newline_in_dict(value, '  ')
-    elif isinstance(a_dict, list):
-        for i, item in enumerate(a_dict):
-            a_dict[i] = replace_newline_in_dict(item, replacement)
-            a_dict[i] = replace_newline_in_dict(item, '  ')
-    elif isinstance(a_dict, str):
-        a_dict = a_dict.replace('\n', replacement)
-        a_dict = a_dict.replace('  ', replacement)
-    return a_dict
-
 def parse_fees_from_text(input_text):
     """Parse fees and frequency rates from a list of text descriptions.
     """
@@ -174,43 +140,32 @@ def parse_fees_from_text(input_text):
 def calculate_medical_costs(patient_id):
     """Calculate and display fees for medical services related to a patient
        with a given patient_id. It does this by retrieving estimates from an
-       ICD (International Classification of Diseases) source, parsing these
-       estimates into fees.
+       ICD (International Classification of Diseases) source, the reimbursement
+       ranges are parsed when the codes are stored (see patientcodes.py).
     """
 
-    def parse_and_calculate_estimates(cost):
-        """Parse fees from text and calculate the average estimates for medical
-            and insurance, if available.
+    def get_average_estimate(min_val, max_val):
+        """Calculate the average estimate from min and max values, if they
+            exist.
         """
 
-        medical = parse_fees_from_text(cost['medical_provider_reimbursement_rate'])
-        insurance = parse_fees_from_text(cost['insurance_company_reimbursement_rate'])
-
-        def get_average_estimate(fees):
-            """Calculate the average estimate from min and max values, if they
-                exist.
-            """
-
-            if fees['min_val'] and fees['max_val']:
-                min_val = locale.atof(fees['min_val'].strip('$'))
-                max_val = locale.atof(fees['max_val'].strip('$'))
-                return (min_val + max_val) / 2
-            return None
-
-        medical_estimate = get_average_estimate(medical)
-        insurance_estimate = get_average_estimate(insurance)
-
-        return medical_estimate, insurance_estimate
+        if min_val is not None and max_val is not None:
+            return float(min_val + max_val) / 2
+        return None
 
     costs = get_icd_billable_estimates(patient_id)
 
     for cost in costs:
-        medical_estimate, insurance_estimate = parse_and_calculate_estimates(cost)
+        medical_estimate = get_average_estimate(cost['medical_provider_reimbursement_min'],
+                                                cost['medical_provider_reimbursement_max'])
+        insurance_estimate = get_average_estimate(cost['insurance_company_reimbursement_min'],
+                                                  cost['insurance_company_reimbursement_max'])
 
         if medical_estimate is not None:
             print(cost['code'])
             print('medical_estimate', '${:,.2f}'.format(medical_estimate))
-            print('insurance_estimate', '${:,.2f}'.format(insurance_estimate))
+            if insurance_estimate is not None:
+                print('insurance_estimate', '${:,.2f}'.format(insurance_estimate))
 
 
 
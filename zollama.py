@@ -31,19 +31,23 @@
                    --keyfile=key.pem \
                    --bind 0.0.0.0:5000 \
                    zollama:app \
-                   --timeout 2592000 \
+                   --timeout 120 \
                    --threads 4 \
                    --reload
 
+    Analysis endpoints queue jobs and return a job id right away, job
+    workers run inside the service process (JOB_WORKERS, started when the
+    service starts, see gunicorn.conf.py) and/or as separate processes:
+
+        > python zollama_worker.py
+
     Customize it to your hearts content!
 
     LICENSE: The 3-Clause BSD License - license.txt
 
     TODO:
         - Add Swagger Docs
-        - Add long running task queue
-            - Queue: task_id, task_status, end_point
-            - Kafka
+        - Kafka for the long running task queue (see jobs.py)
         - Revisit Endpoint logic add robust error handling
         - Add scheduler app - to schedule some of these events
             - scheduler checks whether or not a similar tasks exists
@@ -53,21 +57,46 @@
 import asyncio
 import json
 import logging
+import threading
+from contextlib import closing
 from flask import Flask, request, jsonify, abort
 from flask_jwt_extended import JWTManager, jwt_required, create_access_token
 
 # Import required local modules
+from analysisbatches import run_bulk
 from config import get_config
 from clincodeutils import extract_icd10_codes
 from clincodeutils import extract_cpt_codes
 from clincodeutils import extract_hcpcs_codes
-from clincodeutils import icd_10_code_details_list
-from clincodeutils import lookup_cpt_gpt
-from clincodeutils import lookup_hcpcs_gpt
+from clincodeutils import icd_10_code_details_list_async
+from clincodeutils import lookup_cpt_gpt_async
+from clincodeutils import lookup_hcpcs_gpt_async
 from database import insert_data_into_table
-from database import get_select_query_result_dicts
+from database import register_query
+from database import run_query
+from database import stream_query_rows
+from database import get_pt_locality_and_codes
 from encryption import decrypt_text
+from encryption import encrypt_text
+from feematrix import FEE_MATRIX
+from gptutils import pin_model
+from gptutils import preload_models
 from gptutils import prompt_chat
+from gptutils import resident_models
+from gptutils import run_prompt_graph
+from gptutils import run_sync
+from gptutils import unpin_model
+from gptutils import OLLAMA_ROUTER
+from jobs import cancel_job
+from jobs import get_job
+from jobs import register_job_handler
+from jobs import start_job_workers
+from jobs import submit_job
+from normalize import normalize
+from patientcodes import store_code_items
+from pipeline import Stage
+from pipeline import StagedPipeline
+from pipeline import parse_worker_counts
 from utils import ts_int_to_dt_obj
 from utils import serialize_datetime
 
@@ -77,8 +106,35 @@ app = Flask('ZOllama-GPT')
 CONFIG = get_config()
 
 NUM_ELEMENTS_CHUNK = 25
-LLMS = CONFIG.get('service','LLMS').split(',')
-MEDLLMS = CONFIG.get('service','MEDLLMS').split(',')
+LLMS = CONFIG.llms
+MEDLLMS = CONFIG.medllms
+
+# analyze_visit_notes pipeline worker counts and queue size
+PIPELINE_WORKERS = parse_worker_counts(CONFIG.get('service', 'PIPELINE_WORKERS', fallback=''),
+                                       ['fetch', 'summarize', 'extract_codes', 'persist'])
+PIPELINE_DIAGNOSE_WORKERS = parse_worker_counts(CONFIG.get('service', 'PIPELINE_DIAGNOSE_WORKERS',
+                                                           fallback=''),
+                                                MEDLLMS)
+PIPELINE_QUEUE_SIZE = CONFIG.getint('service', 'PIPELINE_QUEUE_SIZE', fallback=32)
+
+# visit notes per batch of a bulk run, see analyze_visit_notes_bulk
+BULK_MAX_BATCH_SIZE = 1000
+BULK_BATCH_SIZE = min(max(1, CONFIG.getint('service', 'BULK_BATCH_SIZE', fallback=50)),
+                      BULK_MAX_BATCH_SIZE)
+
+SUMMARY_LLM = 'deepseek-llm'
+SUMMARY_PROMPT = "What disease does this patient have? P is patient, D is Doctor"
+DIAGNOSIS_PROMPT = 'Diagnose this patient: '
+
+# job worker threads per service process, 0 leaves jobs to zollama_worker.py
+JOB_WORKERS = CONFIG.getint('service', 'JOB_WORKERS', fallback=1)
+JOB_WORKERS_LOCK = threading.Lock()
+JOB_WORKERS_STOP = None
+
+# load LLMS and MEDLLMS (and pinned models) on the Ollama hosts at start
+OLLAMA_PRELOAD = CONFIG.getboolean('service', 'OLLAMA_PRELOAD', fallback=False)
+MODEL_WARM_UP_LOCK = threading.Lock()
+MODEL_WARM_UP = None
 
 # Flask app config
 app.config.update(
@@ -105,22 +161,86 @@ def login():
 @app.route('/analyze_visit_notes', methods=['GET'])
 @jwt_required()
 def analyze_visit_notes_endpoint():
-    """Analyze all OSCE format Visit Notes that exist in database
+    """Queue analysis of all OSCE format Visit Notes that exist in database
+    """
+
+    job_id = submit_analysis_job('analyze_visit_notes')
+    return jsonify({'message': 'analyze_visit_notes endpoint', 'job_id': job_id}), 202
+
+@app.route('/analyze_visit_notes/batch', methods=['POST'])
+@jwt_required()
+def analyze_visit_notes_batch_endpoint():
+    """Queue analysis of a list of OSCE format Visit Notes
     """
 
-    if not analyze_visit_notes():
-        abort(502, description="Ollama Server not available")
-    return jsonify({'message': 'analyze_visit_notes endpoint'})
+    visit_note_ids = (request.get_json(silent=True) or {}).get('visit_note_ids')
+    if not isinstance(visit_note_ids, list) or not visit_note_ids \
+       or not all(isinstance(an_id, str) and an_id for an_id in visit_note_ids):
+        abort(400, description="visit_note_ids must be a non-empty list of ids")
+
+    job_id = submit_analysis_job('analyze_visit_notes', visit_note_ids)
+    return jsonify({'message': 'analyze_visit_notes batch endpoint', 'job_id': job_id}), 202
+
+@app.route('/analyze_visit_notes/bulk', methods=['POST'])
+@jwt_required()
+def analyze_visit_notes_bulk_endpoint():
+    """Queue a bulk analysis, phase by phase, of the visit notes that have
+        not been analyzed yet or of a list of them
+    """
+
+    visit_note_ids = (request.get_json(silent=True) or {}).get('visit_note_ids')
+    if visit_note_ids is not None and (not isinstance(visit_note_ids, list) or not visit_note_ids
+       or not all(isinstance(an_id, str) and an_id for an_id in visit_note_ids)):
+        abort(400, description="visit_note_ids must be a non-empty list of ids")
+
+    job_id = submit_analysis_job('analyze_visit_notes_bulk', visit_note_ids)
+    return jsonify({'message': 'analyze_visit_notes bulk endpoint', 'job_id': job_id}), 202
 
 @app.route('/analyze_visit_note', methods=['GET'])
 @jwt_required()
 def analyze_visit_note_endpoint():
-    """Analyze OSCE format Visit Note that exists in the database
+    """Queue analysis of an OSCE format Visit Note that exists in the database
     """
 
     visit_note_id = request.args.get('visit_note_id')
-    analyze_visit_note(visit_note_id)
-    return jsonify({'message': 'analyze_visit_note endpoint'})
+    if not visit_note_id:
+        abort(400, description="visit_note_id is required")
+
+    job_id = submit_analysis_job('analyze_visit_notes', [visit_note_id])
+    return jsonify({'message': 'analyze_visit_note endpoint', 'job_id': job_id}), 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+@jwt_required()
+def job_status_endpoint(job_id):
+    """Status and progress of a job
+    """
+
+    job = get_job(job_id)
+    if job is None:
+        abort(404, description="Job not found")
+    return jsonify(json.loads(json.dumps(job, default=serialize_datetime)))
+
+@app.route('/jobs/<job_id>/progress', methods=['GET'])
+@jwt_required()
+def job_progress_endpoint(job_id):
+    """Progress of a job
+    """
+
+    job = get_job(job_id)
+    if job is None:
+        abort(404, description="Job not found")
+    return jsonify({'job_id': job_id, 'status': job['status'], 'progress': job['progress']})
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+@jwt_required()
+def job_cancel_endpoint(job_id):
+    """Cancel a queued or running job
+    """
+
+    status = cancel_job(job_id)
+    if status is None:
+        abort(404, description="Job not found")
+    return jsonify({'job_id': job_id, 'status': status})
 
 @app.route('/get_patient', methods=['GET'])
 @jwt_required()
@@ -132,108 +252,491 @@ def get_patient_endpoint():
     get_patient_record(patient_id)
     return jsonify({'message': 'get_patient endpoint'})
 
-def analyze_visit_notes():
-    """Analyze all visit notes in the db
+@app.route('/estimate_fees', methods=['GET'])
+@jwt_required()
+def estimate_fees_endpoint():
+    """Price the CPT codes of a patient document at the patient's locality
     """
 
-    sql_query = """SELECT
-                        patient_note_id
-                   FROM 
-                        patient_notes
-                   WHERE patient_note_id NOT IN (SELECT patient_note_id FROM patient_documents);
-                """
+    patient_document_id = request.args.get('patient_document_id')
+    if not patient_document_id:
+        abort(400, description="patient_document_id is required")
+
+    try:
+        pt_locality_codes = get_pt_locality_and_codes(patient_document_id)
+    except IndexError:
+        abort(404, description="No codes found for patient document")
+
+    try:
+        claim = FEE_MATRIX.price_claim(pt_locality_codes['codes'], pt_locality_codes['locality'])
+    except FileNotFoundError:
+        abort(503, description="Fee matrix not built, run feematrix.py or a cms.py refresh")
+    return jsonify(dict(claim, patient_id=pt_locality_codes['patient_id']))
+
+@app.route('/ollama/models', methods=['GET'])
+@jwt_required()
+def ollama_models_endpoint():
+    """Models loaded on each Ollama host, pinned models and per host
+        prompt and model load counts
+    """
+
+    return jsonify({
+                    'resident': run_sync(resident_models()),
+                    'pinned': sorted(OLLAMA_ROUTER.pinned),
+                    'endpoints': OLLAMA_ROUTER.stats()
+                   })
+
+@app.route('/ollama/models/<path:model>/pin', methods=['POST'])
+@jwt_required()
+def ollama_pin_model_endpoint(model):
+    """Load a model and keep it loaded
+    """
+
+    return jsonify({'model': model, 'pinned': True, 'loaded': run_sync(pin_model(model))})
+
+@app.route('/ollama/models/<path:model>/unpin', methods=['POST'])
+@jwt_required()
+def ollama_unpin_model_endpoint(model):
+    """Let a model be unloaded again, right away with ?unload=true
+    """
+
+    unload = request.args.get('unload', '').lower() in ('1', 'true', 'yes')
+    return jsonify({'model': model, 'pinned': False,
+                    'loaded': run_sync(unpin_model(model, unload))})
+
+def submit_analysis_job(job_type, visit_note_ids=None):
+    """Queue a job, make sure this process runs job workers
+    """
+
+    ensure_job_workers()
+    return submit_job(job_type, visit_note_ids)
+
+def ensure_job_workers():
+    """Start JOB_WORKERS job worker threads once per process, they run
+        independently of the request threads. Called when the service
+        starts so jobs queued before a restart are picked up without a
+        new request.
+    """
+
+    global JOB_WORKERS_STOP # pylint: disable=global-statement
+
+    with JOB_WORKERS_LOCK:
+        if JOB_WORKERS_STOP is None and JOB_WORKERS > 0:
+            JOB_WORKERS_STOP = start_job_workers(JOB_WORKERS)
+
+def warm_up_models():
+    """Load LLMS, MEDLLMS and pinned models on the Ollama hosts, once per
+        process and off the request threads
+    """
+
+    global MODEL_WARM_UP # pylint: disable=global-statement
+
+    models = list(dict.fromkeys(LLMS + MEDLLMS + sorted(OLLAMA_ROUTER.pinned)))
+
+    def warm_up():
+        loaded = run_sync(preload_models(models))
+        logging.info('Preloaded models: %s', loaded)
+
+    with MODEL_WARM_UP_LOCK:
+        if MODEL_WARM_UP is None and models:
+            MODEL_WARM_UP = threading.Thread(target=warm_up, name='model-warm-up', daemon=True)
+            MODEL_WARM_UP.start()
+    return MODEL_WARM_UP
+
+def run_analysis_job(job):
+    """Job handler for analyze_visit_notes jobs, see jobs.py
+    """
+
+    pipeline = visit_notes_pipeline()
+    # per visit note, a note fans out into one item per MEDLLMS model
+    #  but counts once, see pipeline.py
+    job.track(lambda: {
+                       'total': len(job.visit_note_ids) if job.visit_note_ids is not None
+                                else pipeline.stats.get('submitted'),
+                       'completed': pipeline.stats.get('completed', 0),
+                       'failed': pipeline.stats.get('failed', 0)
+                      })
+    job.on_cancel(pipeline.cancel)
+
+    stats = analyze_visit_notes(job.visit_note_ids, pipeline)
+    if not stats:
+        raise RuntimeError('Ollama Server not available')
+    return {
+            'submitted': stats['submitted'],
+            'completed': stats['completed'],
+            'failed': stats['failed'],
+            'stages': stats['stages'],
+            'elapsed_seconds': stats['elapsed_seconds']
+           }
+
+register_job_handler('analyze_visit_notes', run_analysis_job)
+
+def run_bulk_analysis_job(job):
+    """Job handler for analyze_visit_notes_bulk jobs, see jobs.py
+    """
+
+    stats = {}
+    cancel = threading.Event()
+    job.track(lambda: {
+                       'total': len(job.visit_note_ids) if job.visit_note_ids is not None
+                                else stats.get('submitted'),
+                       'completed': stats.get('completed', 0),
+                       'failed': stats.get('failed', 0)
+                      })
+    job.on_cancel(cancel.set)
+
+    if not analyze_visit_notes_bulk(job.visit_note_ids, cancelled=cancel.is_set, stats=stats):
+        raise RuntimeError('Ollama Server not available')
+    return stats
+
+register_job_handler('analyze_visit_notes_bulk', run_bulk_analysis_job)
+
+UNANALYZED_VISIT_NOTES = """SELECT
+                                patient_note_id
+                           FROM
+                                patient_notes pn
+                           WHERE NOT EXISTS (SELECT 1
+                                             FROM patient_documents pd
+                                             WHERE pd.patient_note_id = pn.patient_note_id);
+                        """
+
+def analyze_visit_notes(visit_note_ids=None, pipeline=None):
+    """Analyze visit notes, by default all visit notes in the db that have
+        not been analyzed yet
+
+        Notes go through a staged pipeline, see pipeline.py:
+            fetch/decrypt -> summarize -> diagnose (per MEDLLMS model)
+            -> extract codes -> persist
+        A note that fails is logged and counted, the run carries on.
+    """
 
-    all_visit_notes = get_select_query_result_dicts(sql_query)
-    for a_visit_note_id in all_visit_notes:
-        result = analyze_visit_note(a_visit_note_id['patient_note_id'])
-        if not result:
+    if not run_sync(OLLAMA_ROUTER.is_available()):
+        logging.error('No Ollama Server is available')
+        return False
+
+    pipeline = pipeline or visit_notes_pipeline()
+    if visit_note_ids is None:
+        # ids are streamed from a server-side cursor as the pipeline takes
+        #  them, not loaded up front
+        with closing(stream_query_rows(UNANALYZED_VISIT_NOTES, row_type='tuple')) as rows:
+            stats = pipeline.run(row[0] for row in rows)
+    else:
+        stats = pipeline.run(visit_note_ids)
+    logging.info('Analyzed %s of %s visit notes, %s failures in %ss',
+                 stats['completed'], stats['submitted'], stats['failed'],
+                 stats['elapsed_seconds'])
+    return stats
+
+def analyze_visit_notes_bulk(visit_note_ids=None, batch_size=None, cancelled=None, stats=None):
+    """Analyze visit notes in batches of batch_size (BULK_BATCH_SIZE),
+        phase by phase, so the models are loaded once per phase instead of
+        once per note, see analysisbatches.py:
+            summarize (SUMMARY_LLM) -> diagnose (each MEDLLMS model in turn)
+            -> codes (each MEDLLMS model in turn) -> lookup (CODE_LOOKUP_LLM)
+            and persist
+        By default all visit notes that have not been analyzed yet, an
+        unfinished batch of an earlier run is finished first.
+    """
+
+    if not run_sync(OLLAMA_ROUTER.is_available()):
+        logging.error('No Ollama Server is available')
+        return False
+
+    batch_size = min(max(1, batch_size or BULK_BATCH_SIZE), BULK_MAX_BATCH_SIZE)
+    stats = run_bulk(bulk_analysis_phases(), visit_note_ids, batch_size, cancelled, stats)
+    logging.info('Bulk analyzed %s of %s visit notes in %s batches, %s failures in %ss',
+                 stats['completed'], stats['submitted'], stats['batches'], stats['failed'],
+                 stats['elapsed_seconds'])
+    return stats
+
+async def for_each_note(func, visit_note_ids):
+    """Run func(visit_note_id) for every note at once, OLLAMA_ROUTER keeps
+        the prompts within the hosts' max_concurrency. A note that fails is
+        logged, the others carry on.
+    """
+
+    results = await asyncio.gather(*(func(visit_note_id) for visit_note_id in visit_note_ids),
+                                   return_exceptions=True)
+    for visit_note_id, result in zip(visit_note_ids, results):
+        if isinstance(result, Exception):
+            logging.error('Visit note %s failed: %s', visit_note_id[0:10], result)
+
+def encrypt_prompt_results(results):
+    """Code prompt results as a bulk run keeps them between phases, every
+        analysis encrypted when patient data encryption is enabled
+    """
+
+    if not CONFIG.patient_data_encryption_enabled:
+        return results
+    return {prompt_key: dict(result, analysis=encrypt_text(result['analysis']).decode('utf-8'),
+                             encrypted=True)
+            for prompt_key, result in results.items()}
+
+def decrypt_prompt_results(results):
+    """Code prompt results kept by encrypt_prompt_results, decrypted
+    """
+
+    decrypted = {}
+    for prompt_key, result in results.items():
+        if result.get('encrypted'):
+            result = {key: value for key, value in result.items() if key != 'encrypted'}
+            result['analysis'] = decrypt_text(result['analysis'])
+        decrypted[prompt_key] = result
+    return decrypted
+
+def bulk_analysis_phases():
+    """Phases of analyze_visit_notes_bulk, each one runs every prompt of
+        the batch with one model before the next model's prompts
+    """
+
+    def summarize(batch):
+        async def summarize_note(visit_note_id):
+            visit_notes = await asyncio.to_thread(fetch_visit_notes, visit_note_id)
+            if not visit_notes:
+                return
+            visit_note = visit_notes[0]
+            summarized_obj = await prompt_chat(SUMMARY_LLM, SUMMARY_PROMPT + visit_note['content'])
+            if summarized_obj:
+                # the note itself is not kept, it is only read here
+                summarized_obj = dict(summarized_obj,
+                                      patient_id=visit_note['patient_id'],
+                                      patient_locality=visit_note['patient_locality'])
+                await asyncio.to_thread(batch.store, 'summarize', visit_note_id, summarized_obj)
+
+        run_sync(for_each_note(summarize_note, batch.pending('summarize')))
+
+    def diagnose(batch):
+        for llm in MEDLLMS:
+            async def diagnose_note(visit_note_id, llm=llm):
+                summarized_obj = batch.result('summarize', visit_note_id)
+                analyzed_obj = await prompt_chat(llm, DIAGNOSIS_PROMPT +
+                                                      decrypt_text(summarized_obj['analysis']))
+                if analyzed_obj:
+                    await asyncio.to_thread(batch.store, 'diagnose', visit_note_id, analyzed_obj,
+                                            llm)
+
+            run_sync(for_each_note(diagnose_note, batch.pending('diagnose', llm, 'summarize')))
+
+    def codes(batch):
+        for llm in MEDLLMS:
+            async def code_prompts_note(visit_note_id, llm=llm):
+                analyzed_obj = batch.result('diagnose', visit_note_id, llm)
+                prompts = code_prompts(llm)
+                stages = code_prompt_stages(llm, prompts, decrypt_text(analyzed_obj['analysis']))
+                results = await run_prompt_graph({name: stages[name] for name in prompts})
+                if all(results.values()):
+                    await asyncio.to_thread(batch.store, 'codes', visit_note_id,
+                                            encrypt_prompt_results(results), llm)
+
+            run_sync(for_each_note(code_prompts_note,
+                                   batch.pending('codes', llm, 'diagnose', llm)))
+
+    def lookup(batch):
+        async def lookup_note(visit_note_id, llm):
+            summarized_obj = batch.result('summarize', visit_note_id)
+            analyzed_obj = batch.result('diagnose', visit_note_id, llm)
+            # the code prompts ran in the codes phase, only lookups are left
+            prompt_results = decrypt_prompt_results(batch.result('codes', visit_note_id, llm))
+            results = await run_prompt_graph(code_prompt_stages(llm, code_prompts(llm), None,
+                                                                prompt_results))
+            visit_note = {
+                          'patient_id': summarized_obj['patient_id'],
+                          'patient_note_id': visit_note_id,
+                          'patient_locality': summarized_obj['patient_locality']
+                         }
+            await asyncio.to_thread(store_icd_cpt_codes, visit_note['patient_id'],
+                                    analyzed_obj['shasum_512'], build_codes_document(results))
+            await asyncio.to_thread(store_visit_note_analysis, visit_note, llm, summarized_obj,
+                                    analyzed_obj)
+            await asyncio.to_thread(batch.store, 'lookup', visit_note_id,
+                                    {'patient_document_id': analyzed_obj['shasum_512']}, llm)
+
+        async def lookup_all():
+            # every lookup prompt runs with CODE_LOOKUP_LLM, whatever llm
+            #  the codes came from
+            await asyncio.gather(*(for_each_note(lambda visit_note_id, llm=llm:
+                                                     lookup_note(visit_note_id, llm),
+                                                 batch.pending('lookup', llm, 'codes', llm))
+                                   for llm in MEDLLMS))
+
+        run_sync(lookup_all())
+
+    return [
+            ('summarize', summarize),
+            ('diagnose', diagnose),
+            ('codes', codes),
+            ('lookup', lookup)
+           ]
+
+def visit_notes_pipeline():
+    """Staged pipeline used by analyze_visit_notes, worker counts per stage
+        (and per model for the diagnose stage) come from setup.config
+    """
+
+    def fetch(visit_note_id):
+        return fetch_visit_notes(visit_note_id)
+
+    def summarize(visit_note):
+        summarized_obj = summarize_visit_note(visit_note)
+        if not summarized_obj:
             return False
-    return True
+        return [dict(visit_note, llm=llm, summarized_obj=summarized_obj) for llm in MEDLLMS]
+
+    def diagnose(visit_note):
+        analyzed_obj = diagnose_visit_note(visit_note['llm'], visit_note['summarized_obj'])
+        if not analyzed_obj:
+            return False
+        return [dict(visit_note, analyzed_obj=analyzed_obj)]
+
+    def extract_codes(visit_note):
+        codes_document = get_icd_cpt_codes(visit_note['llm'],
+                                           decrypt_text(visit_note['analyzed_obj']['analysis']))
+        return [dict(visit_note, codes_document=codes_document)]
+
+    def persist(visit_note):
+        store_icd_cpt_codes(visit_note['patient_id'],
+                            visit_note['analyzed_obj']['shasum_512'],
+                            visit_note['codes_document'])
+        store_visit_note_analysis(visit_note,
+                                  visit_note['llm'],
+                                  visit_note['summarized_obj'],
+                                  visit_note['analyzed_obj'])
+        return []
+
+    stages = [
+              Stage('fetch', fetch, PIPELINE_WORKERS['fetch']),
+              Stage('summarize', summarize, PIPELINE_WORKERS['summarize']),
+              Stage('diagnose', diagnose, PIPELINE_DIAGNOSE_WORKERS,
+                    key=lambda visit_note: visit_note['llm']),
+              Stage('extract_codes', extract_codes, PIPELINE_WORKERS['extract_codes']),
+              Stage('persist', persist, PIPELINE_WORKERS['persist'])
+             ]
+
+    def item_id(item):
+        visit_note_id = item['patient_note_id'] if isinstance(item, dict) else item
+        return visit_note_id[0:10]
+
+    return StagedPipeline(stages, queue_size=PIPELINE_QUEUE_SIZE, item_id=item_id)
 
 def analyze_visit_note(visit_note_id):
     """Analyze a specific visit note that exists in the database
     """
 
-    encrypt_analysis = CONFIG.getboolean('service', 'PATIENT_DATA_ENCRYPTION_ENABLED')
+    visit_notes = fetch_visit_notes(visit_note_id)
+
+    for visit_note in visit_notes:
+        summarized_obj = summarize_visit_note(visit_note)
+
+        if not summarized_obj:
+            return False
 
-    sql_query = f"""SELECT
-                        patient_id, patient_note_id, patient_note, patient_note ->> 'locality' as patient_locality
+        # process diagnosis for ICD/CPT codes
+        for llm in MEDLLMS:
+            analyzed_obj = diagnose_visit_note(llm, summarized_obj)
+            if not analyzed_obj:
+                return False
+
+            # decrypt analysis result for ICD/CPT processing only
+            decrypted_analysis = decrypt_text(analyzed_obj['analysis'])
+            get_store_icd_cpt_codes(
+                                    visit_note['patient_id'],
+                                    analyzed_obj['shasum_512'],
+                                    llm,
+                                    decrypted_analysis
+                                   )
+
+            store_visit_note_analysis(visit_note, llm, summarized_obj, analyzed_obj)
+    return True
+
+register_query('fetch_visit_notes',
+               """SELECT
+                        patient_id, patient_note_id, patient_note, patient_locality
                    FROM
                         patient_notes
-                   WHERE patient_note_id = '{visit_note_id}';
-                """
+                   WHERE patient_note_id = %s;
+                """)
+
+def fetch_visit_notes(visit_note_id):
+    """Get a visit note from the database, note content is decrypted
+    """
 
-    visit_notes = get_select_query_result_dicts(sql_query)
+    visit_notes = run_query('fetch_visit_notes', (visit_note_id,))
 
     for visit_note in visit_notes:
-        logging.info(visit_note['patient_note_id'][0:10])
-        patient_id = visit_note['patient_id']
-        patient_note_id = visit_note['patient_note_id']
-
         # decrypt patient note content
-        content = decrypt_text(visit_note['patient_note']['note'])
-
-        prompt = "What disease does this patient have? P is patient, D is Doctor"
-        summarized_obj = asyncio.run(prompt_chat('deepseek-llm', prompt + content))
-
-        if summarized_obj:
-            recommended_diagnosis = decrypt_text(summarized_obj['analysis'])
-
-            # process diagnosis for ICD/CPT codes
-            for llm in MEDLLMS:
-                analyzed_obj = asyncio.run(
-                                           prompt_chat(
-                                                       llm,
-                                                       'Diagnose this patient: ' +
-                                                       recommended_diagnosis
-                                                      )
-                                          )
-
-                # decrypt analysis result for ICD/CPT processing only
-                decrypted_analysis = decrypt_text(analyzed_obj['analysis'])
-                get_store_icd_cpt_codes(
-                                        patient_id,
-                                        analyzed_obj['shasum_512'],
-                                        llm,
-                                        decrypted_analysis
-                                       )
-
-                if not encrypt_analysis:
-                    app.logger.error('URGENT: Patient Data Encryption disabled! \
-                                If spotted in Production logs, notify immediately!')
-
-                # construct patient data object for storage
-                patient_data_obj = {
-                                    'schema_version': '4',
-                                    'llm': llm,
-                                    'source': 'healthcare',
-                                    'category': 'patient',
-                                    'patient_id': patient_id,
-                                    'patient_note_id': patient_note_id,
-                                    'osce_note_summarized': summarized_obj['analysis'],
-                                    'analysis_document': analyzed_obj['analysis']
-                                   }
-
-                patient_analysis_data = {
-                                         'timestamp': analyzed_obj['timestamp'],
-                                         'patient_document_id': analyzed_obj['shasum_512'],
-                                          'patient_locality' : visit_note['patient_locality'],
-                                         'patient_id': patient_id,
-                                         'patient_note_id': patient_note_id,
-                                         #json.loads this when read back from database
-                                         'analysis_document': json.dumps(patient_data_obj)
-                                        }
-
-                insert_data_into_table('patient_documents', patient_analysis_data)
-                return True
-        else:
-            return False
+        visit_note['content'] = decrypt_text(visit_note['patient_note']['note'])
+
+    return visit_notes
+
+def summarize_visit_note(visit_note):
+    """Summarize a visit note with deepseek-llm
+    """
+
+    logging.info(visit_note['patient_note_id'][0:10])
+    return run_sync(prompt_chat(SUMMARY_LLM, SUMMARY_PROMPT + visit_note['content']))
+
+def diagnose_visit_note(llm, summarized_obj):
+    """Diagnose the summarized visit note with a medical llm
+    """
+
+    recommended_diagnosis = decrypt_text(summarized_obj['analysis'])
+    return run_sync(
+                    prompt_chat(
+                                llm,
+                                DIAGNOSIS_PROMPT +
+                                recommended_diagnosis
+                               )
+                   )
+
+def store_visit_note_analysis(visit_note, llm, summarized_obj, analyzed_obj):
+    """Store the analysis of a visit note
+    """
+
+    encrypt_analysis = CONFIG.patient_data_encryption_enabled
+
+    if not encrypt_analysis:
+        app.logger.error('URGENT: Patient Data Encryption disabled! \
+                    If spotted in Production logs, notify immediately!')
+
+    patient_id = visit_note['patient_id']
+    patient_note_id = visit_note['patient_note_id']
+
+    # construct patient data object for storage
+    patient_data_obj = {
+                        'schema_version': '4',
+                        'llm': llm,
+                        'source': 'healthcare',
+                        'category': 'patient',
+                        'patient_id': patient_id,
+                        'patient_note_id': patient_note_id,
+                        'osce_note_summarized': summarized_obj['analysis'],
+                        'analysis_document': analyzed_obj['analysis']
+                       }
+
+    patient_analysis_data = {
+                             'timestamp': analyzed_obj['timestamp'],
+                             'patient_document_id': analyzed_obj['shasum_512'],
+                             'patient_locality' : visit_note['patient_locality'],
+                             'patient_id': patient_id,
+                             'patient_note_id': patient_note_id,
+                             #json.loads this when read back from database
+                             'analysis_document': json.dumps(patient_data_obj)
+                            }
+
+    insert_data_into_table('patient_documents', patient_analysis_data)
 
 def get_store_icd_cpt_codes(patient_id, patient_document_id, llm, analyzed_content):
     """Get icd and cpt codes for the diagnosis and store the two
         as JSON in the table
     """
 
+    codes_document = get_icd_cpt_codes(llm, analyzed_content)
+    store_icd_cpt_codes(patient_id, patient_document_id, codes_document)
+
+def code_prompts(llm):
+    """Code prompts of get_icd_cpt_codes for llm, by prompt key
+    """
+
     prompts = {
                'icd': 'What are the ICD codes for this diagnosis? ',
                'cpt': 'What are the CPT codes for this diagnosis? ',
@@ -246,66 +749,42 @@ def get_store_icd_cpt_codes(patient_id, patient_document_id, llm, analyzed_conte
     # adjust prompts if llm is 'meditron'
     if llm == 'meditron':
         prompts['prescription_cpt'] = prompts['prescription']
+    return prompts
+
+def get_icd_cpt_codes(llm, analyzed_content):
+    """Get icd, cpt, hcpcs and prescription codes for the diagnosis
+    """
+
+    results = run_sync(run_prompt_graph(code_prompt_stages(llm, code_prompts(llm),
+                                                           analyzed_content)))
+    return build_codes_document(results)
+
+def build_codes_document(results):
+    """Codes document from the results of the code_prompt_stages graph
+    """
 
-    # do not encrypt
-    icd_obj = asyncio.run(prompt_chat(llm, prompts['icd'] + analyzed_content, False))
-
-    # do not encrypt
-    cpt_obj = asyncio.run(prompt_chat(llm, prompts['cpt'] + analyzed_content, False))
-
-    # do not encrypt
-    hcpcs_obj = asyncio.run(prompt_chat(llm, prompts['hcpcs'] + analyzed_content, False))
-
-    # do not encrypt
-    prescription_obj = asyncio.run(
-                                   prompt_chat(
-                                               llm,
-                                               prompts['prescription'] + analyzed_content,
-                                               False
-                                              )
-                                  )
-    prescription_analysis = prescription_obj['analysis']
-
-    # do not encrypt
-    prescription_cpt_obj = asyncio.run(
-                                       prompt_chat(
-                                                   llm,
-                                                   prompts['prescription_cpt'] +
-                                                   prescription_analysis,
-                                                   False
-                                                  )
-                                      )
-    # do not encrypt
-    prescription_hcpcs_obj = asyncio.run(
-                                         prompt_chat(
-                                                     llm,
-                                                     prompts['prescription_hcpcs'] +
-                                                     prescription_analysis,
-                                                     False
-                                                    )
-                                        )
-
-    icd_10_code_details = icd_10_code_details_list(extract_icd10_codes(icd_obj['analysis']))
-    prescription_cpt_details = lookup_cpt_gpt(extract_cpt_codes(prescription_cpt_obj['analysis']))
-    prescription_hcpcs_details = lookup_hcpcs_gpt(extract_hcpcs_codes(prescription_hcpcs_obj['analysis']))
-
-    hcpcs_codes = extract_hcpcs_codes(hcpcs_obj['analysis'])
+    icd_obj = results['icd']
+    cpt_obj = results['cpt']
+    hcpcs_obj = results['hcpcs']
+    prescription_obj = results['prescription']
+    prescription_cpt_obj = results['prescription_cpt']
+    prescription_hcpcs_obj = results['prescription_hcpcs']
 
     codes_document = {
                       'icd': {
                               'timestamp': serialize_datetime(icd_obj['timestamp']),
                               'codes': extract_icd10_codes(icd_obj['analysis']),
-                              'details': icd_10_code_details
+                              'details': results['icd_details']
                              },
                       'cpt': {
                               'timestamp': serialize_datetime(cpt_obj['timestamp']),
                               'codes': extract_cpt_codes(cpt_obj['analysis']),
-                              'details': lookup_cpt_gpt(extract_cpt_codes(cpt_obj['analysis']))
+                              'details': results['cpt_details']
                              },
                       'hcpcs': {
                                 'timestamp': serialize_datetime(hcpcs_obj['timestamp']),
-                                'codes': hcpcs_codes,
-                                'details': lookup_hcpcs_gpt(hcpcs_codes)
+                                'codes': extract_hcpcs_codes(hcpcs_obj['analysis']),
+                                'details': results['hcpcs_details']
                                },
                       'prescription': {
                                        'timestamp': serialize_datetime(prescription_obj['timestamp']),
@@ -314,17 +793,28 @@ def get_store_icd_cpt_codes(patient_id, patient_document_id, llm, analyzed_conte
                       'prescription_cpt': {
                                            'timestamp': serialize_datetime(prescription_cpt_obj['timestamp']),
                                            'codes': extract_cpt_codes(prescription_cpt_obj['analysis']),
-                                           'details': prescription_cpt_details
+                                           'details': results['prescription_cpt_details']
                                           },
                       'prescription_hcpcs': {
                                              'timestamp': serialize_datetime(prescription_hcpcs_obj['timestamp']),
                                              'codes': extract_cpt_codes(prescription_hcpcs_obj['analysis']),
-                                             'details': prescription_hcpcs_details
+                                             'details': results['prescription_hcpcs_details']
                                             }
                      }
+    # line breaks and runs of blanks in the LLM written details
+    for section in codes_document.values():
+        normalize(section.get('details', []))
 
+    return codes_document
+
+def store_icd_cpt_codes(patient_id, patient_document_id, codes_document):
+    """Store icd and cpt codes document in the table, and a row per code
+        in patient_code_items
+    """
+
+    timestamp = serialize_datetime(ts_int_to_dt_obj())
     codes_data = {
-                  'timestamp': serialize_datetime(ts_int_to_dt_obj()),
+                  'timestamp': timestamp,
                   'patient_id': patient_id,
                   'patient_document_id': patient_document_id,
                   #json.loads this when read back from database
@@ -332,13 +822,61 @@ def get_store_icd_cpt_codes(patient_id, patient_document_id, llm, analyzed_conte
                  }
 
     insert_data_into_table('patient_codes', codes_data)
+    store_code_items(patient_id, patient_document_id, codes_document, timestamp)
 
-def get_patient_record(patient_id):
-    """Get all notes, documents, and billing information available
-        for a given patient_id
+def code_prompt_stages(llm, prompts, analyzed_content, prompt_results=None):
+    """Stage graph for get_store_icd_cpt_codes
+
+        The icd, cpt, hcpcs and prescription prompts only need the
+        diagnosis so they run concurrently. The prescription_* prompts
+        start as soon as the prescription prompt finishes, and each code
+        lookup starts as soon as the prompt it reads from finishes.
+
+        prompt_results has the results of prompts that already ran, by
+        prompt key, those are not asked again.
     """
 
-    sql_query = f"""
+    def ask(prompt_key, source=None):
+        async def stage(dep_results):
+            if prompt_results and prompt_key in prompt_results:
+                return prompt_results[prompt_key]
+            content = dep_results[source]['analysis'] if source else analyzed_content
+            # do not encrypt
+            return await prompt_chat(llm, prompts[prompt_key] + content, False)
+        return stage
+
+    def lookup(lookup_func, extract_func, source):
+        async def stage(dep_results):
+            return await lookup_func(extract_func(dep_results[source]['analysis']))
+        return stage
+
+    stages = {
+              'icd': ((), ask('icd')),
+              'cpt': ((), ask('cpt')),
+              'hcpcs': ((), ask('hcpcs')),
+              'prescription': ((), ask('prescription')),
+              'prescription_cpt': (('prescription',),
+                                   ask('prescription_cpt', 'prescription')),
+              'prescription_hcpcs': (('prescription',),
+                                     ask('prescription_hcpcs', 'prescription')),
+              'icd_details': (('icd',),
+                              lookup(icd_10_code_details_list_async, extract_icd10_codes, 'icd')),
+              'cpt_details': (('cpt',),
+                              lookup(lookup_cpt_gpt_async, extract_cpt_codes, 'cpt')),
+              'hcpcs_details': (('hcpcs',),
+                                lookup(lookup_hcpcs_gpt_async, extract_hcpcs_codes, 'hcpcs')),
+              'prescription_cpt_details': (('prescription_cpt',),
+                                           lookup(lookup_cpt_gpt_async, extract_cpt_codes,
+                                                  'prescription_cpt')),
+              'prescription_hcpcs_details': (('prescription_hcpcs',),
+                                             lookup(lookup_hcpcs_gpt_async, extract_hcpcs_codes,
+                                                    'prescription_hcpcs'))
+             }
+
+    return stages
+
+register_query('get_patient_record',
+               """
                     SELECT
                         pn.patient_id,
                         pn.patient_note_id,
@@ -356,16 +894,25 @@ def get_patient_record(patient_id):
                         AND pd.patient_document_id = pc.patient_document_id
                     WHERE
                         pd.patient_document_id IS NOT NULL
-                        AND pn.patient_id = '{patient_id}';
-                 """
+                        AND pn.patient_id = %s;
+                 """)
 
-    patient_record = get_select_query_result_dicts(sql_query)
+def get_patient_record(patient_id):
+    """Get all notes, documents, and billing information available
+        for a given patient_id
+    """
+
+    patient_record = run_query('get_patient_record', (patient_id,))
 
     return patient_record
 
+if OLLAMA_PRELOAD:
+    warm_up_models()
+
 if __name__ == "__main__":
 
     logging.basicConfig(level=logging.INFO) # init logging
+    ensure_job_workers()
 
     # non-production WSGI settings:
     #  port 5000, listen to local ip address, use ssl
@@ -51,6 +51,133 @@ SET default_tablespace = '';
 
 SET default_table_access_method = heap;
 
+--
+-- Name: analysis_batch_results; Type: TABLE; Schema: public; Owner: zollama
+--
+
+CREATE TABLE public.analysis_batch_results (
+    id integer NOT NULL,
+    batch_id text NOT NULL,
+    patient_note_id text NOT NULL,
+    phase text NOT NULL,
+    llm text DEFAULT ''::text NOT NULL,
+    "timestamp" timestamp with time zone NOT NULL,
+    result_document jsonb NOT NULL
+);
+
+
+ALTER TABLE public.analysis_batch_results OWNER TO zollama;
+
+--
+-- Name: analysis_batch_results_id_seq; Type: SEQUENCE; Schema: public; Owner: zollama
+--
+
+ALTER TABLE public.analysis_batch_results ALTER COLUMN id ADD GENERATED BY DEFAULT AS IDENTITY (
+    SEQUENCE NAME public.analysis_batch_results_id_seq
+    START WITH 1
+    INCREMENT BY 1
+    NO MINVALUE
+    NO MAXVALUE
+    CACHE 1
+);
+
+
+--
+-- Name: analysis_batches; Type: TABLE; Schema: public; Owner: zollama
+--
+
+CREATE TABLE public.analysis_batches (
+    id integer NOT NULL,
+    batch_id text NOT NULL,
+    run_id text NOT NULL,
+    "timestamp" timestamp with time zone NOT NULL,
+    updated timestamp with time zone NOT NULL,
+    phase text NOT NULL,
+    visit_note_ids jsonb NOT NULL
+);
+
+
+ALTER TABLE public.analysis_batches OWNER TO zollama;
+
+--
+-- Name: analysis_batches_id_seq; Type: SEQUENCE; Schema: public; Owner: zollama
+--
+
+ALTER TABLE public.analysis_batches ALTER COLUMN id ADD GENERATED BY DEFAULT AS IDENTITY (
+    SEQUENCE NAME public.analysis_batches_id_seq
+    START WITH 1
+    INCREMENT BY 1
+    NO MINVALUE
+    NO MAXVALUE
+    CACHE 1
+);
+
+
+--
+-- Name: analysis_jobs; Type: TABLE; Schema: public; Owner: zollama
+--
+
+CREATE TABLE public.analysis_jobs (
+    id integer NOT NULL,
+    job_id text NOT NULL,
+    "timestamp" timestamp with time zone NOT NULL,
+    updated timestamp with time zone NOT NULL,
+    job_type text NOT NULL,
+    status text NOT NULL,
+    job_document jsonb NOT NULL,
+    progress jsonb NOT NULL,
+    result jsonb,
+    error text,
+    lease_expires timestamp with time zone
+);
+
+
+ALTER TABLE public.analysis_jobs OWNER TO zollama;
+
+--
+-- Name: analysis_jobs_id_seq; Type: SEQUENCE; Schema: public; Owner: zollama
+--
+
+ALTER TABLE public.analysis_jobs ALTER COLUMN id ADD GENERATED BY DEFAULT AS IDENTITY (
+    SEQUENCE NAME public.analysis_jobs_id_seq
+    START WITH 1
+    INCREMENT BY 1
+    NO MINVALUE
+    NO MAXVALUE
+    CACHE 1
+);
+
+
+--
+-- Name: code_details; Type: TABLE; Schema: public; Owner: zollama
+--
+
+CREATE TABLE public.code_details (
+    id integer NOT NULL,
+    "timestamp" timestamp with time zone NOT NULL,
+    code_system text NOT NULL,
+    code text NOT NULL,
+    prompt_version text NOT NULL,
+    details_document jsonb NOT NULL
+);
+
+
+ALTER TABLE public.code_details OWNER TO zollama;
+
+--
+-- Name: code_details_id_seq; Type: SEQUENCE; Schema: public; Owner: zollama
+--
+
+ALTER TABLE public.code_details ALTER COLUMN id ADD GENERATED BY DEFAULT AS IDENTITY (
+    SEQUENCE NAME public.code_details_id_seq
+    START WITH 1
+    INCREMENT BY 1
+    NO MINVALUE
+    NO MAXVALUE
+    CACHE 1
+);
+
+
 --
 -- Name: cpt_hcpcs_codes; Type: TABLE; Schema: public; Owner: zollama
 --
@@ -59,7 +186,17 @@ CREATE TABLE public.cpt_hcpcs_codes (
     id integer NOT NULL,
     "timestamp" timestamp with time zone NOT NULL,
     sha256 text NOT NULL,
-    codes_document jsonb NOT NULL
+    codes_document jsonb NOT NULL,
+    first_snapshot_id integer,
+    retired_snapshot_id integer,
+    hcpc text GENERATED ALWAYS AS ((codes_document ->> 'hcpc'::text)) STORED,
+    locality text GENERATED ALWAYS AS ((codes_document ->> 'locality'::text)) STORED,
+    modifier text GENERATED ALWAYS AS (COALESCE((codes_document ->> 'modifier'::text), ''::text)) STORED,
+    fac_price numeric GENERATED ALWAYS AS ((NULLIF((codes_document ->> 'fac_price'::text), ''::text))::numeric) STORED,
+    nfac_price numeric GENERATED ALWAYS AS ((NULLIF((codes_document ->> 'nfac_price'::text), ''::text))::numeric) STORED,
+    fac_limiting_charge numeric GENERATED ALWAYS AS ((NULLIF((codes_document ->> 'fac_limiting_charge'::text), ''::text))::numeric) STORED,
+    nfac_limiting_charge numeric GENERATED ALWAYS AS ((NULLIF((codes_document ->> 'nfac_limiting_charge'::text), ''::text))::numeric) STORED,
+    conv_fact numeric GENERATED ALWAYS AS ((NULLIF((codes_document ->> 'conv_fact'::text), ''::text))::numeric) STORED
 );
 
 
@@ -96,6 +233,65 @@ CREATE TABLE public.embeddings (
 
 ALTER TABLE public.embeddings OWNER TO zollama;
 
+--
+-- Name: fee_schedule_snapshots; Type: TABLE; Schema: public; Owner: zollama
+--
+
+CREATE TABLE public.fee_schedule_snapshots (
+    id integer NOT NULL,
+    "timestamp" timestamp with time zone NOT NULL,
+    label text NOT NULL,
+    effective_date date NOT NULL,
+    status text DEFAULT 'loading'::text NOT NULL,
+    stats jsonb
+);
+
+
+ALTER TABLE public.fee_schedule_snapshots OWNER TO zollama;
+
+--
+-- Name: fee_schedule_snapshots_id_seq; Type: SEQUENCE; Schema: public; Owner: zollama
+--
+
+ALTER TABLE public.fee_schedule_snapshots ALTER COLUMN id ADD GENERATED BY DEFAULT AS IDENTITY (
+    SEQUENCE NAME public.fee_schedule_snapshots_id_seq
+    START WITH 1
+    INCREMENT BY 1
+    NO MINVALUE
+    NO MAXVALUE
+    CACHE 1
+);
+
+
+--
+-- Name: llm_response_cache; Type: TABLE; Schema: public; Owner: zollama
+--
+
+CREATE TABLE public.llm_response_cache (
+    id integer NOT NULL,
+    "timestamp" timestamp with time zone NOT NULL,
+    cache_key text NOT NULL,
+    model text NOT NULL,
+    response_document jsonb NOT NULL
+);
+
+
+ALTER TABLE public.llm_response_cache OWNER TO zollama;
+
+--
+-- Name: llm_response_cache_id_seq; Type: SEQUENCE; Schema: public; Owner: zollama
+--
+
+ALTER TABLE public.llm_response_cache ALTER COLUMN id ADD GENERATED BY DEFAULT AS IDENTITY (
+    SEQUENCE NAME public.llm_response_cache_id_seq
+    START WITH 1
+    INCREMENT BY 1
+    NO MINVALUE
+    NO MAXVALUE
+    CACHE 1
+);
+
+
 --
 -- Name: medicare_data; Type: TABLE; Schema: public; Owner: zollama
 --
@@ -126,6 +322,46 @@ CREATE TABLE public.old_patient_codes (
 
 ALTER TABLE public.old_patient_codes OWNER TO zollama;
 
+--
+-- Name: patient_code_items; Type: TABLE; Schema: public; Owner: zollama
+--
+
+CREATE TABLE public.patient_code_items (
+    id integer NOT NULL,
+    "timestamp" timestamp with time zone NOT NULL,
+    patient_id text NOT NULL,
+    patient_document_id text NOT NULL,
+    source text NOT NULL,
+    code_system text NOT NULL,
+    code text NOT NULL,
+    "position" integer NOT NULL,
+    billable boolean,
+    short_description text,
+    insurance_reimbursement_rate text,
+    insurance_reimbursement_min numeric,
+    insurance_reimbursement_max numeric,
+    provider_reimbursement_rate text,
+    provider_reimbursement_min numeric,
+    provider_reimbursement_max numeric
+);
+
+
+ALTER TABLE public.patient_code_items OWNER TO zollama;
+
+--
+-- Name: patient_code_items_id_seq; Type: SEQUENCE; Schema: public; Owner: zollama
+--
+
+ALTER TABLE public.patient_code_items ALTER COLUMN id ADD GENERATED BY DEFAULT AS IDENTITY (
+    SEQUENCE NAME public.patient_code_items_id_seq
+    START WITH 1
+    INCREMENT BY 1
+    NO MINVALUE
+    NO MAXVALUE
+    CACHE 1
+);
+
+
 --
 -- Name: patient_codes; Type: TABLE; Schema: public; Owner: zollama
 --
@@ -195,7 +431,8 @@ CREATE TABLE public.patient_notes (
     "timestamp" timestamp with time zone NOT NULL,
     patient_note_id text NOT NULL,
     patient_id text NOT NULL,
-    patient_note jsonb NOT NULL
+    patient_note jsonb NOT NULL,
+    patient_locality text GENERATED ALWAYS AS ((patient_note ->> 'locality'::text)) STORED
 );
 
 
@@ -215,6 +452,83 @@ ALTER TABLE public.patient_notes ALTER COLUMN id ADD GENERATED BY DEFAULT AS IDE
 );
 
 
+--
+-- Name: schema_migrations; Type: TABLE; Schema: public; Owner: zollama
+--
+
+CREATE TABLE public.schema_migrations (
+    version text NOT NULL,
+    name text NOT NULL,
+    applied timestamp with time zone NOT NULL
+);
+
+
+ALTER TABLE public.schema_migrations OWNER TO zollama;
+
+--
+-- Name: analysis_batch_results analysis_batch_results_batch_note_phase_llm_key; Type: CONSTRAINT; Schema: public; Owner: zollama
+--
+
+ALTER TABLE ONLY public.analysis_batch_results
+    ADD CONSTRAINT analysis_batch_results_batch_note_phase_llm_key UNIQUE (batch_id, patient_note_id, phase, llm);
+
+
+--
+-- Name: analysis_batch_results analysis_batch_results_pkey; Type: CONSTRAINT; Schema: public; Owner: zollama
+--
+
+ALTER TABLE ONLY public.analysis_batch_results
+    ADD CONSTRAINT analysis_batch_results_pkey PRIMARY KEY (id);
+
+
+--
+-- Name: analysis_batches analysis_batches_batch_id_key; Type: CONSTRAINT; Schema: public; Owner: zollama
+--
+
+ALTER TABLE ONLY public.analysis_batches
+    ADD CONSTRAINT analysis_batches_batch_id_key UNIQUE (batch_id);
+
+
+--
+-- Name: analysis_batches analysis_batches_pkey; Type: CONSTRAINT; Schema: public; Owner: zollama
+--
+
+ALTER TABLE ONLY public.analysis_batches
+    ADD CONSTRAINT analysis_batches_pkey PRIMARY KEY (id);
+
+
+--
+-- Name: analysis_jobs analysis_jobs_job_id_key; Type: CONSTRAINT; Schema: public; Owner: zollama
+--
+
+ALTER TABLE ONLY public.analysis_jobs
+    ADD CONSTRAINT analysis_jobs_job_id_key UNIQUE (job_id);
+
+
+--
+-- Name: analysis_jobs analysis_jobs_pkey; Type: CONSTRAINT; Schema: public; Owner: zollama
+--
+
+ALTER TABLE ONLY public.analysis_jobs
+    ADD CONSTRAINT analysis_jobs_pkey PRIMARY KEY (id);
+
+
+--
+-- Name: code_details code_details_pkey; Type: CONSTRAINT; Schema: public; Owner: zollama
+--
+
+ALTER TABLE ONLY public.code_details
+    ADD CONSTRAINT code_details_pkey PRIMARY KEY (id);
+
+
+--
+-- Name: code_details code_details_code_system_code_prompt_version_key; Type: CONSTRAINT; Schema: public; Owner: zollama
+--
+
+ALTER TABLE ONLY public.code_details
+    ADD CONSTRAINT code_details_code_system_code_prompt_version_key UNIQUE (code_system, code, prompt_version);
+
+
 --
 -- Name: cpt_hcpcs_codes cpt_hcpcs_codes_pkey1; Type: CONSTRAINT; Schema: public; Owner: zollama
 --
@@ -224,11 +538,11 @@ ALTER TABLE ONLY public.cpt_hcpcs_codes
 
 
 --
--- Name: cpt_hcpcs_codes cpt_hcpcs_codes_sha256_key; Type: CONSTRAINT; Schema: public; Owner: zollama
+-- Name: cpt_hcpcs_codes cpt_hcpcs_codes_sha256_first_snapshot_id_key; Type: CONSTRAINT; Schema: public; Owner: zollama
 --
 
 ALTER TABLE ONLY public.cpt_hcpcs_codes
-    ADD CONSTRAINT cpt_hcpcs_codes_sha256_key UNIQUE (sha256);
+    ADD CONSTRAINT cpt_hcpcs_codes_sha256_first_snapshot_id_key UNIQUE (sha256, first_snapshot_id);
 
 
 --
@@ -239,6 +553,54 @@ ALTER TABLE ONLY public.embeddings
     ADD CONSTRAINT embeddings_pkey PRIMARY KEY (id);
 
 
+--
+-- Name: fee_schedule_snapshots fee_schedule_snapshots_label_key; Type: CONSTRAINT; Schema: public; Owner: zollama
+--
+
+ALTER TABLE ONLY public.fee_schedule_snapshots
+    ADD CONSTRAINT fee_schedule_snapshots_label_key UNIQUE (label);
+
+
+--
+-- Name: fee_schedule_snapshots fee_schedule_snapshots_pkey; Type: CONSTRAINT; Schema: public; Owner: zollama
+--
+
+ALTER TABLE ONLY public.fee_schedule_snapshots
+    ADD CONSTRAINT fee_schedule_snapshots_pkey PRIMARY KEY (id);
+
+
+--
+-- Name: llm_response_cache llm_response_cache_cache_key_key; Type: CONSTRAINT; Schema: public; Owner: zollama
+--
+
+ALTER TABLE ONLY public.llm_response_cache
+    ADD CONSTRAINT llm_response_cache_cache_key_key UNIQUE (cache_key);
+
+
+--
+-- Name: llm_response_cache llm_response_cache_pkey; Type: CONSTRAINT; Schema: public; Owner: zollama
+--
+
+ALTER TABLE ONLY public.llm_response_cache
+    ADD CONSTRAINT llm_response_cache_pkey PRIMARY KEY (id);
+
+
+--
+-- Name: patient_code_items patient_code_items_pkey; Type: CONSTRAINT; Schema: public; Owner: zollama
+--
+
+ALTER TABLE ONLY public.patient_code_items
+    ADD CONSTRAINT patient_code_items_pkey PRIMARY KEY (id);
+
+
+--
+-- Name: patient_code_items patient_code_items_document_source_code_key; Type: CONSTRAINT; Schema: public; Owner: zollama
+--
+
+ALTER TABLE ONLY public.patient_code_items
+    ADD CONSTRAINT patient_code_items_document_source_code_key UNIQUE (patient_document_id, source, code);
+
+
 --
 -- Name: patient_codes patient_codes_pkey; Type: CONSTRAINT; Schema: public; Owner: zollama
 --
@@ -279,6 +641,42 @@ ALTER TABLE ONLY public.patient_notes
     ADD CONSTRAINT patient_notes_pkey PRIMARY KEY (id);
 
 
+--
+-- Name: schema_migrations schema_migrations_pkey; Type: CONSTRAINT; Schema: public; Owner: zollama
+--
+
+ALTER TABLE ONLY public.schema_migrations
+    ADD CONSTRAINT schema_migrations_pkey PRIMARY KEY (version);
+
+
+--
+-- Name: idx_analysis_batches_open; Type: INDEX; Schema: public; Owner: zollama
+--
+
+CREATE INDEX idx_analysis_batches_open ON public.analysis_batches USING btree (id) WHERE (phase <> 'done'::text);
+
+
+--
+-- Name: idx_analysis_batches_run_id; Type: INDEX; Schema: public; Owner: zollama
+--
+
+CREATE INDEX idx_analysis_batches_run_id ON public.analysis_batches USING btree (run_id);
+
+
+--
+-- Name: idx_analysis_jobs_lease; Type: INDEX; Schema: public; Owner: zollama
+--
+
+CREATE INDEX idx_analysis_jobs_lease ON public.analysis_jobs USING btree (lease_expires) WHERE (status = ANY (ARRAY['running'::text, 'cancelling'::text]));
+
+
+--
+-- Name: idx_analysis_jobs_queued; Type: INDEX; Schema: public; Owner: zollama
+--
+
+CREATE INDEX idx_analysis_jobs_queued ON public.analysis_jobs USING btree (id) WHERE (status = 'queued'::text);
+
+
 --
 -- Name: analysis_document_gin_index; Type: INDEX; Schema: public; Owner: zollama
 --
@@ -300,6 +698,27 @@ CREATE INDEX idx_codes_document_gin ON public.patient_codes USING gin (codes_doc
 CREATE INDEX idx_cpt_codes_sha256 ON public.cpt_hcpcs_codes USING btree (sha256);
 
 
+--
+-- Name: idx_cpt_codes_current_hcpc; Type: INDEX; Schema: public; Owner: zollama
+--
+
+CREATE INDEX idx_cpt_codes_current_hcpc ON public.cpt_hcpcs_codes USING btree (hcpc) WHERE (retired_snapshot_id IS NULL);
+
+
+--
+-- Name: idx_cpt_codes_hcpc_locality; Type: INDEX; Schema: public; Owner: zollama
+--
+
+CREATE INDEX idx_cpt_codes_hcpc_locality ON public.cpt_hcpcs_codes USING btree (hcpc, locality);
+
+
+--
+-- Name: idx_llm_response_cache_timestamp; Type: INDEX; Schema: public; Owner: zollama
+--
+
+CREATE INDEX idx_llm_response_cache_timestamp ON public.llm_response_cache USING btree ("timestamp");
+
+
 --
 -- Name: idx_mac; Type: INDEX; Schema: public; Owner: zollama
 --
@@ -307,6 +726,20 @@ CREATE INDEX idx_cpt_codes_sha256 ON public.cpt_hcpcs_codes USING btree (sha256)
 CREATE INDEX idx_mac ON public.medicare_data USING btree (mac);
 
 
+--
+-- Name: idx_patient_code_items_code; Type: INDEX; Schema: public; Owner: zollama
+--
+
+CREATE INDEX idx_patient_code_items_code ON public.patient_code_items USING btree (code_system, code);
+
+
+--
+-- Name: idx_patient_code_items_patient_id; Type: INDEX; Schema: public; Owner: zollama
+--
+
+CREATE INDEX idx_patient_code_items_patient_id ON public.patient_code_items USING btree (patient_id, code_system);
+
+
 --
 -- Name: idx_patient_document_id; Type: INDEX; Schema: public; Owner: zollama
 --
@@ -335,6 +768,13 @@ CREATE INDEX idx_timestamp ON public.patient_codes USING btree ("timestamp");
 CREATE INDEX patient_document_id_index ON public.patient_documents USING btree (patient_document_id);
 
 
+--
+-- Name: patient_documents_locality_index; Type: INDEX; Schema: public; Owner: zollama
+--
+
+CREATE INDEX patient_documents_locality_index ON public.patient_documents USING btree (patient_locality);
+
+
 --
 -- Name: patient_id_index; Type: INDEX; Schema: public; Owner: zollama
 --
@@ -342,6 +782,13 @@ CREATE INDEX patient_document_id_index ON public.patient_documents USING btree (
 CREATE INDEX patient_id_index ON public.patient_notes USING btree (patient_id);
 
 
+--
+-- Name: patient_locality_index; Type: INDEX; Schema: public; Owner: zollama
+--
+
+CREATE INDEX patient_locality_index ON public.patient_notes USING btree (patient_locality);
+
+
 --
 -- Name: patient_note_gin_index; Type: INDEX; Schema: public; Owner: zollama
 --
@@ -370,6 +817,62 @@ CREATE INDEX timestamp_index ON public.patient_notes USING btree ("timestamp");
 GRANT CREATE ON SCHEMA public TO zollama;
 
 
+--
+-- Name: TABLE analysis_batch_results; Type: ACL; Schema: public; Owner: zollama
+--
+
+GRANT ALL ON TABLE public.analysis_batch_results TO zollama;
+
+
+--
+-- Name: SEQUENCE analysis_batch_results_id_seq; Type: ACL; Schema: public; Owner: zollama
+--
+
+GRANT SELECT,USAGE ON SEQUENCE public.analysis_batch_results_id_seq TO zollama;
+
+
+--
+-- Name: TABLE analysis_batches; Type: ACL; Schema: public; Owner: zollama
+--
+
+GRANT ALL ON TABLE public.analysis_batches TO zollama;
+
+
+--
+-- Name: SEQUENCE analysis_batches_id_seq; Type: ACL; Schema: public; Owner: zollama
+--
+
+GRANT SELECT,USAGE ON SEQUENCE public.analysis_batches_id_seq TO zollama;
+
+
+--
+-- Name: TABLE analysis_jobs; Type: ACL; Schema: public; Owner: zollama
+--
+
+GRANT ALL ON TABLE public.analysis_jobs TO zollama;
+
+
+--
+-- Name: SEQUENCE analysis_jobs_id_seq; Type: ACL; Schema: public; Owner: zollama
+--
+
+GRANT SELECT,USAGE ON SEQUENCE public.analysis_jobs_id_seq TO zollama;
+
+
+--
+-- Name: TABLE code_details; Type: ACL; Schema: public; Owner: zollama
+--
+
+GRANT ALL ON TABLE public.code_details TO zollama;
+
+
+--
+-- Name: SEQUENCE code_details_id_seq; Type: ACL; Schema: public; Owner: zollama
+--
+
+GRANT SELECT,USAGE ON SEQUENCE public.code_details_id_seq TO zollama;
+
+
 --
 -- Name: TABLE cpt_hcpcs_codes; Type: ACL; Schema: public; Owner: zollama
 --
@@ -391,6 +894,34 @@ GRANT SELECT,USAGE ON SEQUENCE public.cpt_hcpcs_codes_id_seq1 TO zollama;
 GRANT ALL ON TABLE public.embeddings TO zollama;
 
 
+--
+-- Name: TABLE fee_schedule_snapshots; Type: ACL; Schema: public; Owner: zollama
+--
+
+GRANT ALL ON TABLE public.fee_schedule_snapshots TO zollama;
+
+
+--
+-- Name: SEQUENCE fee_schedule_snapshots_id_seq; Type: ACL; Schema: public; Owner: zollama
+--
+
+GRANT SELECT,USAGE ON SEQUENCE public.fee_schedule_snapshots_id_seq TO zollama;
+
+
+--
+-- Name: TABLE llm_response_cache; Type: ACL; Schema: public; Owner: zollama
+--
+
+GRANT ALL ON TABLE public.llm_response_cache TO zollama;
+
+
+--
+-- Name: SEQUENCE llm_response_cache_id_seq; Type: ACL; Schema: public; Owner: zollama
+--
+
+GRANT SELECT,USAGE ON SEQUENCE public.llm_response_cache_id_seq TO zollama;
+
+
 --
 -- Name: TABLE medicare_data; Type: ACL; Schema: public; Owner: zollama
 --
@@ -405,6 +936,20 @@ GRANT ALL ON TABLE public.medicare_data TO zollama;
 GRANT ALL ON TABLE public.old_patient_codes TO zollama;
 
 
+--
+-- Name: TABLE patient_code_items; Type: ACL; Schema: public; Owner: zollama
+--
+
+GRANT ALL ON TABLE public.patient_code_items TO zollama;
+
+
+--
+-- Name: SEQUENCE patient_code_items_id_seq; Type: ACL; Schema: public; Owner: zollama
+--
+
+GRANT SELECT,USAGE ON SEQUENCE public.patient_code_items_id_seq TO zollama;
+
+
 --
 -- Name: TABLE patient_codes; Type: ACL; Schema: public; Owner: zollama
 --
@@ -447,6 +992,13 @@ GRANT ALL ON TABLE public.patient_notes TO zollama;
 GRANT SELECT,USAGE ON SEQUENCE public.patient_notes_id_seq TO zollama;
 
 
+--
+-- Name: TABLE schema_migrations; Type: ACL; Schema: public; Owner: zollama
+--
+
+GRANT ALL ON TABLE public.schema_migrations TO zollama;
+
+
 --
 -- Name: DEFAULT PRIVILEGES FOR SEQUENCES; Type: DEFAULT ACL; Schema: public; Owner: zollama
 --
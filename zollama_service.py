@@ -2,7 +2,11 @@
 
     LICENSE: The 3-Clause BSD License - license.txt
 """
+from config import reload_on_sighup
 from zollama import app
+from zollama import ensure_job_workers
 
 if __name__ == "__main__":
+    reload_on_sighup()
+    ensure_job_workers()
     app.run()
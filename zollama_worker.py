@@ -0,0 +1,19 @@
+#!/usr/bin/env python3
+"""Standalone job worker for analysis jobs queued by the service API
+    ©2024, Ovais Quraishi
+
+    LICENSE: The 3-Clause BSD License - license.txt
+"""
+
+import logging
+import sys
+
+from config import reload_on_sighup
+from jobs import run_job_workers
+# registers the job handlers
+import zollama # pylint: disable=unused-import
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO) # init logging
+    reload_on_sighup()
+    run_job_workers(int(sys.argv[1]) if len(sys.argv) > 1 else 1)